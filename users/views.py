@@ -4,6 +4,7 @@ from django.urls import reverse_lazy
 from django.views import generic
 
 from users.forms import RegisterForm, UserUpdateForm
+from websites.limits import get_user_limits
 
 
 class UserCreationView(generic.CreateView):
@@ -21,6 +22,11 @@ class UserDetailView(LoginRequiredMixin, generic.DetailView):
     def get_object(self, queryset=None):
         return self.request.user
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["limits"] = get_user_limits(self.object)
+        return context
+
 
 class UserUpdateView(LoginRequiredMixin, generic.UpdateView):
     model = get_user_model()
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -23,9 +25,12 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = "django-insecure-#!0rg!@0&n^%@7f)m6kaotk!i^oarbk+#b(@2ntroiu^$da3g8"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get("DJANGO_DEBUG", "0") == "1"
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.environ.get("DJANGO_ALLOWED_HOSTS", "").split(",") if host]
+if not DEBUG and not ALLOWED_HOSTS:
+    # Django would answer every request with 400 Bad Request
+    raise ImproperlyConfigured("Set DJANGO_ALLOWED_HOSTS, or DJANGO_DEBUG=1 for development.")
 
 
 # Application definition
@@ -43,6 +48,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -82,7 +88,10 @@ DATABASES = {
         "USER": os.environ["POSTGRES_USER"],
         "PASSWORD": os.environ["POSTGRES_PASSWORD"],
         "HOST": os.environ["POSTGRES_HOST"],
-        "PORT": os.environ["POSTGRES_PORT"]
+        "PORT": os.environ["POSTGRES_PORT"],
+        # Keep connections open across requests and check them before reuse
+        "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
@@ -122,6 +131,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = "static/"
+STATIC_ROOT = BASE_DIR / "staticfiles"
+
+# Served by WhiteNoise from STATIC_ROOT after collectstatic
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "whitenoise.storage.CompressedStaticFilesStorage",
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -132,3 +152,164 @@ AUTH_USER_MODEL = "users.User"
 
 LOGIN_REDIRECT_URL = "/vpn/"
 LOGOUT_REDIRECT_URL = "/vpn/"
+
+# Proxy
+
+# Seconds a worker keeps resolving vpn/<website_name>/ from memory
+VPN_WEBSITE_CACHE_TTL = int(os.environ.get("VPN_WEBSITE_CACHE_TTL", 60))
+
+# Seconds between flushes of buffered traffic into TrafficRollup rows
+VPN_TRAFFIC_FLUSH_INTERVAL = int(os.environ.get("VPN_TRAFFIC_FLUSH_INTERVAL", 5))
+
+# compact_traffic rolls hourly traffic older than this many days into daily
+# rows and deletes daily rows older than VPN_TRAFFIC_DAILY_RETENTION_DAYS
+VPN_TRAFFIC_HOURLY_RETENTION_DAYS = int(os.environ.get("VPN_TRAFFIC_HOURLY_RETENTION_DAYS", 7))
+VPN_TRAFFIC_DAILY_RETENTION_DAYS = int(os.environ.get("VPN_TRAFFIC_DAILY_RETENTION_DAYS", 365))
+
+# Upstream sessions are kept per (user, website) and evicted LRU or when idle
+VPN_SESSION_POOL_SIZE = int(os.environ.get("VPN_SESSION_POOL_SIZE", 1000))
+VPN_SESSION_IDLE_TIMEOUT = int(os.environ.get("VPN_SESSION_IDLE_TIMEOUT", 600))
+
+# Upstream cookies are kept in each session's jar and never reach the
+# browser; a jar drops expired cookies and holds at most this many.
+VPN_COOKIE_JAR_MAX_COOKIES = int(os.environ.get("VPN_COOKIE_JAR_MAX_COOKIES", 200))
+
+# The jars are also saved for VPN_COOKIE_JAR_TTL seconds in this Django cache,
+# so upstream logins survive idle sessions and recycled workers. Only Redis or
+# Memcached share them between workers (manage.py serve warns about it).
+VPN_COOKIE_CACHE_ALIAS = os.environ.get("VPN_COOKIE_CACHE_ALIAS", "default")
+VPN_COOKIE_JAR_TTL = int(os.environ.get("VPN_COOKIE_JAR_TTL", 30 * 24 * 60 * 60))
+
+# Client request headers forwarded upstream; Referer and Origin are always
+# translated to the upstream site, cookies and User-Agent never forwarded.
+VPN_FORWARDED_REQUEST_HEADERS = [
+    "Accept",
+    "Accept-Language",
+    "Cache-Control",
+    "DNT",
+    "Pragma",
+    "Sec-Fetch-Dest",
+    "Sec-Fetch-Mode",
+    "Sec-Fetch-Site",
+    "Sec-Fetch-User",
+    "Upgrade-Insecure-Requests",
+    "X-Requested-With",
+]
+
+# urllib3 pool sizing for each upstream session; VPN_UPSTREAM_POOL_SIZES
+# overrides the per-host maxsize, e.g. {"example.com": 20}
+VPN_UPSTREAM_POOL_CONNECTIONS = int(os.environ.get("VPN_UPSTREAM_POOL_CONNECTIONS", 4))
+VPN_UPSTREAM_POOL_MAXSIZE = int(os.environ.get("VPN_UPSTREAM_POOL_MAXSIZE", 10))
+VPN_UPSTREAM_POOL_SIZES = {}
+
+# Upstream timeouts in seconds; the read timeout applies between bytes
+VPN_UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("VPN_UPSTREAM_CONNECT_TIMEOUT", 5))
+VPN_UPSTREAM_READ_TIMEOUT = float(os.environ.get("VPN_UPSTREAM_READ_TIMEOUT", 30))
+
+# After VPN_BREAKER_FAILURE_THRESHOLD consecutive failures (errors, timeouts,
+# 5xx) a host is failed fast with 503 for VPN_BREAKER_RESET_TIMEOUT seconds,
+# then probed with a single request. DNS failures and 404s are remembered
+# for VPN_NEGATIVE_CACHE_TTL seconds.
+VPN_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("VPN_BREAKER_FAILURE_THRESHOLD", 5))
+VPN_BREAKER_RESET_TIMEOUT = int(os.environ.get("VPN_BREAKER_RESET_TIMEOUT", 30))
+VPN_NEGATIVE_CACHE_TTL = int(os.environ.get("VPN_NEGATIVE_CACHE_TTL", 30))
+
+# Route vpn/<website_name>/ to the async view (httpx). Only enable when
+# serving through ASGI, so upstream connections stay on one event loop.
+VPN_ASYNC_PROXY = os.environ.get("VPN_ASYNC_PROXY", "") == "1"
+
+# Engine that rewrites proxied HTML: "stream" (pure Python, streams the page
+# as it arrives) or "lxml" (libxml2, faster on large pages but sends nothing
+# until the whole page is rewritten; falls back to "stream" without lxml).
+VPN_HTML_ENGINE = os.environ.get("VPN_HTML_ENGINE", "stream")
+
+# Cache for upstream responses and rewritten pages, honouring HTTP freshness.
+# BACKEND may be websites.cache.MemoryCache, websites.cache.FileCache
+# (OPTIONS: location, max_bytes) or websites.cache.DjangoCache
+# (OPTIONS: alias, timeout) for a cache shared by several nodes.
+VPN_CACHE = {
+    "BACKEND": "websites.cache.MemoryCache",
+    "OPTIONS": {
+        "max_bytes": int(os.environ.get("VPN_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    },
+}
+VPN_CACHE_MAX_ENTRY_SIZE = int(os.environ.get("VPN_CACHE_MAX_ENTRY_SIZE", 5 * 1024 * 1024))
+
+# Concurrent identical upstream fetches are coalesced into one; followers
+# wait up to VPN_COALESCE_TIMEOUT seconds for the leader. The key is the
+# normalized URL, the upstream cookies sent with it and these request headers.
+VPN_COALESCE_TIMEOUT = int(os.environ.get("VPN_COALESCE_TIMEOUT", 30))
+VPN_COALESCE_VARY_HEADERS = ["Accept", "Accept-Encoding", "Accept-Language"]
+
+# Rewritten pages are compressed for the client with the first of these it
+# accepts; "br" needs the optional brotli package
+VPN_OUTPUT_ENCODINGS = ["br", "gzip"]
+VPN_GZIP_LEVEL = int(os.environ.get("VPN_GZIP_LEVEL", 6))
+VPN_BROTLI_QUALITY = int(os.environ.get("VPN_BROTLI_QUALITY", 4))
+
+# Token buckets per user and per website, refilled at these rates and
+# holding VPN_RATE_LIMIT_BURST seconds' worth; 0 turns a limit off. Requests
+# over the rate get 429, bytes over the rate are sent more slowly.
+VPN_USER_REQUESTS_PER_SECOND = int(os.environ.get("VPN_USER_REQUESTS_PER_SECOND", 20))
+VPN_WEBSITE_REQUESTS_PER_SECOND = int(os.environ.get("VPN_WEBSITE_REQUESTS_PER_SECOND", 10))
+VPN_USER_BYTES_PER_SECOND = int(os.environ.get("VPN_USER_BYTES_PER_SECOND", 10 * 1024 * 1024))
+VPN_WEBSITE_BYTES_PER_SECOND = int(os.environ.get("VPN_WEBSITE_BYTES_PER_SECOND", 5 * 1024 * 1024))
+VPN_RATE_LIMIT_BURST = int(os.environ.get("VPN_RATE_LIMIT_BURST", 2))
+
+# Bytes a user may transfer per day and per calendar month (UTC); 0 is unlimited.
+# Usage comes from the traffic rollups, re-read every VPN_QUOTA_USAGE_TTL seconds.
+VPN_DAILY_BYTES_QUOTA = int(os.environ.get("VPN_DAILY_BYTES_QUOTA", 5 * 1024 ** 3))
+VPN_MONTHLY_BYTES_QUOTA = int(os.environ.get("VPN_MONTHLY_BYTES_QUOTA", 50 * 1024 ** 3))
+VPN_QUOTA_USAGE_TTL = int(os.environ.get("VPN_QUOTA_USAGE_TTL", 30))
+
+# Where the token buckets live: websites.limits.MemoryLimitStore keeps them
+# per process, so every worker allows the full rate (manage.py serve warns
+# about it), websites.limits.DjangoLimitStore (OPTIONS: alias) in a Django
+# cache, shared by all workers when it is Redis or Memcached.
+VPN_LIMITS = {
+    "BACKEND": "websites.limits.MemoryLimitStore",
+}
+
+# Websites with data saver on get JPEG, PNG and WebP images up to
+# VPN_DATA_SAVER_MAX_SOURCE_SIZE bytes downscaled to fit
+# VPN_DATA_SAVER_MAX_DIMENSION pixels and recompressed, by a pool of
+# VPN_DATA_SAVER_WORKERS processes. Needs the optional Pillow package.
+VPN_DATA_SAVER_QUALITY = int(os.environ.get("VPN_DATA_SAVER_QUALITY", 60))
+VPN_DATA_SAVER_MAX_DIMENSION = int(os.environ.get("VPN_DATA_SAVER_MAX_DIMENSION", 1280))
+VPN_DATA_SAVER_MAX_SOURCE_SIZE = int(os.environ.get("VPN_DATA_SAVER_MAX_SOURCE_SIZE", 10 * 1024 * 1024))
+VPN_DATA_SAVER_WORKERS = int(os.environ.get("VPN_DATA_SAVER_WORKERS", max((os.cpu_count() or 2) // 2, 1)))
+VPN_DATA_SAVER_TIMEOUT = int(os.environ.get("VPN_DATA_SAVER_TIMEOUT", 10))
+VPN_DATA_SAVER_CACHE_TTL = int(os.environ.get("VPN_DATA_SAVER_CACHE_TTL", 24 * 60 * 60))
+
+# Websites with prefetching on have the stylesheets and scripts of every
+# rewritten page, and the first VPN_PREFETCH_MAX_LINKS same-site links of
+# pages visited VPN_PREFETCH_HOT_VISITS times, fetched into the response
+# cache by VPN_PREFETCH_WORKERS threads (0 turns prefetching off). At most
+# VPN_PREFETCH_HOST_CONCURRENCY fetches run per upstream host and
+# VPN_PREFETCH_QUEUE_SIZE wait; all of them share a budget of
+# VPN_PREFETCH_BYTES_PER_SECOND.
+VPN_PREFETCH_WORKERS = int(os.environ.get("VPN_PREFETCH_WORKERS", 4))
+VPN_PREFETCH_HOST_CONCURRENCY = int(os.environ.get("VPN_PREFETCH_HOST_CONCURRENCY", 2))
+VPN_PREFETCH_QUEUE_SIZE = int(os.environ.get("VPN_PREFETCH_QUEUE_SIZE", 1000))
+VPN_PREFETCH_BYTES_PER_SECOND = int(os.environ.get("VPN_PREFETCH_BYTES_PER_SECOND", 2 * 1024 * 1024))
+VPN_PREFETCH_HOT_VISITS = int(os.environ.get("VPN_PREFETCH_HOT_VISITS", 3))
+VPN_PREFETCH_MAX_LINKS = int(os.environ.get("VPN_PREFETCH_MAX_LINKS", 20))
+
+# warm_cache fetches this many of the most visited pages of each website
+# with prefetching on, counting visits of the last VPN_CACHE_WARM_DAYS days
+VPN_CACHE_WARM_PAGES = int(os.environ.get("VPN_CACHE_WARM_PAGES", 20))
+VPN_CACHE_WARM_DAYS = int(os.environ.get("VPN_CACHE_WARM_DAYS", 7))
+
+# Bearer token for scraping /metrics/; without it only staff users may read it
+VPN_METRICS_TOKEN = os.environ.get("VPN_METRICS_TOKEN", "")
+
+# manage.py serve: gunicorn with VPN_SERVE_WORKERS processes (default
+# 2 * cores + 1) of VPN_SERVE_THREADS threads each, or uvicorn workers when
+# VPN_ASYNC_PROXY is on. Keep the threads at or below
+# VPN_UPSTREAM_POOL_MAXSIZE so they don't queue for upstream connections.
+VPN_SERVE_BIND = os.environ.get("VPN_SERVE_BIND", "0.0.0.0:8000")
+VPN_SERVE_WORKERS = int(os.environ.get("VPN_SERVE_WORKERS", 0))
+VPN_SERVE_THREADS = int(os.environ.get("VPN_SERVE_THREADS", 8))
+VPN_SERVE_TIMEOUT = int(os.environ.get("VPN_SERVE_TIMEOUT", 120))
+VPN_SERVE_GRACEFUL_TIMEOUT = int(os.environ.get("VPN_SERVE_GRACEFUL_TIMEOUT", 30))
+VPN_SERVE_MAX_REQUESTS = int(os.environ.get("VPN_SERVE_MAX_REQUESTS", 10000))
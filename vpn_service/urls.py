@@ -18,9 +18,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from websites.views import vpn_metrics
+
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/", include("users.urls")),
+    # Outside vpn/, where every name is a website
+    path("metrics/", vpn_metrics, name="metrics"),
     path("vpn/", include("websites.urls")),
 ]
@@ -0,0 +1,404 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.http import parse_etags, quote_etag
+from django.utils.module_loading import import_string
+from requests.structures import CaseInsensitiveDict
+
+from websites.rewriter import REWRITER_VERSION
+
+
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_LIFETIME = 24 * 60 * 60
+STORABLE_STATUSES = (200, 301, 308)
+PERMANENT_REDIRECTS = (301, 308)
+NOT_MODIFIED_UPDATE_EXCLUDE = {'content-length', 'content-encoding', 'content-type', 'transfer-encoding'}
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness_lifetime(headers, now, status=200):
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in directives:
+        return 0
+
+    for name in ('s-maxage', 'max-age'):
+        if directives.get(name):
+            try:
+                return max(int(directives[name]), 0)
+            except ValueError:
+                return 0
+
+    date = parse_http_date(headers.get('Date')) or now
+    if 'Expires' in headers:
+        expires = parse_http_date(headers['Expires'])
+        return max(expires - date, 0) if expires else 0
+
+    last_modified = parse_http_date(headers.get('Last-Modified'))
+    if last_modified:
+        return min(max(date - last_modified, 0) * HEURISTIC_FRACTION, HEURISTIC_MAX_LIFETIME)
+    if status in PERMANENT_REDIRECTS:
+        return HEURISTIC_MAX_LIFETIME
+    return 0
+
+
+def is_shared_cache(alias):
+    """Whether other processes see a Django cache; the local-memory and dummy caches are per process."""
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+def get_cache_key(url, cookie_scope):
+    """
+    Key of the upstream response for ``url``. Responses fetched with
+    cookies are kept apart per cookie scope (see get_cookie_scope), so
+    only cookie-less ones are shared between users.
+    """
+    return f"{url} cookies={cookie_scope}" if cookie_scope else url
+
+
+def _etag_digest(opaque, page_key):
+    return hashlib.sha256(f"{REWRITER_VERSION} {page_key} {opaque}".encode()).hexdigest()[:12]
+
+
+def rewritten_etag(etag, page_key):
+    """
+    ETag of a page rewritten from an upstream response with ``etag``.
+
+    The upstream tag stays readable inside ours, so a client's validator
+    can be translated back with ``upstream_etag``; the digest ties it to
+    the rewriter version and to the page key (proxy host, website, output
+    encoding and cookie scope).
+    """
+    weak, _, opaque = quote_etag(etag.strip()).rpartition('"')[0].partition('"')
+    return f'{weak}"{opaque}-{_etag_digest(opaque, page_key)}"'
+
+
+def upstream_etag(etag, page_key):
+    """Upstream tag behind one of our rewritten ETags, or None if ``etag`` isn't ours for ``page_key``."""
+    weak, _, opaque = etag.strip().rpartition('"')[0].partition('"')
+    opaque, separator, digest = opaque.rpartition('-')
+    if not separator or digest != _etag_digest(opaque, page_key):
+        return None
+    return f'{weak}"{opaque}"'
+
+
+def translate_validators(request_headers, page_key):
+    """
+    Client validators to forward upstream, with our rewritten ETags mapped
+    back to the upstream ones. The second value tells whether any tag was
+    translated, i.e. whether a 304 refers to a rewritten page.
+    """
+    headers = {}
+    translated = False
+    if request_headers.get('If-Modified-Since'):
+        headers['If-Modified-Since'] = request_headers['If-Modified-Since']
+    if request_headers.get('If-None-Match'):
+        tags = []
+        for tag in parse_etags(request_headers['If-None-Match']):
+            original = upstream_etag(tag, page_key) if tag != '*' else None
+            translated = translated or original is not None
+            tags.append(original or tag)
+        headers['If-None-Match'] = ', '.join(tags)
+    return headers, translated
+
+
+def is_storable(status, headers):
+    """Shared-cache storability of an upstream response (RFC 9111, section 3)."""
+    if status not in STORABLE_STATUSES or 'Set-Cookie' in headers or headers.get('Vary', '').strip() == '*':
+        return False
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    return 'no-store' not in directives and 'private' not in directives
+
+
+class CachedResponse:
+    def __init__(self, status, reason, headers, request_headers=None, body=b''):
+        self.status = status
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        request_headers = CaseInsensitiveDict(request_headers or {})
+        self.vary = {name: request_headers.get(name) for name in self.vary_names()}
+        self.stored_at = time.time()
+        self.lifetime = freshness_lifetime(self.headers, self.stored_at, status)
+        self.version = uuid.uuid4().hex
+        self.source = None
+
+    def vary_names(self):
+        return [name.strip().lower() for name in self.headers.get('Vary', '').split(',') if name.strip()]
+
+    def matches(self, request_headers):
+        if not self.vary:
+            return True
+        request_headers = CaseInsensitiveDict(request_headers)
+        return all(request_headers.get(name) == value for name, value in self.vary.items())
+
+    @property
+    def age(self):
+        return max(time.time() - self.stored_at, 0)
+
+    def is_fresh(self):
+        return self.age < self.lifetime
+
+    def has_validators(self):
+        return 'ETag' in self.headers or 'Last-Modified' in self.headers
+
+    def conditional_headers(self):
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def refresh(self, headers):
+        """Apply the headers of a 304 Not Modified and restart the freshness clock."""
+        for key, value in headers.items():
+            if key.lower() not in NOT_MODIFIED_UPDATE_EXCLUDE:
+                self.headers[key] = value
+        self.stored_at = time.time()
+        self.lifetime = freshness_lifetime(self.headers, self.stored_at, self.status)
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(key) + len(value) for key, value in self.headers.items())
+
+
+class MemoryCache:
+    """In-process LRU bounded by the total size of the stored responses."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry):
+        size = entry.size
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (entry, size)
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+
+class FileCache:
+    """
+    On-disk LRU for a single node.
+
+    Entries are pickled into ``location`` under the hash of their key; the
+    recency index is kept in memory and rebuilt from file mtimes on start.
+    """
+
+    def __init__(self, location, max_bytes):
+        self.location = location
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(location, exist_ok=True)
+        files = [entry for entry in os.scandir(location) if entry.name.endswith('.cache')]
+        for entry in sorted(files, key=lambda file: file.stat().st_mtime):
+            self._index[entry.path] = entry.stat().st_size
+            self._size += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.location, hashlib.sha256(key.encode()).hexdigest() + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            if path not in self._index:
+                return None
+            self._index.move_to_end(path)
+        try:
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.PickleError, EOFError):
+            self.delete(key)
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        fd, tmp_path = tempfile.mkstemp(dir=self.location)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size -= self._index.pop(path, 0)
+            self._index[path] = len(data)
+            self._size += len(data)
+            while self._size > self.max_bytes and self._index:
+                old_path, size = self._index.popitem(last=False)
+                self._size -= size
+                self._unlink(old_path)
+
+    def delete(self, key):
+        path = self._path(key)
+        with self._lock:
+            self._size -= self._index.pop(path, 0)
+        self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class DjangoCache:
+    """Stores entries in a Django cache alias, e.g. Redis or Memcached shared by a cluster."""
+
+    def __init__(self, alias='default', timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+
+    def _key(self, key):
+        return 'vpn:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        return caches[self.alias].get(self._key(key))
+
+    def set(self, key, entry):
+        caches[self.alias].set(self._key(key), entry, self.timeout)
+
+    def delete(self, key):
+        caches[self.alias].delete(self._key(key))
+
+
+class ResponseCache:
+    def __init__(self, backend, max_entry_size):
+        self.backend = backend
+        self.max_entry_size = max_entry_size
+
+    def lookup(self, key, request_headers):
+        entry = self.backend.get(key)
+        if entry is None or not entry.matches(request_headers):
+            return None
+        return entry
+
+    def lookup_page(self, key, page_key, request_headers):
+        """
+        Return the raw upstream entry for ``key`` and the rewritten page
+        derived from it, if that page was produced from the same upstream
+        body.
+        """
+        entry = self.lookup(key, request_headers)
+        if entry is None:
+            return None, None
+        page = self.lookup(page_key, request_headers)
+        if page is not None and page.source != entry.version:
+            page = None
+        return entry, page
+
+    def revalidate(self, key, page_key, entry, page, headers):
+        entry.refresh(headers)
+        self.store(key, entry)
+        if page is not None:
+            page.refresh({key: value for key, value in headers.items() if key.lower() != 'etag'})
+            self.store(page_key, page)
+
+    def invalidate(self, key):
+        """Drop the entry for ``key`` after an unsafe request to it; pages derived from it go with it."""
+        self.backend.delete(key)
+
+    def derive(self, entry, status, reason, headers):
+        """
+        New entry for output derived from ``entry``, sharing its freshness
+        clock. It matches the same upstream request headers as ``entry``;
+        what else it varies on, like the output encoding, is in its key.
+        """
+        derived = CachedResponse(status, reason, headers)
+        derived.vary = dict(entry.vary)
+        derived.stored_at = entry.stored_at
+        derived.lifetime = entry.lifetime
+        derived.source = entry.version
+        return derived
+
+    def store(self, key, entry):
+        if entry.size <= self.max_entry_size and (entry.lifetime > 0 or entry.has_validators()):
+            self.backend.set(key, entry)
+
+    def capture(self, content, key, entry):
+        """Pass ``content`` through and store it under ``key`` once it has been read completely."""
+        chunks = []
+        size = 0
+        for chunk in content:
+            if chunks is not None:
+                size += len(chunk)
+                chunks = chunks if size <= self.max_entry_size else None
+                if chunks is not None:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            entry.body = b''.join(chunks)
+            self.store(key, entry)
+
+    async def acapture(self, content, key, entry):
+        chunks = []
+        size = 0
+        async for chunk in content:
+            if chunks is not None:
+                size += len(chunk)
+                chunks = chunks if size <= self.max_entry_size else None
+                if chunks is not None:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            entry.body = b''.join(chunks)
+            self.store(key, entry)
+
+
+def create_response_cache():
+    config = settings.VPN_CACHE
+    backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return ResponseCache(backend, settings.VPN_CACHE_MAX_ENTRY_SIZE)
+
+
+response_cache = create_response_cache()
@@ -0,0 +1,235 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+from websites.utils import normalize_url
+
+
+class FlightAborted(Exception):
+    """The leader of a coalesced fetch stopped before the body was complete."""
+
+
+class Flight:
+    """
+    One in-flight upstream fetch shared between worker threads.
+
+    The leader publishes the upstream response (as a body-less
+    CachedResponse) with ``start`` and tees the body through ``feed``;
+    followers block in ``wait`` for the headers and then read the body
+    from the shared buffer with ``follow`` while the leader is still
+    downloading it.
+    """
+
+    def __init__(self, release, max_size):
+        self.release = release
+        self.max_size = max_size
+        self.entry = None
+        self.followers = 0
+        self.updated = time.monotonic()
+        self._chunks = []
+        self._size = 0
+        self._started = False
+        self._done = False
+        self._complete = False
+        self._cond = threading.Condition()
+
+    def start(self, entry):
+        with self._cond:
+            if self._started:
+                return
+            self.entry = entry
+            self._started = True
+            self._cond.notify_all()
+        if entry is None:
+            self.release()
+
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self._started, timeout)
+            if not self._started or self._chunks is None:
+                return None
+            return self.entry
+
+    def feed(self, content):
+        complete = False
+        try:
+            for chunk in content:
+                self._append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            self._finish(complete)
+
+    def follow(self, timeout):
+        position = 0
+        while True:
+            with self._cond:
+                ready = self._cond.wait_for(lambda: position < len(self._chunks) or self._done, timeout)
+                chunks = self._chunks[position:]
+                finished = self._done and position + len(chunks) >= len(self._chunks)
+                complete = self._complete
+            if not ready:
+                raise FlightAborted("Timed out waiting for the leader")
+
+            position += len(chunks)
+            yield from chunks
+            if finished:
+                if not complete:
+                    raise FlightAborted("Leader stopped before the end of the body")
+                return
+
+    def _append(self, chunk):
+        with self._cond:
+            if self._chunks is None:
+                return
+            self.updated = time.monotonic()
+            self._size += len(chunk)
+            if self._size <= self.max_size or self.followers:
+                self._chunks.append(chunk)
+                self._cond.notify_all()
+                return
+            self._chunks = None
+        self.release()
+
+    def _finish(self, complete):
+        with self._cond:
+            self._started = True
+            self._done = True
+            self._complete = complete
+            self._cond.notify_all()
+        self.release()
+
+
+class AsyncFlight:
+    """Counterpart of Flight for tasks sharing one event loop."""
+
+    def __init__(self, release, max_size):
+        self.release = release
+        self.max_size = max_size
+        self.entry = None
+        self.followers = 0
+        self.updated = time.monotonic()
+        self._chunks = []
+        self._size = 0
+        self._started = False
+        self._done = False
+        self._complete = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def start(self, entry):
+        if self._started:
+            return
+        self.entry = entry
+        self._started = True
+        self._notify()
+        if entry is None:
+            self.release()
+
+    async def wait(self, timeout):
+        if not self._started:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.entry if self._chunks is not None else None
+
+    async def feed(self, content):
+        complete = False
+        try:
+            async for chunk in content:
+                self._append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            self._finish(complete)
+
+    async def follow(self, timeout):
+        position = 0
+        while True:
+            if position >= len(self._chunks) and not self._done:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    raise FlightAborted("Timed out waiting for the leader")
+                continue
+
+            chunks = self._chunks[position:]
+            position += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if self._done and position >= len(self._chunks):
+                if not self._complete:
+                    raise FlightAborted("Leader stopped before the end of the body")
+                return
+
+    def _append(self, chunk):
+        if self._chunks is None:
+            return
+        self.updated = time.monotonic()
+        self._size += len(chunk)
+        if self._size > self.max_size and not self.followers:
+            self._chunks = None
+            self.release()
+            return
+        self._chunks.append(chunk)
+        self._notify()
+
+    def _finish(self, complete):
+        self._started = True
+        self._done = True
+        self._complete = complete
+        self._notify()
+        self.release()
+
+
+class SingleFlight:
+    """
+    Registry of in-flight fetches keyed by normalized URL, cookies and varying headers.
+
+    The first caller for a key becomes the leader; everyone arriving while
+    the flight is open joins it as a follower. A flight that has shown no
+    progress for ``timeout`` seconds is abandoned and the next caller leads
+    a fresh one.
+    """
+
+    def __init__(self, flight_class, max_size, timeout):
+        self.flight_class = flight_class
+        self.max_size = max_size
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and time.monotonic() - flight.updated < self.timeout:
+                flight.followers += 1
+                return flight, False
+
+            flight = self.flight_class(lambda: self._release(key, flight), self.max_size)
+            self._flights[key] = flight
+            return flight, True
+
+    def _release(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+def get_flight_key(url, request_headers, cookie_scope):
+    """
+    Requests sending different cookies never share a flight: the response
+    may be personalized for one user's upstream session.
+    """
+    names = settings.VPN_COALESCE_VARY_HEADERS
+    return normalize_url(url), cookie_scope, tuple((name.lower(), request_headers.get(name)) for name in names)
+
+
+flights = SingleFlight(Flight, settings.VPN_CACHE_MAX_ENTRY_SIZE, settings.VPN_COALESCE_TIMEOUT)
+async_flights = SingleFlight(AsyncFlight, settings.VPN_CACHE_MAX_ENTRY_SIZE, settings.VPN_COALESCE_TIMEOUT)
@@ -0,0 +1,214 @@
+import zlib
+
+from django.conf import settings
+
+from websites.rewriter import CHUNK_SIZE
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+
+class IdentityCoder:
+    pending = False
+
+    def decompress(self, data, max_length=0):
+        return data
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class DeflateDecoder:
+    """gzip and zlib bodies; "deflate" is also sent without the zlib header by some servers."""
+
+    def __init__(self, wbits):
+        self._wbits = wbits
+        self._first = True
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data, max_length=0):
+        """At most ``max_length`` bytes (0: all of it); the rest of ``data`` waits for the next call."""
+        if self._first and data:
+            self._first = False
+            try:
+                return self._decompressor.decompress(data, max_length)
+            except zlib.error:
+                if self._wbits != zlib.MAX_WBITS:
+                    raise
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(self._decompressor.unconsumed_tail + data, max_length)
+
+    @property
+    def pending(self):
+        return bool(self._decompressor.unconsumed_tail)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class BrotliDecoder:
+    pending = False
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data, max_length=0):
+        if hasattr(self._decompressor, "process"):
+            return self._decompressor.process(data)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class GzipEncoder:
+    """Flushes after every chunk so a streamed page reaches the client without waiting for the end."""
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(settings.VPN_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if not data:
+            return b""
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=settings.VPN_BROTLI_QUALITY)
+
+    def compress(self, data):
+        if not data:
+            return b""
+        process = getattr(self._compressor, "process", None) or self._compressor.compress
+        return process(data) + self._compressor.flush()
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+DECODERS = {
+    "identity": IdentityCoder,
+    "gzip": lambda: DeflateDecoder(16 + zlib.MAX_WBITS),
+    "x-gzip": lambda: DeflateDecoder(16 + zlib.MAX_WBITS),
+    "deflate": lambda: DeflateDecoder(zlib.MAX_WBITS),
+}
+
+ENCODERS = {
+    "gzip": GzipEncoder,
+}
+
+ENCODING_ALIASES = {"x-gzip": "gzip"}
+
+if brotli is not None:
+    DECODERS["br"] = BrotliDecoder
+    ENCODERS["br"] = BrotliEncoder
+
+
+def create_decoder(content_encoding):
+    """Decoder for an upstream Content-Encoding, or None when it can't be decoded here."""
+    encodings = [value.strip().lower() for value in (content_encoding or "identity").split(",") if value.strip()]
+    if len(encodings) != 1 or encodings[0] not in DECODERS:
+        return None
+    return DECODERS[encodings[0]]()
+
+
+def parse_accept_encoding(value):
+    accepted = {}
+    for part in (value or "").split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, arg = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(arg)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """Best output encoding the client accepts, in VPN_OUTPUT_ENCODINGS order of preference."""
+    accepted = parse_accept_encoding(accept_encoding)
+    best, best_quality = "identity", 0.0
+    for encoding in settings.VPN_OUTPUT_ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if encoding in ENCODERS and quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def accepts_encoding(accept_encoding, content_encoding):
+    """Whether a client sending ``accept_encoding`` takes a body in ``content_encoding`` as it is."""
+    coding = (content_encoding or "identity").strip().lower()
+    if coding == "identity":
+        return True
+    accepted = parse_accept_encoding(accept_encoding)
+    coding = ENCODING_ALIASES.get(coding, coding)
+    return accepted.get(coding, accepted.get("*", 0.0)) > 0
+
+
+def create_encoder(encoding):
+    return ENCODERS.get(encoding, IdentityCoder)()
+
+
+def add_vary(headers, name):
+    values = [name]
+    for key in [key for key in headers if key.lower() == "vary"]:
+        values = [value.strip() for value in headers.pop(key).split(",") if value.strip()] + values
+    headers["Vary"] = ", ".join(dict.fromkeys(values))
+
+
+class IdentityStream:
+    """Stands in for a RewriteStream when a body is only transcoded."""
+
+    def feed(self, data):
+        return data
+
+    def close(self):
+        return b""
+
+
+class EncodedStream:
+    """
+    Wraps a RewriteStream so it reads the upstream body still compressed and
+    writes the client body compressed, decoding and encoding chunk by chunk.
+
+    A feed decodes at most CHUNK_SIZE bytes, so a well compressed chunk
+    doesn't reach the rewriter as one huge piece; while ``pending``, the
+    rest is fed with empty chunks.
+    """
+
+    def __init__(self, stream, decoder, encoder):
+        self.stream = stream
+        self.decoder = decoder
+        self.encoder = encoder
+
+    @property
+    def pending(self):
+        return self.decoder.pending
+
+    def feed(self, chunk):
+        return self.encoder.compress(self.stream.feed(self.decoder.decompress(chunk, CHUNK_SIZE)))
+
+    def close(self):
+        data = b""
+        while self.decoder.pending:
+            data += self.stream.feed(self.decoder.decompress(b"", CHUNK_SIZE))
+        data += self.stream.feed(self.decoder.flush()) + self.stream.close()
+        return self.encoder.compress(data) + self.encoder.flush()
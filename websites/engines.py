@@ -0,0 +1,115 @@
+import logging
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from websites.rewriter import LINK_TAGS, HtmlRewriter, rewrite_attribute, rewrite_css
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+else:
+    # Without default_doctype libxml2 adds an HTML 4 doctype to pages that
+    # have none, switching browsers out of standards mode
+    PARSER = lxml.html.HTMLParser(default_doctype=False)
+
+
+logger = logging.getLogger(__name__)
+
+HTML_ENGINES = {
+    "stream": "websites.rewriter.HtmlRewriter",
+    "lxml": "websites.engines.LxmlRewriter",
+}
+
+
+class LxmlRewriter:
+    """
+    HTML rewriter on libxml2's parser.
+
+    It rewrites the same attributes, <style> blocks and <base> as
+    HtmlRewriter but needs the whole document: feed() only buffers and
+    close() returns the page as lxml serializes it. Much faster on large
+    pages at the cost of time to first byte.
+    """
+
+    available = lxml is not None
+
+    def __init__(self, rewrite_url, base_href=None, links=None):
+        self.rewrite_url = rewrite_url
+        self.base_href = base_href
+        self.links = links
+        self._parts = []
+
+    def feed(self, text):
+        self._parts.append(text)
+        return ""
+
+    def close(self):
+        text = "".join(self._parts)
+        self._parts = []
+        try:
+            document = lxml.html.document_fromstring(text, parser=PARSER)
+        except (etree.ParserError, ValueError):
+            # Empty pages and ones lxml refuses (e.g. with an XML encoding
+            # declaration) go through the streaming rewriter
+            rewriter = HtmlRewriter(self.rewrite_url, self.base_href, self.links)
+            return rewriter.feed(text) + rewriter.close()
+
+        self._rewrite(document)
+        if self.base_href:
+            self._insert_base(document)
+        if self.links is not None:
+            self.links.close()
+        return lxml.html.tostring(document.getroottree(), encoding="unicode")
+
+    def _rewrite(self, document):
+        for element in document.iter(etree.Element):
+            tag = element.tag
+            attrib = element.attrib
+            if self.links is not None and tag in LINK_TAGS:
+                self.links.add(tag, dict(attrib))
+            if tag == "link":
+                attrib.pop("integrity", None)
+            refresh = tag == "meta" and attrib.get("http-equiv", "").strip().lower() == "refresh"
+            for name, value in attrib.items():
+                new_value = rewrite_attribute(tag, name, value, refresh, self.rewrite_url)
+                if new_value is not None:
+                    attrib[name] = new_value
+            if tag == "style" and element.text:
+                element.text = rewrite_css(element.text, self.rewrite_url)
+
+    def _insert_base(self, document):
+        head = document.find("head")
+        if head is None:
+            head = etree.Element("head")
+            document.insert(0, head)
+        head.insert(0, etree.Element("base", href=self.base_href))
+
+
+def get_html_engine(name=None):
+    """
+    Rewriter class of the HTML engine ``name`` (VPN_HTML_ENGINE by default).
+    An engine whose library isn't installed falls back to the streaming one.
+    """
+    return load_engine(name or settings.VPN_HTML_ENGINE)
+
+
+@lru_cache
+def load_engine(name):
+    if name not in HTML_ENGINES:
+        raise ImproperlyConfigured(f"Unknown HTML engine {name!r}, expected one of {', '.join(HTML_ENGINES)}")
+    engine = import_string(HTML_ENGINES[name])
+    if not getattr(engine, "available", True):
+        logger.warning("HTML engine %r is not installed, using 'stream'", name)
+        return HtmlRewriter
+    return engine
+
+
+def available_engines():
+    """Names of the engines whose libraries are installed."""
+    return [name for name in HTML_ENGINES if getattr(import_string(HTML_ENGINES[name]), "available", True)]
@@ -0,0 +1,18 @@
+from django.http import HttpResponse
+
+
+class ProxyError(Exception):
+    """A proxied request answered with an error page of the proxy's own instead of a 500."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    def response(self):
+        response = HttpResponse(self.message, status=self.status)
+        if self.retry_after:
+            # A fraction of a second still means retrying later, not right away
+            response['Retry-After'] = str(max(int(self.retry_after), 1))
+        return response
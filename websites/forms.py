@@ -1,4 +1,5 @@
 from django import forms
+from django.db.models.functions import Lower
 
 from websites.models import Website
 
@@ -6,4 +7,15 @@ from websites.models import Website
 class WebsiteCreateUpdateForm(forms.ModelForm):
     class Meta:
         model = Website
-        fields = ["name", "url"]
+        fields = ["name", "url", "data_saver", "prefetch"]
+
+    def clean_name(self):
+        # The unique constraint covers the user, which is not a form field,
+        # so model validation skips it
+        name = self.cleaned_data["name"]
+        duplicates = Website.objects.annotate(name_lower=Lower("name")).filter(
+            user_id=self.instance.user_id, name_lower=name.lower()
+        ).exclude(pk=self.instance.pk)
+        if duplicates.exists():
+            raise forms.ValidationError("У вас вже є сайт з такою назвою.")
+        return name
@@ -0,0 +1,166 @@
+import socket
+import threading
+import time
+
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from django.conf import settings
+from urllib3.exceptions import NameResolutionError
+
+from websites.cache import get_cache_key
+from websites.errors import ProxyError
+from websites.utils import normalize_url
+
+
+TIMEOUT_ERRORS = (requests.Timeout, httpx.TimeoutException)
+UPSTREAM_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+NEGATIVE_CACHE_METHODS = ['GET', 'HEAD']
+
+
+class UpstreamError(ProxyError):
+    """An upstream failure answered with a gateway error instead of a 500."""
+
+
+class CircuitBreaker:
+    """
+    Per-host breaker. After ``failure_threshold`` consecutive failures the
+    host is considered down and requests fail fast for ``reset_timeout``
+    seconds; then a single probe request is let through (half-open) and
+    its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        """Whether a request may go to ``host``; otherwise the seconds until the next probe."""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state["opened_at"] is None:
+                return True, 0
+            now = time.monotonic()
+            wait = state["opened_at"] + self.reset_timeout - now
+            if wait > 0 or now - state["probing"] < self.reset_timeout:
+                return False, max(wait, 1)
+            state["probing"] = now
+            return True, 0
+
+    def record_success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, {"failures": 0, "opened_at": None, "probing": float("-inf")})
+            state["failures"] += 1
+            if state["failures"] >= self.failure_threshold:
+                state["opened_at"] = time.monotonic()
+            state["probing"] = float("-inf")
+
+
+class NegativeCache:
+    """Remembers dead hosts and missing pages for ``ttl`` seconds."""
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return item[1]
+
+    def add(self, key, error):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                now = time.monotonic()
+                self._entries = {key: item for key, item in self._entries.items() if item[0] > now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.monotonic() + self.ttl, error)
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+def is_dns_failure(exc):
+    seen = set()
+    errors = [exc]
+    while errors:
+        error = errors.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, (socket.gaierror, NameResolutionError)):
+            return True
+        errors.extend([error.__cause__, error.__context__, getattr(error, "reason", None)])
+        errors.extend(arg for arg in getattr(error, "args", ()) if isinstance(arg, BaseException))
+    return False
+
+
+def get_upstream_timeout():
+    return settings.VPN_UPSTREAM_CONNECT_TIMEOUT, settings.VPN_UPSTREAM_READ_TIMEOUT
+
+
+def get_missing_key(url, cookie_scope):
+    """Negative cache key of a page; like the response cache, a 404 seen with cookies isn't shared."""
+    return get_cache_key(normalize_url(url), cookie_scope)
+
+
+def check_upstream(url, method, cookie_scope):
+    """Fail fast for a host that is known to be down or a page known to be missing."""
+    host = get_host(url)
+    error = negative_cache.get(host)
+    if error is None and method in NEGATIVE_CACHE_METHODS:
+        error = negative_cache.get(get_missing_key(url, cookie_scope))
+    if error is not None:
+        raise UpstreamError(error.status, error.message)
+
+    allowed, retry_after = breaker.allow(host)
+    if not allowed:
+        raise UpstreamError(503, 'Сайт тимчасово недоступний', retry_after)
+
+
+def record_response(url, method, status_code, cookie_scope, remember_missing=True):
+    """
+    Count an upstream response for the host's breaker and remember a
+    missing page; background fetches pass ``remember_missing=False`` so
+    they never answer for a user.
+    """
+    if status_code >= 500:
+        breaker.record_failure(get_host(url))
+        return
+    breaker.record_success(get_host(url))
+    if remember_missing and status_code in (404, 410) and method in NEGATIVE_CACHE_METHODS:
+        negative_cache.add(get_missing_key(url, cookie_scope), UpstreamError(status_code, 'Сторінку не знайдено'))
+
+
+def record_exception(url, exc):
+    """Count a failed upstream request and return the gateway error to answer with."""
+    host = get_host(url)
+    breaker.record_failure(host)
+    if isinstance(exc, TIMEOUT_ERRORS):
+        return UpstreamError(504, 'Сайт не відповідає')
+    error = UpstreamError(502, 'Сайт недоступний')
+    if is_dns_failure(exc):
+        negative_cache.add(host, error)
+    return error
+
+
+breaker = CircuitBreaker(settings.VPN_BREAKER_FAILURE_THRESHOLD, settings.VPN_BREAKER_RESET_TIMEOUT)
+negative_cache = NegativeCache(settings.VPN_NEGATIVE_CACHE_TTL)
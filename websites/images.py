@@ -0,0 +1,107 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = {
+    "image/jpeg": "JPEG",
+    "image/pjpeg": "JPEG",
+    "image/png": "PNG",
+    "image/webp": "WEBP",
+}
+
+
+def transcode(data, image_format, quality, max_dimension):
+    """
+    Downscale an image to fit ``max_dimension`` and recompress it in its own
+    format. Runs in a pool process; returns None when the result would not
+    be smaller or the image can't be handled (animations, broken files).
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            image.thumbnail((max_dimension, max_dimension))
+            output = io.BytesIO()
+            if image_format == "JPEG":
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+            elif image_format == "WEBP":
+                image.save(output, "WEBP", quality=quality)
+            else:
+                image.save(output, "PNG")
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    result = output.getvalue()
+    return result if len(result) < len(data) else None
+
+
+class ImageSaver:
+    """
+    Process pool for data-saver transcoding, so decoding and encoding
+    images takes neither the request threads nor the event loop. The pool
+    is started on first use in each worker process.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, data, image_format):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            executor = self._executor
+        return executor.submit(
+            transcode, data, image_format, settings.VPN_DATA_SAVER_QUALITY, settings.VPN_DATA_SAVER_MAX_DIMENSION
+        )
+
+    def reset(self, executor_error):
+        """Drop a broken pool; the next image starts a new one."""
+        logger.warning("Image transcoding pool failed: %s", executor_error)
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_image_format(website, status, headers):
+    """The format to transcode a response in, or None when data saver doesn't apply to it."""
+    if Image is None or not website.data_saver or status != 200:
+        return None
+    if headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+        return None
+    try:
+        length = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        return None
+    if not 0 < length <= settings.VPN_DATA_SAVER_MAX_SOURCE_SIZE:
+        return None
+    media_type = (headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+    return IMAGE_FORMATS.get(media_type)
+
+
+def get_variant_key(url, etag, source):
+    """Cache key of a transcoded image: the source's ETag, or a digest of it when there is none."""
+    version = etag or hashlib.sha1(source).hexdigest()
+    settings_key = f"{settings.VPN_DATA_SAVER_QUALITY}:{settings.VPN_DATA_SAVER_MAX_DIMENSION}"
+    return f"{url} data-saver {settings_key} {version}"
+
+
+image_saver = ImageSaver(settings.VPN_DATA_SAVER_WORKERS)
@@ -0,0 +1,274 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from websites.cache import is_shared_cache
+from websites.errors import ProxyError
+from websites.models import TrafficRollup
+
+
+class LimitExceeded(ProxyError):
+    """A request refused by a rate limit or quota."""
+
+
+class MemoryLimitStore:
+    """In-process counters; every worker process enforces the limits on its own."""
+
+    shared = False
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, key, delta, timeout):
+        with self._lock:
+            now = time.monotonic()
+            value, expires = self._counters.get(key, (0, now))
+            if expires <= now:
+                value = 0
+            value += delta
+            self._counters[key] = (value, now + timeout)
+            if len(self._counters) > self.max_size:
+                self._counters = {name: item for name, item in self._counters.items() if item[1] > now}
+            return value
+
+    async def aincr(self, key, delta, timeout):
+        return self.incr(key, delta, timeout)
+
+
+class DjangoLimitStore:
+    """Counters in a Django cache, shared by all workers when it is Redis or Memcached."""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return is_shared_cache(self.alias)
+
+    def incr(self, key, delta, timeout):
+        cache = caches[self.alias]
+        key = f"vpn-limit:{key}"
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            cache.set(key, delta, timeout)
+            return delta
+
+    async def aincr(self, key, delta, timeout):
+        cache = caches[self.alias]
+        key = f"vpn-limit:{key}"
+        await cache.aadd(key, 0, timeout)
+        try:
+            return await cache.aincr(key, delta)
+        except ValueError:
+            await cache.aset(key, delta, timeout)
+            return delta
+
+
+class TokenBucket:
+    """
+    Token bucket kept in a single counter of consumed tokens, so it only
+    needs an atomic increment from the store.
+
+    At time ``t`` the bucket has been refilled with ``t * rate`` tokens
+    since the epoch; the tokens left are that minus the counter, capped at
+    ``capacity`` by moving the counter forward when the bucket is full.
+    """
+
+    def __init__(self, store, key, rate, capacity):
+        self.store = store
+        # The counter only makes sense for one rate
+        self.key = f"{key}:{rate}"
+        self.rate = rate
+        self.capacity = max(int(capacity), 1)
+        self.timeout = int(self.capacity / rate) + 60
+
+    def take(self, amount, reserve=False):
+        """
+        Take ``amount`` tokens and return the seconds until they are covered.
+        Unless ``reserve`` is set, a request the bucket can't cover right
+        away takes nothing.
+        """
+        refilled = int(time.time() * self.rate)
+        consumed = self.store.incr(self.key, amount, self.timeout)
+        full = refilled - self.capacity
+        if consumed - amount < full:
+            consumed = self.store.incr(self.key, full - (consumed - amount), self.timeout)
+        wait = (consumed - refilled) / self.rate
+        if wait > 0 and not reserve:
+            self.store.incr(self.key, -amount, self.timeout)
+        return max(wait, 0)
+
+    async def atake(self, amount, reserve=False):
+        refilled = int(time.time() * self.rate)
+        consumed = await self.store.aincr(self.key, amount, self.timeout)
+        full = refilled - self.capacity
+        if consumed - amount < full:
+            consumed = await self.store.aincr(self.key, full - (consumed - amount), self.timeout)
+        wait = (consumed - refilled) / self.rate
+        if wait > 0 and not reserve:
+            await self.store.aincr(self.key, -amount, self.timeout)
+        return max(wait, 0)
+
+
+class QuotaUsage:
+    """Bytes a user transferred today and this month, from TrafficRollup plus what this process sent since."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._usage.get(user_id)
+            if item is not None and item[0] > time.monotonic():
+                return item[1], item[2]
+        daily, monthly = get_user_traffic(user_id)
+        with self._lock:
+            self._usage[user_id] = (time.monotonic() + self.ttl, daily, monthly)
+        return daily, monthly
+
+    def add(self, user_id, size):
+        with self._lock:
+            item = self._usage.get(user_id)
+            if item is not None:
+                self._usage[user_id] = (item[0], item[1] + size, item[2] + size)
+
+
+def get_user_traffic(user_id):
+    now = timezone.now()
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    month_start = day_start.replace(day=1)
+    size = F("bytes_in") + F("bytes_out")
+    usage = TrafficRollup.objects.filter(website__user_id=user_id, period_start__gte=month_start).aggregate(
+        daily=Sum(size, filter=Q(period_start__gte=day_start), default=0),
+        monthly=Sum(size, default=0),
+    )
+    return usage["daily"], usage["monthly"]
+
+
+def get_user_limits(user):
+    """Configured limits and the user's quota usage, for the profile page."""
+    daily, monthly = get_user_traffic(user.pk)
+    return {
+        "user_requests_per_second": settings.VPN_USER_REQUESTS_PER_SECOND,
+        "user_bytes_per_second": settings.VPN_USER_BYTES_PER_SECOND,
+        "website_requests_per_second": settings.VPN_WEBSITE_REQUESTS_PER_SECOND,
+        "website_bytes_per_second": settings.VPN_WEBSITE_BYTES_PER_SECOND,
+        "daily_quota": settings.VPN_DAILY_BYTES_QUOTA,
+        "monthly_quota": settings.VPN_MONTHLY_BYTES_QUOTA,
+        "daily_used": daily,
+        "monthly_used": monthly,
+    }
+
+
+class RequestLimits:
+    """
+    Limits of one proxied request: requests per second are checked up
+    front, bytes per second by throttling the response chunks, and the
+    daily and monthly quotas both up front and while streaming.
+    """
+
+    def __init__(self, user_id, website_id):
+        self.user_id = user_id
+        self.website_id = website_id
+        self.budget = None
+
+    def buckets(self, kind, user_rate, website_rate):
+        burst = settings.VPN_RATE_LIMIT_BURST
+        if user_rate:
+            yield TokenBucket(limit_store, f"{kind}:user:{self.user_id}", user_rate, user_rate * burst)
+        if website_rate:
+            yield TokenBucket(
+                limit_store, f"{kind}:website:{self.website_id}", website_rate, website_rate * burst
+            )
+
+    def check(self):
+        """Raise LimitExceeded when the request is over a quota or the requests per second."""
+        quotas = (settings.VPN_DAILY_BYTES_QUOTA, settings.VPN_MONTHLY_BYTES_QUOTA)
+        if any(quotas):
+            usage = quota_usage.get(self.user_id)
+            self.budget = min(quota - used for quota, used in zip(quotas, usage) if quota)
+            if self.budget <= 0:
+                raise LimitExceeded(429, 'Ліміт трафіку вичерпано')
+
+        for bucket in self.buckets(
+            "requests", settings.VPN_USER_REQUESTS_PER_SECOND, settings.VPN_WEBSITE_REQUESTS_PER_SECOND
+        ):
+            wait = bucket.take(1)
+            if wait:
+                raise LimitExceeded(429, 'Забагато запитів', wait)
+
+    def spend(self, size):
+        """Count ``size`` bytes against the quota; False when it is used up."""
+        if self.budget is not None:
+            if self.budget <= 0:
+                return False
+            self.budget -= size
+            quota_usage.add(self.user_id, size)
+        return True
+
+    def take(self, size):
+        """Seconds to wait before sending ``size`` more bytes, or None when the quota is used up."""
+        if not self.spend(size):
+            return None
+        return max((
+            bucket.take(size, reserve=True)
+            for bucket in self.buckets(
+                "bytes", settings.VPN_USER_BYTES_PER_SECOND, settings.VPN_WEBSITE_BYTES_PER_SECOND
+            )
+        ), default=0)
+
+    async def atake(self, size):
+        if not self.spend(size):
+            return None
+        return max([
+            await bucket.atake(size, reserve=True)
+            for bucket in self.buckets(
+                "bytes", settings.VPN_USER_BYTES_PER_SECOND, settings.VPN_WEBSITE_BYTES_PER_SECOND
+            )
+        ], default=0)
+
+
+def throttle(content, limits):
+    """Pass ``content`` on at the allowed bytes per second; stop when the quota runs out."""
+    for chunk in content:
+        wait = limits.take(len(chunk))
+        if wait is None:
+            if hasattr(content, 'close'):
+                content.close()
+            return
+        if wait:
+            time.sleep(wait)
+        yield chunk
+
+
+async def athrottle(content, limits):
+    async for chunk in content:
+        wait = await limits.atake(len(chunk))
+        if wait is None:
+            if hasattr(content, 'aclose'):
+                await content.aclose()
+            return
+        if wait:
+            await asyncio.sleep(wait)
+        yield chunk
+
+
+def create_limit_store():
+    config = settings.VPN_LIMITS
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+limit_store = create_limit_store()
+quota_usage = QuotaUsage(settings.VPN_QUOTA_USAGE_TTL)
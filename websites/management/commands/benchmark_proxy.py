@@ -0,0 +1,401 @@
+import gzip
+import http.server
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import time
+import tracemalloc
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from websites.engines import available_engines, get_html_engine
+from websites.models import Website
+from websites.rewriter import CHUNK_SIZE, LinkRewriter, RewriteStream
+from websites.traffic import traffic
+
+
+# The benchmark measures the proxy, not the rate limits
+unlimited = override_settings(
+    VPN_USER_REQUESTS_PER_SECOND=0,
+    VPN_WEBSITE_REQUESTS_PER_SECOND=0,
+    VPN_USER_BYTES_PER_SECOND=0,
+    VPN_WEBSITE_BYTES_PER_SECOND=0,
+    VPN_DAILY_BYTES_QUOTA=0,
+    VPN_MONTHLY_BYTES_QUOTA=0,
+)
+
+
+def check_status(status, name, mode):
+    """A benchmark of error pages measures nothing; stop at the first response that is not 2xx or 3xx."""
+    if not 200 <= status < 400:
+        raise CommandError(f"{name} ({mode}): the proxy answered {status}")
+
+
+def html_page(body, title="Benchmark"):
+    return f"<!DOCTYPE html><html><head><title>{title}</title></head><body>{body}</body></html>".encode()
+
+
+def build_corpus():
+    paragraph = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8 + "</p>"
+    links = "".join(f'<a href="/articles/{i}?ref=list&amp;page={i % 7}">Article {i}</a>' for i in range(5000))
+    assets = "".join(
+        f'<img src="/img/{i}.jpg" srcset="/img/{i}.jpg 1x, /img/{i}@2x.jpg 2x" alt="">'
+        f'<link rel="stylesheet" href="/css/{i}.css"><script src="js/{i}.js"></script>'
+        f'<div style="background:url(/bg/{i}.png)"></div>'
+        for i in range(1500)
+    )
+    large = (paragraph + '<a href="/more">more</a>') * (5 * 1024 * 1024 // (len(paragraph) + 25))
+
+    return {
+        "small": {"body": html_page(paragraph * 4)},
+        "large": {"body": html_page(large)},
+        "link_heavy": {"body": html_page(links)},
+        "asset_heavy": {"body": html_page(assets)},
+        "slow_drip": {"body": html_page(paragraph * 50 + links[:links.index("<a", 20000)]), "drip": (40, 0.025)},
+        "gzip": {"body": html_page(links), "gzip": True},
+        "binary": {"body": os.urandom(1024 * 1024), "content_type": "application/octet-stream"},
+    }
+
+
+class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the benchmark corpus; the first path segment selects the page."""
+
+    corpus = {}
+    cache_control = "no-store"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        page = self.corpus.get(self.path.strip("/").split("/")[0])
+        if page is None:
+            self.send_error(404)
+            return
+
+        body = page["body"]
+        self.send_response(200)
+        self.send_header("Content-Type", page.get("content_type", "text/html; charset=utf-8"))
+        self.send_header("Cache-Control", self.cache_control)
+        if page.get("gzip"):
+            body = page.setdefault("gzipped", gzip.compress(body))
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        pieces, delay = page.get("drip", (1, 0))
+        step = -(-len(body) // pieces)
+        for start in range(0, len(body), step):
+            if delay:
+                time.sleep(delay)
+            self.wfile.write(body[start:start + step])
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "mean": statistics.fmean(ordered),
+    }
+
+
+def summarize(latencies, ttfbs, sizes, elapsed):
+    return {
+        "requests": len(latencies),
+        "latency_ms": {key: value * 1000 for key, value in percentiles(latencies).items()},
+        "ttfb_ms": {key: value * 1000 for key, value in percentiles(ttfbs).items()},
+        "throughput_rps": len(latencies) / elapsed,
+        "throughput_mbps": sum(sizes) / elapsed / (1024 * 1024),
+        "response_bytes": sizes[-1],
+    }
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_stage(func):
+    """Run ``func`` twice: once for wall time, once under tracemalloc for allocations."""
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"ms": elapsed * 1000, "alloc_peak_bytes": peak}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    """Benchmark the vpn_website hot path against a local upstream stand-in"""
+
+    help = (
+        "Serves a corpus of pages from a local HTTP server and drives vpn/<website_name>/ "
+        "in-process (Django test client) and over a real socket (threaded WSGI server). "
+        "Uses a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=30, help="Requests per scenario and mode.")
+        parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests before each scenario.")
+        parser.add_argument("--concurrency", type=int, default=4, help="Client threads in socket mode.")
+        parser.add_argument("--scenario", action="append", help="Only run these scenarios.")
+        parser.add_argument("--cacheable", action="store_true", help="Let the response cache serve the corpus.")
+        parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results.")
+        parser.add_argument("--compare", help="Previous results file to print latency deltas against.")
+
+    def handle(self, *args, **options):
+        corpus = build_corpus()
+        scenarios = options["scenario"] or list(corpus)
+        UpstreamHandler.corpus = corpus
+        UpstreamHandler.cache_control = "public, max-age=300" if options["cacheable"] else "no-store"
+
+        upstream = start_server(http.server.ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler))
+        proxy = ThreadedWSGIServer(("127.0.0.1", 0), QuietWSGIRequestHandler)
+        proxy.set_app(get_wsgi_application())
+        start_server(proxy)
+
+        setup_test_environment()
+        # The socket mode requests reach the proxy as 127.0.0.1
+        hosts = override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "127.0.0.1", "localhost"])
+        hosts.enable()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        unlimited.enable()
+        try:
+            user = get_user_model().objects.create_user("benchmark", password="benchmark")
+            Website.objects.create(user=user, name="bench", url=f"http://127.0.0.1:{upstream.server_port}/")
+            client = Client()
+            client.force_login(user)
+
+            results = {
+                "commit": git_commit(),
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "async_proxy": settings.VPN_ASYNC_PROXY,
+                "html_engine": settings.VPN_HTML_ENGINE,
+                "cacheable": options["cacheable"],
+                "scenarios": {},
+            }
+            for name in scenarios:
+                self.stdout.write(f"Running {name}...")
+                for _ in range(options["warmup"]):
+                    response = client.get(f"/vpn/bench/{name}")
+                    check_status(response.status_code, name, "warmup")
+                    b"".join(response.streaming_content)
+                results["scenarios"][name] = {
+                    "in_process": self.run_in_process(client, name, options["requests"]),
+                    "socket": self.run_socket(
+                        proxy.server_port, client.cookies, name, options["requests"], options["concurrency"]
+                    ),
+                    "stages": self.run_stages(upstream.server_port, name, corpus[name]),
+                    "peak_rss_kb": peak_rss_kb(),
+                }
+        finally:
+            traffic.flush()
+            unlimited.disable()
+            runner.teardown_databases(old_config)
+            hosts.disable()
+            teardown_test_environment()
+            proxy.shutdown()
+            upstream.shutdown()
+
+        with open(options["output"], "w") as file:
+            json.dump(results, file, indent=2)
+        self.report(results)
+        if options["compare"]:
+            self.compare(results, options["compare"])
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def run_in_process(self, client, name, count):
+        latencies, ttfbs, sizes = [], [], []
+        started = time.perf_counter()
+        for _ in range(count):
+            request_started = time.perf_counter()
+            response = client.get(f"/vpn/bench/{name}")
+            check_status(response.status_code, name, "in_process")
+            size = 0
+            ttfb = None
+            for chunk in response.streaming_content:
+                if ttfb is None:
+                    ttfb = time.perf_counter() - request_started
+                size += len(chunk)
+            response.close()
+            latencies.append(time.perf_counter() - request_started)
+            ttfbs.append(ttfb or latencies[-1])
+            sizes.append(size)
+        return summarize(latencies, ttfbs, sizes, time.perf_counter() - started)
+
+    def run_socket(self, port, cookies, name, count, concurrency):
+        latencies, ttfbs, sizes = [], [], []
+        lock = threading.Lock()
+        url = f"http://127.0.0.1:{port}/vpn/bench/{name}"
+        session_cookie = {settings.SESSION_COOKIE_NAME: cookies[settings.SESSION_COOKIE_NAME].value}
+        remaining = iter(range(count))
+        failures = []
+
+        def worker():
+            with requests.Session() as session:
+                session.cookies.update(session_cookie)
+                while True:
+                    with lock:
+                        if failures or next(remaining, None) is None:
+                            return
+                    request_started = time.perf_counter()
+                    response = session.get(url, stream=True, headers={"Accept-Encoding": "identity"})
+                    try:
+                        check_status(response.status_code, name, "socket")
+                    except CommandError as error:
+                        with lock:
+                            failures.append(error)
+                        return
+                    size = 0
+                    ttfb = None
+                    while chunk := response.raw.read1(CHUNK_SIZE, decode_content=False):
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - request_started
+                        size += len(chunk)
+                    elapsed = time.perf_counter() - request_started
+                    with lock:
+                        latencies.append(elapsed)
+                        ttfbs.append(ttfb or elapsed)
+                        sizes.append(size)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0]
+        return summarize(latencies, ttfbs, sizes, time.perf_counter() - started)
+
+    def run_stages(self, port, name, page):
+        """
+        Time and allocation peak of each pipeline stage on one page:
+        fetch (upstream read), parse (tokenize with identity links),
+        rewrite (tokenize and map links) and serialize (UTF-8 encode), with
+        the configured HTML engine. parse and rewrite are also timed for
+        every installed engine.
+        """
+        url = f"http://127.0.0.1:{port}/{name}"
+        body, fetch = measure_stage(lambda: requests.get(url).content)
+        content_type = page.get("content_type", "text/html; charset=utf-8")
+        if not content_type.startswith("text/html"):
+            return {"fetch": fetch}
+
+        text = body.decode("utf-8")
+
+        def link_rewriter():
+            return LinkRewriter("http://testserver/vpn/bench", url, f"/{name}")
+
+        def tokenize(engine, rewrite_url):
+            rewriter = engine(rewrite_url, base_href=url)
+            parts = [rewriter.feed(text[start:start + CHUNK_SIZE]) for start in range(0, len(text), CHUNK_SIZE)]
+            return "".join(parts) + rewriter.close()
+
+        engines = {}
+        for engine_name in available_engines():
+            engine = get_html_engine(engine_name)
+            _, parse = measure_stage(lambda: tokenize(engine, lambda value: value))
+            _, rewrite = measure_stage(lambda: tokenize(engine, link_rewriter()))
+            engines[engine_name] = {"parse": parse, "rewrite": rewrite}
+
+        engine = get_html_engine()
+        configured = engines.get(settings.VPN_HTML_ENGINE, engines["stream"])
+        output = tokenize(engine, link_rewriter())
+        _, serialize = measure_stage(lambda: output.encode())
+
+        def pipeline_run():
+            stream = RewriteStream(engine(link_rewriter(), url), content_type)
+            return stream.feed(body) + stream.close()
+
+        _, pipeline = measure_stage(pipeline_run)
+        return {
+            "fetch": fetch,
+            "parse": configured["parse"],
+            "rewrite": configured["rewrite"],
+            "serialize": serialize,
+            "pipeline": pipeline,
+            "engines": engines,
+        }
+
+    def report(self, results):
+        for name, result in results["scenarios"].items():
+            for mode in ("in_process", "socket"):
+                stats = result[mode]
+                self.stdout.write(
+                    f"{name:12} {mode:10} p50 {stats['latency_ms']['p50']:8.2f} ms  "
+                    f"p95 {stats['latency_ms']['p95']:8.2f} ms  p99 {stats['latency_ms']['p99']:8.2f} ms  "
+                    f"ttfb {stats['ttfb_ms']['p50']:8.2f} ms  {stats['throughput_rps']:7.1f} req/s  "
+                    f"{stats['throughput_mbps']:7.1f} MiB/s"
+                )
+            stages = "  ".join(
+                f"{stage} {data['ms']:.2f} ms" for stage, data in result["stages"].items() if stage != "engines"
+            )
+            self.stdout.write(f"{'':12} stages     {stages}  peak RSS {result['peak_rss_kb']} KiB")
+            engines = result["stages"].get("engines", {})
+            for engine_name, stages in engines.items():
+                parse, rewrite = stages["parse"]["ms"], stages["rewrite"]["ms"]
+                speedup = engines["stream"]["rewrite"]["ms"] / rewrite if rewrite else 0
+                self.stdout.write(
+                    f"{'':12} {engine_name:10} parse {parse:8.2f} ms  rewrite {rewrite:8.2f} ms  "
+                    f"({speedup:.2f}x stream)"
+                )
+
+    def compare(self, results, path):
+        with open(path) as file:
+            previous = json.load(file)
+        self.stdout.write(f"Compared with {previous.get('commit') or path}:")
+        for name, result in results["scenarios"].items():
+            old = previous["scenarios"].get(name)
+            if not old:
+                continue
+            for mode in ("in_process", "socket"):
+                before = old[mode]["latency_ms"]["p50"]
+                after = result[mode]["latency_ms"]["p50"]
+                change = (after - before) / before * 100 if before else 0
+                self.stdout.write(f"{name:12} {mode:10} p50 {before:8.2f} -> {after:8.2f} ms ({change:+.1f}%)")
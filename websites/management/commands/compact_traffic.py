@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Min, Q, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from websites.models import PageVisit, TrafficRollup
+from websites.traffic import FIELDS
+
+
+SUMS = {field: Sum(field) for field in FIELDS}
+
+
+def merge(rows, period, bucket):
+    """Replace ``rows`` by one row of ``period`` per website and ``bucket``."""
+    groups = list(rows.annotate(bucket=bucket).values("website_id", "bucket").annotate(**SUMS).order_by())
+    rows.delete()
+    TrafficRollup.objects.bulk_create([
+        TrafficRollup(website_id=group["website_id"], period=period, period_start=group["bucket"],
+                      **{field: group[field] for field in FIELDS})
+        for group in groups
+    ])
+    return len(groups)
+
+
+class Command(BaseCommand):
+    """Merge hourly traffic rows, roll old hours into days and delete expired days and pages"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hourly-days", type=int, default=settings.VPN_TRAFFIC_HOURLY_RETENTION_DAYS)
+        parser.add_argument("--daily-days", type=int, default=settings.VPN_TRAFFIC_DAILY_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        current_hour = now.replace(minute=0, second=0, microsecond=0)
+        cutoff = (now - timedelta(days=options["hourly_days"])).replace(hour=0, minute=0, second=0, microsecond=0)
+        hourly = TrafficRollup.objects.filter(period=TrafficRollup.HOUR)
+
+        with transaction.atomic():
+            # The current hour is still being appended to by the proxy
+            recent = hourly.filter(period_start__gte=cutoff, period_start__lt=current_hour)
+            duplicated = (
+                recent.values("website_id", "period_start").annotate(rows=Count("pk"))
+                .filter(rows__gt=1).values_list("period_start", flat=True).distinct()
+            )
+            hours = merge(recent.filter(period_start__in=list(duplicated)), TrafficRollup.HOUR, F("period_start"))
+
+        with transaction.atomic():
+            first_hour = hourly.filter(period_start__lt=cutoff).aggregate(first=Min("period_start"))["first"]
+            days = 0
+            if first_hour is not None:
+                first_day = first_hour.replace(hour=0, minute=0, second=0, microsecond=0)
+                expired = TrafficRollup.objects.filter(
+                    Q(period=TrafficRollup.HOUR, period_start__lt=cutoff)
+                    | Q(period=TrafficRollup.DAY, period_start__gte=first_day, period_start__lt=cutoff)
+                )
+                days = merge(expired, TrafficRollup.DAY, TruncDay("period_start"))
+
+        deleted, _ = TrafficRollup.objects.filter(
+            period=TrafficRollup.DAY, period_start__lt=now - timedelta(days=options["daily_days"])
+        ).delete()
+
+        pages, _ = PageVisit.objects.filter(last_visited__lt=now - timedelta(days=options["daily_days"])).delete()
+
+        self.stdout.write(
+            f"Merged {hours} hourly rows, rolled up {days} daily rows, deleted {deleted} expired rows "
+            f"and {pages} pages not visited since"
+        )
@@ -0,0 +1,79 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from gunicorn.app.base import BaseApplication
+
+from websites.limits import limit_store
+from websites.sessions import cookie_store
+
+
+def default_workers():
+    return (os.cpu_count() or 1) * 2 + 1
+
+
+def post_fork(server, worker):
+    # Connections opened by the master must not be shared with the workers
+    connections.close_all()
+
+
+class ProxyServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if settings.VPN_ASYNC_PROXY:
+            from vpn_service.asgi import application
+        else:
+            from vpn_service.wsgi import application
+        return application
+
+
+class Command(BaseCommand):
+    """
+    Serve the project with gunicorn: threaded WSGI workers, or uvicorn
+    workers when VPN_ASYNC_PROXY is on. SIGHUP reloads the workers
+    gracefully, SIGTERM lets in-flight requests finish.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bind", default=settings.VPN_SERVE_BIND)
+        parser.add_argument("--workers", type=int, default=settings.VPN_SERVE_WORKERS or default_workers())
+        parser.add_argument("--threads", type=int, default=settings.VPN_SERVE_THREADS)
+
+    def handle(self, *args, **options):
+        if settings.VPN_ASYNC_PROXY:
+            worker_class = "uvicorn.workers.UvicornWorker"
+        else:
+            worker_class = "gthread"
+        if options["workers"] > 1 and not limit_store.shared:
+            self.stderr.write(self.style.WARNING(
+                f"VPN_LIMITS keeps the rate limits per process: each of the {options['workers']} workers "
+                "allows the full rate. Use websites.limits.DjangoLimitStore with a shared cache (Redis or "
+                "Memcached) to enforce them across workers."
+            ))
+        if options["workers"] > 1 and not cookie_store.shared:
+            self.stderr.write(self.style.WARNING(
+                f"VPN_COOKIE_CACHE_ALIAS is a per-process cache: each of the {options['workers']} workers keeps "
+                "its own upstream cookies, so upstream logins are lost when a request reaches another worker. "
+                "Point it at a shared cache (Redis or Memcached)."
+            ))
+        self.stdout.write(f"Starting {options['workers']} {worker_class} workers on {options['bind']}")
+        ProxyServer({
+            "bind": options["bind"],
+            "workers": options["workers"],
+            "threads": options["threads"],
+            "worker_class": worker_class,
+            "timeout": settings.VPN_SERVE_TIMEOUT,
+            "graceful_timeout": settings.VPN_SERVE_GRACEFUL_TIMEOUT,
+            "max_requests": settings.VPN_SERVE_MAX_REQUESTS,
+            "max_requests_jitter": settings.VPN_SERVE_MAX_REQUESTS // 10,
+            "accesslog": "-",
+            "post_fork": post_fork,
+        }).run()
@@ -0,0 +1,51 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from websites.cache import MemoryCache, response_cache
+from websites.health import get_host
+from websites.models import Website
+from websites.prefetch import prefetcher
+from websites.utils import get_baseurl_and_path
+
+
+class Command(BaseCommand):
+    """Fetch the most visited pages of every website with prefetching on into the response cache"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=settings.VPN_CACHE_WARM_PAGES)
+        parser.add_argument("--days", type=int, default=settings.VPN_CACHE_WARM_DAYS)
+        parser.add_argument("--website", type=int, action="append", help="Only warm these website ids.")
+
+    def handle(self, *args, **options):
+        if isinstance(response_cache.backend, MemoryCache):
+            raise CommandError(
+                "VPN_CACHE uses the in-process MemoryCache; warming needs a FileCache or DjangoCache "
+                "shared with the proxy"
+            )
+
+        since = timezone.now() - timedelta(days=options["days"])
+        websites = Website.objects.filter(prefetch=True).order_by("pk")
+        if options["website"]:
+            websites = websites.filter(pk__in=options["website"])
+
+        results = Counter()
+        for website in websites:
+            base_url, _ = get_baseurl_and_path(website, '')
+            urls = website.pages.filter(last_visited__gte=since).order_by("-visits").values_list("url", flat=True)
+            jobs = [
+                (website.pk, base_url, url, {})
+                for url in urls[:options["pages"]] if get_host(url) == get_host(base_url)
+            ]
+            with ThreadPoolExecutor(max(settings.VPN_PREFETCH_HOST_CONCURRENCY, 1)) as executor:
+                fetched = executor.map(lambda job: prefetcher.fetch(*job), jobs)
+                website_results = Counter(result for result, _ in fetched)
+            summary = ", ".join(f"{count} {result}" for result, count in website_results.items())
+            self.stdout.write(f"{website}: {summary or 'no visited pages'}")
+            results += website_results
+
+        self.stdout.write(f"Warmed {results['stored'] + results['revalidated']} pages, {results['cached']} were fresh")
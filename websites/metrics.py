@@ -0,0 +1,211 @@
+import threading
+import time
+
+from bisect import bisect_left
+from collections import defaultdict
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms rendered in the Prometheus text format.
+
+    Each worker process keeps its own registry, so a scraper sees the
+    numbers of the process that answered.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(int)
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            self._counters[name, labels] += amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram()
+            histogram.observe(value)
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, list(histogram.counts), histogram.sum, histogram.buckets)
+                 for key, histogram in self._histograms.items()),
+                key=lambda item: item[0],
+            )
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{{{format_labels(labels)}}} {value}")
+
+        for (name, labels), counts, total, buckets in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(labels + (("le", bound),))
+                lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+            lines.append(f"{name}_sum{{{format_labels(labels)}}} {total}")
+            lines.append(f"{name}_count{{{format_labels(labels)}}} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("vpn_requests_total", "counter", "Proxied requests by website, method and cache status.")
+metrics.describe("vpn_bytes_total", "counter", "Bytes received from and sent to clients by website.")
+metrics.describe("vpn_upstream_responses_total", "counter", "Upstream responses by website and status code.")
+metrics.describe("vpn_stage_duration_seconds", "histogram", "Time spent in each stage of a proxied request.")
+
+
+class TimedStream:
+    """Adds the time spent in a RewriteStream's feed and close to a stage."""
+
+    def __init__(self, stream, timer, stage):
+        self.stream = stream
+        self.timer = timer
+        self.stage = stage
+
+    @property
+    def pending(self):
+        return self.stream.pending
+
+    def feed(self, chunk):
+        started = time.perf_counter()
+        try:
+            return self.stream.feed(chunk)
+        finally:
+            self.timer.add(self.stage, time.perf_counter() - started)
+
+    def close(self):
+        started = time.perf_counter()
+        try:
+            return self.stream.close()
+        finally:
+            self.timer.add(self.stage, time.perf_counter() - started)
+
+
+class StageTimer:
+    """
+    Stage durations of one proxied request.
+
+    Stages finished before the response headers go out (find_website,
+    cache, coalesce, upstream) are reported in the Server-Timing header;
+    all of them, including the streamed fetch and rewrite, end up in the
+    vpn_stage_duration_seconds histogram when the body is complete.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.status = None
+        self.cache_status = None
+
+    def set_response(self, response):
+        self.status = response.status_code
+        self.cache_status = response.get("X-Cache")
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def stage(self, name):
+        return StageContext(self, name)
+
+    def time_chunks(self, chunks, stage):
+        chunks = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            self.add(stage, time.perf_counter() - started)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def atime_chunks(self, chunks, stage):
+        chunks = aiter(chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = await anext(chunks, None)
+            self.add(stage, time.perf_counter() - started)
+            if chunk is None:
+                return
+            yield chunk
+
+    def time_stream(self, stream, stage):
+        return TimedStream(stream, self, stage) if stream is not None else None
+
+    def server_timing(self):
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+    def finish(self, website, bytes_received, bytes_sent):
+        website_id = str(website.pk)
+        self.add("total", time.perf_counter() - self.started)
+        metrics.inc("vpn_bytes_total", (("direction", "received"), ("website_id", website_id)), bytes_received)
+        metrics.inc("vpn_bytes_total", (("direction", "sent"), ("website_id", website_id)), bytes_sent)
+        for stage, seconds in self.stages.items():
+            metrics.observe("vpn_stage_duration_seconds", (("stage", stage), ("website_id", website_id)), seconds)
+
+
+class StageContext:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+def count_request(response, request, website):
+    request.stage_timer.set_response(response)
+    metrics.inc("vpn_requests_total", (
+        ("cache", response.get("X-Cache", "NONE")),
+        ("method", request.method),
+        ("website_id", str(website.pk)),
+    ))
+    if request.stage_timer.stages:
+        response["Server-Timing"] = request.stage_timer.server_timing()
+    return response
+
+
+def count_upstream(website, status_code):
+    metrics.inc("vpn_upstream_responses_total", (("status", str(status_code)), ("website_id", str(website.pk))))
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("websites", "0002_website_bytes_count_website_transition_count"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="website",
+            name="bytes_count",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:44
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+def rename_duplicate_names(apps, schema_editor):
+    """Websites whose names only differed in case get their id appended, so the constraint can be added."""
+    Website = apps.get_model("websites", "Website")
+    seen = set()
+    for website in Website.objects.order_by("pk"):
+        key = (website.user_id, website.name.lower())
+        if key in seen:
+            website.name = f"{website.name[:90]}-{website.pk}"
+            website.save(update_fields=["name"])
+        seen.add((website.user_id, website.name.lower()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("websites", "0003_alter_website_bytes_count"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_names, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="website",
+            constraint=models.UniqueConstraint(
+                models.F("user"),
+                django.db.models.functions.text.Lower("name"),
+                name="unique_website_name_per_user",
+                violation_error_message="У вас вже є сайт з такою назвою.",
+            ),
+        ),
+    ]
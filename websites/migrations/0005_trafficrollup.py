@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("websites", "0004_website_unique_name_per_user"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TrafficRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("period", models.CharField(choices=[("hour", "Hour"), ("day", "Day")], default="hour", max_length=4)),
+                ("period_start", models.DateTimeField()),
+                ("requests", models.IntegerField(default=0)),
+                ("transitions", models.IntegerField(default=0)),
+                ("bytes_in", models.BigIntegerField(default=0)),
+                ("bytes_out", models.BigIntegerField(default=0)),
+                ("cache_hits", models.IntegerField(default=0)),
+                ("errors", models.IntegerField(default=0)),
+                ("latency_sum", models.FloatField(default=0)),
+                ("website", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="traffic", to="websites.website")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["website", "period_start"], name="traffic_website_period_idx"), models.Index(fields=["period", "period_start"], name="traffic_period_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('websites', '0005_trafficrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trafficrollup',
+            name='bytes_saved',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='website',
+            name='bytes_saved',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='website',
+            name='data_saver',
+            field=models.BooleanField(default=False, help_text='Recompress and downscale JPEG, PNG and WebP images.'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('websites', '0006_website_data_saver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='website',
+            name='prefetch',
+            field=models.BooleanField(default=False, help_text='Fetch stylesheets, scripts and likely next pages in the background.'),
+        ),
+        migrations.CreateModel(
+            name='PageVisit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=2048)),
+                ('visits', models.IntegerField(default=0)),
+                ('last_visited', models.DateTimeField()),
+                ('website', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='websites.website')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['website', '-visits'], name='page_website_visits_idx')],
+                'constraints': [models.UniqueConstraint(fields=('website', 'url'), name='unique_page_per_website')],
+            },
+        ),
+    ]
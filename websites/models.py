@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth import get_user_model
 
 
@@ -6,12 +7,84 @@ class Website(models.Model):
     name = models.CharField(max_length=100)
     url = models.CharField(max_length=255)
     transition_count = models.IntegerField(default=0)
-    bytes_count = models.IntegerField(default=0)
+    bytes_count = models.BigIntegerField(default=0)
+    data_saver = models.BooleanField(
+        default=False, help_text="Recompress and downscale JPEG, PNG and WebP images."
+    )
+    bytes_saved = models.BigIntegerField(default=0)
+    prefetch = models.BooleanField(
+        default=False, help_text="Fetch stylesheets, scripts and likely next pages in the background."
+    )
     user = models.ForeignKey(
         get_user_model(),
         on_delete=models.CASCADE,
         related_name="websites"
     )
 
+    class Meta:
+        constraints = [
+            # Also serves as the (user, lower(name)) index for the proxy route lookup
+            models.UniqueConstraint(
+                models.F("user"),
+                Lower("name"),
+                name="unique_website_name_per_user",
+                violation_error_message="У вас вже є сайт з такою назвою.",
+            ),
+        ]
+
     def __str__(self) -> str:
         return f"{self.name}: {self.url}"
+
+
+class TrafficRollup(models.Model):
+    """
+    Traffic of one website over one hour or one day.
+
+    The proxy appends hourly rows in batches, so an hour may have several
+    rows until compact_traffic merges them; readers always aggregate.
+    """
+
+    HOUR = "hour"
+    DAY = "day"
+    PERIOD_CHOICES = [(HOUR, "Hour"), (DAY, "Day")]
+
+    website = models.ForeignKey(Website, on_delete=models.CASCADE, related_name="traffic")
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES, default=HOUR)
+    period_start = models.DateTimeField()
+    requests = models.IntegerField(default=0)
+    transitions = models.IntegerField(default=0)
+    bytes_in = models.BigIntegerField(default=0)
+    bytes_out = models.BigIntegerField(default=0)
+    bytes_saved = models.BigIntegerField(default=0)
+    cache_hits = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    latency_sum = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["website", "period_start"], name="traffic_website_period_idx"),
+            models.Index(fields=["period", "period_start"], name="traffic_period_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.website_id} {self.period} {self.period_start}"
+
+
+class PageVisit(models.Model):
+    """Visits of one upstream page of a website, for prefetching and warm_cache."""
+
+    website = models.ForeignKey(Website, on_delete=models.CASCADE, related_name="pages")
+    url = models.CharField(max_length=2048)
+    visits = models.IntegerField(default=0)
+    last_visited = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["website", "url"], name="unique_page_per_website"),
+        ]
+        indexes = [
+            models.Index(fields=["website", "-visits"], name="page_website_visits_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.website_id} {self.url}"
@@ -0,0 +1,233 @@
+import logging
+import threading
+
+from collections import OrderedDict, defaultdict, deque
+from queue import SimpleQueue
+from urllib.parse import urldefrag, urljoin
+
+from django.conf import settings
+
+from websites.cache import CachedResponse, get_cache_key, is_storable, response_cache
+from websites.health import (
+    UPSTREAM_ERRORS,
+    UpstreamError,
+    check_upstream,
+    get_host,
+    get_upstream_timeout,
+    record_exception,
+    record_response,
+)
+from websites.limits import TokenBucket, limit_store
+from websites.metrics import metrics
+from websites.rewriter import CHUNK_SIZE, is_rewritable
+from websites.sessions import get_cookie_scope, sessions
+from websites.utils import get_content_length
+
+
+logger = logging.getLogger(__name__)
+
+# Prefetches never carry the user's cookies: every website gets one session
+# of its own, so following a link can't change anyone's upstream state
+PREFETCH_USER = None
+MAX_TRACKED_PAGES = 10000
+
+metrics.describe("vpn_prefetch_total", "counter", "Background fetches by result.")
+metrics.describe("vpn_prefetch_bytes_total", "counter", "Bytes read from upstream by background fetches.")
+
+
+class PageLinks:
+    """
+    Collects the links of a page while it is rewritten: stylesheets and
+    scripts always, same-site links when ``follow_pages`` is set. They are
+    queued for prefetching once the page is complete.
+    """
+
+    def __init__(self, prefetcher, website_id, base_url, url, headers, follow_pages):
+        self.prefetcher = prefetcher
+        self.website_id = website_id
+        self.base_url = base_url
+        self.url = url
+        self.headers = {**headers, "Referer": url}
+        self.follow_pages = follow_pages
+        self.host = get_host(base_url)
+        self.pages = []
+        self.assets = []
+
+    def add(self, tag, attrs):
+        if tag == "a":
+            value, links = attrs.get("href"), self.pages if self.follow_pages else None
+        elif tag == "script":
+            value, links = attrs.get("src"), self.assets
+        elif "stylesheet" in attrs.get("rel", "").lower().split():
+            value, links = attrs.get("href"), self.assets
+        else:
+            return
+        if links is None or not value or not is_rewritable(value) or len(links) >= self.prefetcher.max_links:
+            return
+
+        url = urldefrag(urljoin(self.url, value.strip())).url
+        if url != self.url and get_host(url) == self.host and url not in links:
+            links.append(url)
+
+    def close(self):
+        self.prefetcher.enqueue(self.website_id, self.base_url, self.assets + self.pages, self.headers)
+
+
+class Prefetcher:
+    """
+    Background fetches into the response cache.
+
+    Jobs are run by ``workers`` daemon threads, started on first use; at
+    most ``queue_size`` wait and the rest are dropped. At most
+    ``host_concurrency`` fetches run against one upstream host, the others
+    wait in a line per host. Fetches are skipped while the shared
+    ``bytes_per_second`` budget is used up, and only responses the cache
+    may store are kept.
+    """
+
+    def __init__(self, workers, host_concurrency, queue_size, bytes_per_second, hot_visits, max_links):
+        self.workers = workers
+        self.host_concurrency = host_concurrency
+        self.queue_size = queue_size
+        self.hot_visits = hot_visits
+        self.max_links = max_links
+        self.budget = None
+        if bytes_per_second:
+            burst = bytes_per_second * settings.VPN_RATE_LIMIT_BURST
+            self.budget = TokenBucket(limit_store, "prefetch:bytes", bytes_per_second, burst)
+        self._jobs = SimpleQueue()
+        self._queued = set()
+        self._active = defaultdict(int)
+        self._waiting = defaultdict(deque)
+        self._visits = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def page_links(self, website, base_url, url, headers):
+        """Link collector for a page being rewritten, or None when the website doesn't prefetch."""
+        if not self.workers or not website.prefetch:
+            return None
+        follow_pages = self.visit(website.pk, url) >= self.hot_visits
+        return PageLinks(self, website.pk, base_url, url, headers, follow_pages)
+
+    def visit(self, website_id, url):
+        """Count a visit of a page in this process and return its visits so far."""
+        key = (website_id, url)
+        with self._lock:
+            visits = self._visits.pop(key, 0) + 1
+            self._visits[key] = visits
+            if len(self._visits) > MAX_TRACKED_PAGES:
+                self._visits.popitem(last=False)
+        return visits
+
+    def enqueue(self, website_id, base_url, urls, headers):
+        with self._lock:
+            if not self._threads:
+                self._start()
+            for url in urls:
+                if url in self._queued:
+                    continue
+                if len(self._queued) >= self.queue_size:
+                    metrics.inc("vpn_prefetch_total", (("result", "dropped"),))
+                    continue
+                self._queued.add(url)
+                self._jobs.put((website_id, base_url, url, headers))
+
+    def fetch(self, website_id, base_url, url, headers):
+        """
+        Fetch ``url`` into the response cache unless a fresh copy is there;
+        a stale one is revalidated. Returns the result and the bytes read.
+        """
+        session = sessions.get(PREFETCH_USER, website_id, base_url)
+        # Users sending no cookies share what is fetched without any
+        cookie_scope = get_cookie_scope(session, url)
+        key = get_cache_key(url, cookie_scope)
+        entry = response_cache.lookup(key, {**session.headers, **headers})
+        if entry is not None and entry.is_fresh():
+            return "cached", 0
+        conditional_headers = entry.conditional_headers() if entry is not None else {}
+
+        try:
+            check_upstream(url, "GET", cookie_scope)
+            response = session.get(
+                url, headers={**headers, **conditional_headers},
+                stream=True, allow_redirects=False, timeout=get_upstream_timeout()
+            )
+        except UpstreamError:
+            return "unavailable", 0
+        except UPSTREAM_ERRORS as exc:
+            record_exception(url, exc)
+            return "error", 0
+        record_response(url, "GET", response.status_code, cookie_scope, remember_missing=False)
+
+        with response:
+            if response.status_code == 304 and entry is not None:
+                response_cache.revalidate(key, None, entry, None, response.headers)
+                return "revalidated", 0
+            if not is_storable(response.status_code, response.headers):
+                return "not_storable", 0
+            if get_content_length(response.headers) > response_cache.max_entry_size:
+                return "too_large", 0
+            body = bytearray()
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                body += chunk
+                if len(body) > response_cache.max_entry_size:
+                    return "too_large", len(body)
+
+        response_cache.store(key, CachedResponse(
+            response.status_code, response.reason, response.headers, response.request.headers, bytes(body)
+        ))
+        return "stored", len(body)
+
+    def _start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"prefetch-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            host = get_host(job[2])
+            with self._lock:
+                if self._active[host] >= self.host_concurrency:
+                    self._waiting[host].append(job)
+                    continue
+                self._active[host] += 1
+
+            while job is not None:
+                self._run_job(job)
+                with self._lock:
+                    self._queued.discard(job[2])
+                    waiting = self._waiting[host]
+                    job = waiting.popleft() if waiting else None
+                    if job is None:
+                        del self._waiting[host]
+                        self._active[host] -= 1
+                        if not self._active[host]:
+                            del self._active[host]
+
+    def _run_job(self, job):
+        if self.budget is not None and self.budget.take(0):
+            result, size = "over_budget", 0
+        else:
+            try:
+                result, size = self.fetch(*job)
+            except Exception:
+                logger.exception("Prefetch of %s failed", job[2])
+                result, size = "error", 0
+        if size:
+            if self.budget is not None:
+                self.budget.take(size, reserve=True)
+            metrics.inc("vpn_prefetch_bytes_total", amount=size)
+        metrics.inc("vpn_prefetch_total", (("result", result),))
+
+
+prefetcher = Prefetcher(
+    settings.VPN_PREFETCH_WORKERS,
+    settings.VPN_PREFETCH_HOST_CONCURRENCY,
+    settings.VPN_PREFETCH_QUEUE_SIZE,
+    settings.VPN_PREFETCH_BYTES_PER_SECOND,
+    settings.VPN_PREFETCH_HOT_VISITS,
+    settings.VPN_PREFETCH_MAX_LINKS,
+)
@@ -0,0 +1,483 @@
+import codecs
+import re
+
+from html import escape, unescape
+from urllib.parse import quote, urljoin, urlparse, urlunparse
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_PENDING = 256 * 1024
+
+# Part of the ETag of every rewritten page; bump it whenever the rewritten
+# output changes so browsers don't keep pages produced by an older rewriter.
+REWRITER_VERSION = "2"
+
+URL_ATTRS = {
+    "a": {"href"},
+    "area": {"href"},
+    "link": {"href"},
+    "form": {"action"},
+    "button": {"formaction"},
+    "input": {"src", "formaction"},
+    "img": {"src", "srcset"},
+    "source": {"src", "srcset"},
+    "script": {"src"},
+    "iframe": {"src"},
+    "frame": {"src"},
+    "embed": {"src"},
+    "audio": {"src"},
+    "video": {"src", "poster"},
+    "track": {"src"},
+    "object": {"data"},
+    "body": {"background"},
+    "table": {"background"},
+    "td": {"background"},
+}
+RAW_TEXT_TAGS = {"script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes"}
+HEAD_TAGS = {"html", "head"}
+# Tags reported to the ``links`` collector of an HTML rewriter
+LINK_TAGS = {"a", "link", "script"}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+MEMO_SIZE = 4096
+PATH_SAFE = "!$&'()*+,;=" + "/~:@"
+
+_TAG_NAME_RE = re.compile(r"<([a-zA-Z][^\s/>]*)")
+_ATTR_RE = re.compile(r"""[\s/]*([^\s/>][^\s/>=]*)(?:(\s*=\s*)("[^"]*"|'[^']*'|[^\s>]*))?""")
+_TAG_END_RE = re.compile(r"[\s/]*>")
+_RAW_END_RE = {name: re.compile(f"</{name}", re.IGNORECASE) for name in RAW_TEXT_TAGS}
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([a-zA-Z0-9_.:-]+)""", re.IGNORECASE)
+_CSS_CHARSET_RE = re.compile(rb"""^@charset\s+["']([a-zA-Z0-9_.:-]+)["']""")
+_SCHEME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+_HTTP_SCHEME_RE = re.compile(r"^https?:", re.IGNORECASE)
+_CSS_URL_RE = re.compile(
+    r"""(?P<url>url\(\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^'")\s]*))\s*\))"""
+    r"""|(?P<import>@import\s+(?:"(?P<idq>[^"]*)"|'(?P<isq>[^']*)'))""",
+    re.IGNORECASE,
+)
+_SRCSET_RE = re.compile(r"([\s,]*)([^\s,]\S*?)(?:(,+)(?=\s|$)|(?=\s|$)([^,]*))")
+_CSS_TOKEN_START_RE = re.compile(r"url\(|@import", re.IGNORECASE)
+_CSS_TOKEN_MAX = 4096
+_REFRESH_URL_RE = re.compile(r"""^(\s*\d*\.?\d*\s*[;,]\s*(?:url\s*=\s*)?)(["']?)(.*?)\2\s*$""", re.IGNORECASE | re.DOTALL)
+
+
+def detect_encoding(content_type, head):
+    """Pick the charset from the Content-Type header, a BOM or a <meta> tag."""
+    _, _, params = (content_type or "").partition(";")
+    for param in params.split(";"):
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value:
+            return _known_encoding(value.strip("\"' "))
+
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+
+    match = _META_CHARSET_RE.search(head[:4096]) or _CSS_CHARSET_RE.match(head)
+    if match:
+        return _known_encoding(match.group(1).decode("ascii"))
+    return "utf-8"
+
+
+def _known_encoding(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return "utf-8"
+
+
+def get_host_port(url):
+    """Lowercased host and explicit port of a parsed URL; the default port of its scheme counts as none."""
+    try:
+        port = url.port
+    except ValueError:
+        return None
+    return url.hostname, None if port == DEFAULT_PORTS.get(url.scheme) else port
+
+
+def rewrite_link(value, proxy_prefix, scheme, main_domain, subpath):
+    """
+    Map a link found on an upstream page to its URL behind the proxy.
+
+    ``proxy_prefix`` is the absolute URL of vpn/<website_name>; the result is
+    the same as building it with reverse() and build_absolute_uri(). Links to
+    hosts other than ``main_domain`` (the website's host[:port]) are left
+    absolute, protocol-relative ones resolved against the page ``scheme``;
+    so are http links of an https website, which the proxy would upgrade.
+    """
+    value = value.replace(r'\/', '/')
+    value = value.replace(r'/\\', '/')
+    if value.startswith('//'):
+        value = f"{scheme}:{value}"
+
+    url = urlparse(value)
+    if url.netloc:
+        if get_host_port(url) != get_host_port(urlparse(f"{scheme}://{main_domain}")):
+            return value
+        if url.scheme == "http" and scheme != "http":
+            return value
+        value = urlunparse(('', '', url.path or '/', url.params, url.query, url.fragment))
+    elif url.scheme:
+        return value
+
+    new_href = urljoin(subpath, value)
+    if new_href and new_href[0] != '/':
+        new_href = '/' + new_href
+    return proxy_prefix + quote(new_href, safe=PATH_SAFE)
+
+
+def is_rewritable(value):
+    """
+    Relative and http(s) URLs go to rewrite_link, which keeps those of other
+    hosts; fragments and other schemes stay as they are.
+    """
+    value = value.strip()
+    if not value or value.startswith("#"):
+        return False
+    return not _SCHEME_RE.match(value) or bool(_HTTP_SCHEME_RE.match(value))
+
+
+def rewrite_srcset(value, rewrite_url):
+    """Rewrite every candidate URL of a srcset list, keeping the descriptors."""
+    def replace(match):
+        url = match.group(2)
+        if is_rewritable(url):
+            url = rewrite_url(url)
+        return match.group(1) + url + (match.group(3) or match.group(4) or "")
+
+    return _SRCSET_RE.sub(replace, value)
+
+
+def rewrite_css(text, rewrite_url):
+    """Rewrite url() and @import references in a complete piece of CSS."""
+    def replace(match):
+        if match.group("url"):
+            url = match.group("dq") if match.group("dq") is not None else match.group("sq")
+            if url is None:
+                url = match.group("bare")
+            if not is_rewritable(url):
+                return match.group(0)
+            return f'url("{rewrite_url(url)}")'
+
+        url = match.group("idq") if match.group("idq") is not None else match.group("isq")
+        if not is_rewritable(url):
+            return match.group(0)
+        return f'@import "{rewrite_url(url)}"'
+
+    return _CSS_URL_RE.sub(replace, text)
+
+
+def rewrite_refresh(value, rewrite_url):
+    """Rewrite the target of a <meta http-equiv="refresh"> content value."""
+    match = _REFRESH_URL_RE.match(value)
+    if not match or not match.group(3) or not is_rewritable(match.group(3)):
+        return value
+    return match.group(1) + rewrite_url(match.group(3))
+
+
+def attribute_value(raw):
+    """Unquoted, unescaped value of an attribute as written in the markup."""
+    if len(raw) > 1 and raw[0] in "\"'" and raw[-1] == raw[0]:
+        raw = raw[1:-1]
+    return unescape(raw)
+
+
+def rewrite_attribute(tag, name, value, refresh, rewrite_url):
+    """
+    New value for the unescaped attribute ``name`` of a ``tag`` element, or
+    None to leave it untouched. ``refresh`` tells whether the element is a
+    <meta http-equiv="refresh">. Shared by all HTML engines.
+    """
+    if name == "style":
+        new_value = rewrite_css(value, rewrite_url)
+    elif name == "srcset":
+        new_value = rewrite_srcset(value, rewrite_url)
+    elif name in URL_ATTRS.get(tag, ()):
+        new_value = rewrite_url(value.strip()) if is_rewritable(value) else None
+    elif refresh and name == "content":
+        new_value = rewrite_refresh(value, rewrite_url)
+    else:
+        new_value = None
+    return None if new_value == value else new_value
+
+
+class LinkRewriter:
+    """Per-request link mapper with everything but the link itself resolved up front."""
+
+    def __init__(self, proxy_prefix, base_url, subpath, memo_size=MEMO_SIZE):
+        parsed_base_url = urlparse(base_url)
+        self.proxy_prefix = proxy_prefix
+        self.scheme = parsed_base_url.scheme
+        self.main_domain = parsed_base_url.netloc
+        self.subpath = subpath
+        self.memo_size = memo_size
+        self._memo = {}
+
+    def __call__(self, value):
+        try:
+            return self._memo[value]
+        except KeyError:
+            pass
+        result = rewrite_link(value, self.proxy_prefix, self.scheme, self.main_domain, self.subpath)
+        if len(self._memo) < self.memo_size:
+            self._memo[value] = result
+        return result
+
+
+class CssRewriter:
+    """
+    Incremental url()/@import rewriter for stylesheets.
+
+    A reference that may still be incomplete at the end of a chunk is held
+    back until the next one arrives.
+    """
+
+    def __init__(self, rewrite_url):
+        self.rewrite_url = rewrite_url
+        self._pending = ""
+
+    def feed(self, text):
+        buffer = self._pending + text if self._pending else text
+        cut = max(len(buffer) - len("@import") + 1, 0)
+        for token in _CSS_TOKEN_START_RE.finditer(buffer, max(cut - _CSS_TOKEN_MAX, 0)):
+            if token.start() >= cut:
+                break
+            match = _CSS_URL_RE.match(buffer, token.start())
+            if not match or match.end() > cut:
+                cut = token.start()
+                break
+
+        self._pending = buffer[cut:]
+        return rewrite_css(buffer[:cut], self.rewrite_url)
+
+    def close(self):
+        text = rewrite_css(self._pending, self.rewrite_url)
+        self._pending = ""
+        return text
+
+
+class HtmlRewriter:
+    """
+    Incremental HTML tokenizer that rewrites link attributes on the fly.
+
+    Covers navigation links and forms, asset references (src, srcset,
+    poster, <link href>, ...), <meta> refreshes, inline style attributes
+    and <style> blocks. Text is fed in arbitrary chunks; everything outside
+    the rewritten values is copied through untouched. An incomplete tag at
+    the end of a chunk is held back until the next one arrives.
+
+    ``links``, when given, gets the attributes of every LINK_TAGS element
+    through ``add(tag, attrs)`` and a ``close()`` at the end of the page.
+    """
+
+    def __init__(self, rewrite_url, base_href=None, links=None):
+        self.rewrite_url = rewrite_url
+        self.base_href = base_href
+        self.links = links
+        self._pending = ""
+        self._raw_end = None
+        self._css = None
+
+    def feed(self, text):
+        buffer = self._pending + text if self._pending else text
+        out = []
+        pos = self._process(buffer, out, final=False)
+        self._pending = buffer[pos:]
+
+        if len(self._pending) > MAX_PENDING:
+            out.append(self._pending)
+            self._pending = ""
+        return "".join(out)
+
+    def close(self):
+        out = []
+        pos = self._process(self._pending, out, final=True)
+        out.append(self._pending[pos:])
+        self._pending = ""
+        if self.links is not None:
+            self.links.close()
+        return "".join(out)
+
+    def _process(self, buffer, out, final):
+        pos = 0
+        length = len(buffer)
+
+        while pos < length:
+            if self._raw_end:
+                match = self._raw_end.search(buffer, pos)
+                if not match:
+                    keep = 0 if final else len(self._raw_end.pattern) - 1
+                    stop = max(pos, length - keep)
+                    out.append(self._raw_text(buffer[pos:stop], final))
+                    return stop
+                out.append(self._raw_text(buffer[pos:match.start()], True))
+                pos = match.start()
+                self._raw_end = None
+
+            start = buffer.find("<", pos)
+            if start == -1:
+                out.append(buffer[pos:])
+                return length
+            out.append(buffer[pos:start])
+            pos = start
+
+            if buffer.startswith("<!--", start):
+                end = buffer.find("-->", start + 4)
+                if end == -1:
+                    return pos
+                pos = end + 3
+                out.append(buffer[start:pos])
+                continue
+
+            if start + 1 >= length:
+                return pos
+
+            if buffer[start + 1] in "!?/":
+                end = buffer.find(">", start + 1)
+                if end == -1:
+                    return pos
+                pos = end + 1
+                out.append(buffer[start:pos])
+                continue
+
+            tag = self._parse_tag(buffer, start)
+            if tag is None:
+                return pos
+            if tag is False:
+                out.append("<")
+                pos = start + 1
+                continue
+
+            name, attrs, end = tag
+            self._emit_tag(buffer, start, end, name, attrs, out)
+            pos = end
+
+            if name in RAW_TEXT_TAGS:
+                self._raw_end = _RAW_END_RE[name]
+                if name == "style":
+                    self._css = CssRewriter(self.rewrite_url)
+
+        return pos
+
+    def _raw_text(self, text, last):
+        if self._css is None:
+            return text
+        text = self._css.feed(text)
+        if last:
+            text += self._css.close()
+            self._css = None
+        return text
+
+    def _parse_tag(self, buffer, start):
+        match = _TAG_NAME_RE.match(buffer, start)
+        if not match:
+            return False
+
+        attrs = []
+        pos = match.end()
+        while True:
+            attr = _ATTR_RE.match(buffer, pos)
+            if not attr or attr.end() == pos:
+                break
+            attrs.append(attr)
+            pos = attr.end()
+
+        end = _TAG_END_RE.match(buffer, pos)
+        if not end:
+            return None
+        return match.group(1).lower(), attrs, end.end()
+
+    def _emit_tag(self, buffer, start, end, name, attrs, out):
+        if self.base_href and name not in HEAD_TAGS:
+            out.append(self._base_tag())
+        if self.links is not None and name in LINK_TAGS:
+            self.links.add(name, {
+                attr.group(1).lower(): attribute_value(attr.group(3)) for attr in attrs if attr.group(3) is not None
+            })
+
+        pos = start
+        for attr in attrs:
+            attr_name = attr.group(1).lower()
+            if name == "link" and attr_name == "integrity":
+                out.append(buffer[pos:attr.start()])
+                pos = attr.end()
+                continue
+
+            value = attr.group(3)
+            if value is None:
+                continue
+            new_value = self._rewrite_attr(name, attr_name, value, attrs)
+            if new_value is None:
+                continue
+            out.append(buffer[pos:attr.start(3)])
+            out.append(f'"{escape(new_value)}"')
+            pos = attr.end(3)
+        out.append(buffer[pos:end])
+
+        if self.base_href and name == "head":
+            out.append(self._base_tag())
+
+    def _rewrite_attr(self, name, attr_name, raw, attrs):
+        """New value for an attribute, or None to leave it untouched."""
+        refresh = name == "meta" and attr_name == "content" and self._is_refresh(attrs)
+        return rewrite_attribute(name, attr_name, attribute_value(raw), refresh, self.rewrite_url)
+
+    @staticmethod
+    def _is_refresh(attrs):
+        for attr in attrs:
+            if attr.group(1).lower() == "http-equiv" and attr.group(3):
+                return attr.group(3).strip("\"'").strip().lower() == "refresh"
+        return False
+
+    def _base_tag(self):
+        tag = f'<base href="{escape(self.base_href)}">'
+        self.base_href = None
+        return tag
+
+
+class RewriteStream:
+    """Byte-level wrapper around a text rewriter: decodes input, encodes output as UTF-8."""
+
+    def __init__(self, rewriter, content_type=None):
+        self.rewriter = rewriter
+        self.content_type = content_type
+        self._decoder = None
+
+    def feed(self, chunk):
+        if self._decoder is None:
+            if not chunk:
+                return b""
+            encoding = detect_encoding(self.content_type, chunk)
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        return self.rewriter.feed(self._decoder.decode(chunk)).encode()
+
+    def close(self):
+        text = self._decoder.decode(b"", final=True) if self._decoder else ""
+        return (self.rewriter.feed(text) + self.rewriter.close()).encode()
+
+
+def rewrite_stream(chunks, stream):
+    for chunk in chunks:
+        data = stream.feed(chunk)
+        if data:
+            yield data
+        while stream.pending:
+            data = stream.feed(b"")
+            if data:
+                yield data
+    data = stream.close()
+    if data:
+        yield data
+
+
+async def arewrite_stream(chunks, stream):
+    async for chunk in chunks:
+        data = stream.feed(chunk)
+        if data:
+            yield data
+        while stream.pending:
+            data = stream.feed(b"")
+            if data:
+                yield data
+    data = stream.close()
+    if data:
+        yield data
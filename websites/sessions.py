@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import threading
+import time
+import urllib.request
+import weakref
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import cloudscraper
+import httpx
+from asgiref.sync import async_to_sync
+from cloudscraper import CipherSuiteAdapter
+from cloudscraper.user_agent import User_Agent
+from django.conf import settings
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+
+from websites.cache import is_shared_cache
+
+
+def get_pool_maxsize(host):
+    return settings.VPN_UPSTREAM_POOL_SIZES.get(host, settings.VPN_UPSTREAM_POOL_MAXSIZE)
+
+
+def create_session(url):
+    """Cloudscraper session with connection pools sized for the upstream host."""
+    session = cloudscraper.create_scraper()
+    maxsize = get_pool_maxsize(urlparse(url).hostname)
+
+    https_adapter = session.get_adapter("https://")
+    session.mount("https://", CipherSuiteAdapter(
+        ssl_context=https_adapter.ssl_context,
+        source_address=https_adapter.source_address,
+        pool_connections=settings.VPN_UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=maxsize,
+    ))
+    session.mount("http://", HTTPAdapter(
+        pool_connections=settings.VPN_UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=maxsize,
+    ))
+    return session
+
+
+def close_session(session):
+    session.close()
+
+
+def create_async_client(url):
+    """httpx client for the async proxy path, sending cloudscraper's browser headers."""
+    maxsize = get_pool_maxsize(urlparse(url).hostname)
+    return httpx.AsyncClient(
+        headers=User_Agent(allow_brotli=False).headers,
+        limits=httpx.Limits(max_connections=maxsize, max_keepalive_connections=maxsize),
+        timeout=httpx.Timeout(settings.VPN_UPSTREAM_READ_TIMEOUT, connect=settings.VPN_UPSTREAM_CONNECT_TIMEOUT),
+    )
+
+
+def close_async_client(client):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Discarded from a sync view, e.g. when the website is updated
+        async_to_sync(client.aclose)()
+        return
+    loop.create_task(client.aclose())
+
+
+def get_cookie_jar(session):
+    """The http.cookiejar.CookieJar of a requests session or an httpx client."""
+    return getattr(session.cookies, "jar", session.cookies)
+
+
+def get_cookie_scope(session, url):
+    """
+    Digest of the cookies ``session`` sends to ``url``, or "" when it sends
+    none. Responses may only be shared between requests of the same scope.
+    """
+    request = urllib.request.Request(url)
+    get_cookie_jar(session).add_cookie_header(request)
+    cookie = request.get_header("Cookie")
+    return hashlib.sha256(cookie.encode()).hexdigest()[:16] if cookie else ""
+
+
+def prune_cookies(jar, max_cookies):
+    """Drop expired cookies, then those closest to expiring while the jar holds more than ``max_cookies``."""
+    jar.clear_expired_cookies()
+    cookies = list(jar)
+    if len(cookies) <= max_cookies:
+        return
+    cookies.sort(key=lambda cookie: cookie.expires or float("inf"))
+    for cookie in cookies[:len(cookies) - max_cookies]:
+        try:
+            jar.clear(cookie.domain, cookie.path, cookie.name)
+        except KeyError:
+            pass
+
+
+def get_jar_digest(jar):
+    cookies = sorted(
+        (cookie.domain, cookie.path, cookie.name, cookie.value or "", cookie.expires or 0) for cookie in jar
+    )
+    return hashlib.sha256(repr(cookies).encode()).hexdigest()[:16]
+
+
+class DjangoCookieStore:
+    """
+    Cookie jars of the upstream sessions in a Django cache, keyed by (user,
+    website). With Redis or Memcached an upstream login or Cloudflare
+    clearance reaches every worker and outlives recycled workers and idle
+    sessions; a session's jar is loaded when it is handed out and saved
+    whenever a response changes it.
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+        # Digest of the jar each session last loaded or saved, so unchanged jars are left alone
+        self._digests = weakref.WeakKeyDictionary()
+
+    @property
+    def shared(self):
+        return is_shared_cache(self.alias)
+
+    def _key(self, key):
+        return f"vpn-cookies:{key[0]}:{key[1]}"
+
+    def _load(self, session, stored):
+        if stored is None or stored[0] == self._digests.get(session):
+            return
+        jar = get_cookie_jar(session)
+        jar.clear()
+        for cookie in stored[1]:
+            jar.set_cookie(cookie)
+        self._digests[session] = stored[0]
+
+    def load(self, key, session):
+        self._load(session, caches[self.alias].get(self._key(key)))
+
+    async def aload(self, key, session):
+        self._load(session, await caches[self.alias].aget(self._key(key)))
+
+    def _changes(self, session):
+        jar = get_cookie_jar(session)
+        digest = get_jar_digest(jar)
+        if digest == self._digests.get(session):
+            return None
+        self._digests[session] = digest
+        return digest, list(jar)
+
+    def save(self, key, session):
+        changes = self._changes(session)
+        if changes is not None:
+            caches[self.alias].set(self._key(key), changes, self.timeout)
+
+    async def asave(self, key, session):
+        changes = self._changes(session)
+        if changes is not None:
+            await caches[self.alias].aset(self._key(key), changes, self.timeout)
+
+    def delete(self, key):
+        caches[self.alias].delete(self._key(key))
+
+    def track(self, key, session):
+        """Save the jar of ``session`` after each of its responses."""
+        if isinstance(session, httpx.AsyncClient):
+            async def save(response):
+                await self.asave(key, session)
+
+            session.event_hooks["response"].append(save)
+            return
+
+        def save(response, **kwargs):
+            # requests extracts the response's cookies only after the hooks ran
+            extract_cookies_to_jar(session.cookies, response.request, response.raw)
+            self.save(key, session)
+
+        session.hooks["response"].append(save)
+
+
+class SessionPool:
+    """
+    Upstream sessions keyed by (user, website).
+
+    Each user gets their own cookie jar and Cloudflare clearance for every
+    website, while keep-alive connections are reused across requests. The
+    pool holds at most ``max_size`` sessions; the least recently used one
+    is closed when it overflows and sessions idle for longer than
+    ``idle_timeout`` seconds are dropped. Upstream cookies live in these
+    jars, each holding at most ``max_cookies`` unexpired cookies, and in
+    ``cookie_store`` when there is one.
+    """
+
+    def __init__(
+        self, max_size, idle_timeout, max_cookies, factory=create_session, close=close_session, cookie_store=None
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_cookies = max_cookies
+        self.factory = factory
+        self.close = close
+        self.cookie_store = cookie_store
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, website_id, url):
+        session = self._get(user_id, website_id, url)
+        if self.cookie_store is not None:
+            self.cookie_store.load((user_id, website_id), session)
+        return session
+
+    async def aget(self, user_id, website_id, url):
+        session = self._get(user_id, website_id, url)
+        if self.cookie_store is not None:
+            await self.cookie_store.aload((user_id, website_id), session)
+        return session
+
+    def _get(self, user_id, website_id, url):
+        key = (user_id, website_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                self._sessions.move_to_end(key)
+                entry[1] = now
+                self._evict(now)
+
+        if entry is not None:
+            prune_cookies(get_cookie_jar(entry[0]), self.max_cookies)
+            return entry[0]
+
+        session = self.factory(url)
+
+        with self._lock:
+            entry = self._sessions.setdefault(key, [session, now])
+            self._sessions.move_to_end(key)
+            self._evict(now)
+
+        if entry[0] is not session:
+            self.close(session)
+        elif self.cookie_store is not None:
+            self.cookie_store.track(key, session)
+        return entry[0]
+
+    def discard(self, user_id=None, website_id=None):
+        with self._lock:
+            keys = [
+                key for key in self._sessions
+                if user_id in (None, key[0]) and website_id in (None, key[1])
+            ]
+            sessions = [self._sessions.pop(key)[0] for key in keys]
+
+        for session in sessions:
+            self.close(session)
+        if self.cookie_store is not None:
+            for key in keys:
+                self.cookie_store.delete(key)
+
+    def _evict(self, now):
+        while self._sessions:
+            key, (session, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_size and now - last_used < self.idle_timeout:
+                break
+            del self._sessions[key]
+            self.close(session)
+
+
+cookie_store = DjangoCookieStore(settings.VPN_COOKIE_CACHE_ALIAS, settings.VPN_COOKIE_JAR_TTL)
+sessions = SessionPool(
+    settings.VPN_SESSION_POOL_SIZE,
+    settings.VPN_SESSION_IDLE_TIMEOUT,
+    settings.VPN_COOKIE_JAR_MAX_COOKIES,
+    cookie_store=cookie_store,
+)
+async_clients = SessionPool(
+    settings.VPN_SESSION_POOL_SIZE,
+    settings.VPN_SESSION_IDLE_TIMEOUT,
+    settings.VPN_COOKIE_JAR_MAX_COOKIES,
+    factory=create_async_client,
+    close=close_async_client,
+    cookie_store=cookie_store,
+)
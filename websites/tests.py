@@ -1,3 +1,1301 @@
-from django.test import TestCase
+import gzip
+import io
+import random
+import threading
+import time
 
-# Create your tests here.
+from concurrent.futures import Future
+from http.cookiejar import Cookie
+from datetime import timedelta
+from html import unescape
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.urls import reverse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from websites.cache import MemoryCache, response_cache
+from websites.coalesce import Flight, SingleFlight
+from websites.compression import EncodedStream, IdentityCoder, IdentityStream, create_decoder
+from websites.engines import available_engines, get_html_engine
+from websites.forms import WebsiteCreateUpdateForm
+from websites.health import CircuitBreaker, NegativeCache, UpstreamError
+from websites.images import Image, image_saver, transcode
+from websites.limits import DjangoLimitStore, LimitExceeded, MemoryLimitStore, RequestLimits, TokenBucket, athrottle
+from websites.management.commands.benchmark_proxy import build_corpus
+from websites.models import TrafficRollup, Website
+from websites.prefetch import Prefetcher
+from websites.rewriter import CHUNK_SIZE, HtmlRewriter, LinkRewriter, rewrite_link, rewrite_stream
+from websites.sessions import (
+    DjangoCookieStore,
+    SessionPool,
+    close_async_client,
+    create_async_client,
+    create_session,
+    prune_cookies,
+)
+from websites.traffic import TrafficCounter, traffic
+from websites.utils import WebsiteCache, get_forwarded_headers
+from websites.metrics import StageTimer
+from websites.views import async_vpn_website, call_upstream, get_scheme_upgrade, rewrite_redirect_headers
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Answers /<route>/<argument> with the route registered for its first
+    path segment; every request is recorded.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = self.read_chunks()
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command, self.path, self.headers, body))
+
+        name, _, argument = self.path[1:].partition("/")
+        route = self.server.routes.get(name)
+        if route is None:
+            status, headers, content = 404, {}, b"missing"
+        else:
+            status, headers, content = route(self, argument)
+        self.send_response(status)
+        for name, value in headers.items() if isinstance(headers, dict) else headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def read_chunks(self):
+        body = b""
+        while size := int(self.rfile.readline().split(b";")[0], 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+        return body
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_OPTIONS = handle_request
+
+
+def html(body, **headers):
+    return 200, {"Content-Type": "text/html", **headers}, body.encode()
+
+
+def whoami(handler, argument):
+    return html(f"<p>{handler.headers.get('Cookie')}</p>", **{"Cache-Control": "max-age=60"})
+
+
+def page(handler, argument):
+    """Cacheable page varying on the language, revalidated with its ETag."""
+    headers = {"Cache-Control": argument or "max-age=60", "ETag": '"v1"', "Vary": "Accept-Language"}
+    if handler.headers.get("If-None-Match") == '"v1"':
+        return 304, headers, b""
+    return html(f"<p>{handler.headers.get('Accept-Language')}</p>", **headers)
+
+
+def script(handler, argument):
+    """Script compressed the way the upstream session asks for, whatever the client accepts."""
+    headers = {"Content-Type": "application/javascript", "Content-Encoding": "gzip", "Cache-Control": "max-age=60"}
+    return 200, headers, gzip.compress(b"var a = 1;" * 100)
+
+
+def echo(handler, argument):
+    """Answers with the status in the path and the method and body it got."""
+    status, headers, content = html(f"<p>{handler.command} {handler.server.requests[-1][3].decode()}</p>")
+    return int(argument or status), headers, content
+
+
+def video(handler, argument):
+    """Ten bytes of video; a "bytes=<first>-<last>" Range gets 206 Partial Content."""
+    body = b"0123456789"
+    headers = {"Content-Type": "video/mp4", "Accept-Ranges": "bytes", "Cache-Control": "max-age=60"}
+    if handler.headers.get("Range"):
+        first, last = map(int, handler.headers["Range"].removeprefix("bytes=").split("-"))
+        return 206, {**headers, "Content-Range": f"bytes {first}-{last}/{len(body)}"}, body[first:last + 1]
+    return 200, headers, body
+
+
+def redirect(handler, argument):
+    return 302, {"Location": f"/{argument}"}, b""
+
+
+def login(handler, argument):
+    return 200, {"Set-Cookie": f"sid={argument}; Path=/", "Content-Type": "text/plain"}, b"ok"
+
+
+def photo(handler, argument):
+    """Noise saved at full JPEG quality, so data saver always makes it smaller."""
+    if not hasattr(photo, "body"):
+        output = io.BytesIO()
+        pixels = random.Random(0).randbytes(200 * 200 * 3)
+        Image.frombytes("RGB", (200, 200), pixels).save(output, "JPEG", quality=100)
+        photo.body = output.getvalue()
+    return 200, {"Content-Type": "image/jpeg", "Cache-Control": "max-age=60"}, photo.body
+
+
+def private(handler, argument):
+    """Found only for a logged in session."""
+    if "sid=" not in (handler.headers.get("Cookie") or ""):
+        return 404, {"Content-Type": "text/plain"}, b"not found"
+    return html("<p>private</p>")
+
+
+def vary(response):
+    return {value.strip() for value in response.get("Vary", "").split(",")}
+
+
+class ProxyTestCase(TestCase):
+    """Runs the proxy against a local upstream server; ``routes`` maps its paths to handlers."""
+
+    routes = {
+        "whoami": whoami,
+        "page": page,
+        "echo": echo,
+        "redirect": redirect,
+        "script": script,
+        "login": login,
+        "video": video,
+        "private": private,
+        "photo": photo,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.upstream = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+        cls.upstream.routes = cls.routes
+        cls.upstream.requests = []
+        threading.Thread(target=cls.upstream.serve_forever, daemon=True).start()
+        cls.upstream_url = f"http://127.0.0.1:{cls.upstream.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.upstream.shutdown()
+        cls.upstream.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.upstream.requests.clear()
+        for patcher in [
+            mock.patch.object(response_cache, "backend", MemoryCache(16 * 1024 * 1024)),
+            # User and website ids are reused once a test is rolled back
+            mock.patch("websites.utils.website_cache", WebsiteCache(0)),
+            mock.patch("websites.views.sessions", SessionPool(100, 600, 200)),
+            mock.patch("websites.views.flights", SingleFlight(Flight, 1024 * 1024, 30)),
+            mock.patch("websites.health.breaker", CircuitBreaker(5, 30)),
+            mock.patch("websites.health.negative_cache", NegativeCache(30)),
+            # Traffic is flushed by a thread of its own, outside the test transaction
+            mock.patch.object(traffic, "_start"),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = self.create_user("alice")
+
+    def create_user(self, username):
+        user = get_user_model().objects.create_user(username, password="secret")
+        Website.objects.create(user=user, name="site", url=f"{self.upstream_url}/")
+        return user
+
+    def get(self, path, user=None, **headers):
+        """Proxied GET of ``path``; the response is returned with its body still unread."""
+        # Sessions get random browser headers; send the same ones for every user
+        headers = {"Accept": "text/html", "Accept-Language": "uk", **headers}
+        self.client.force_login(user or self.user)
+        return self.client.get(f"/vpn/site{path}", headers=headers)
+
+    def upstream_paths(self):
+        return [path for _, path, _, _ in self.upstream.requests]
+
+    @staticmethod
+    def read(response):
+        if getattr(response, "streaming", False):
+            return b"".join(response.streaming_content)
+        return response.content
+
+
+@override_settings(VPN_COALESCE_TIMEOUT=1)
+class CoalescingTests(ProxyTestCase):
+    def test_same_user_joins_the_flight(self):
+        self.read(self.get("/login/alice"))
+        leader = self.get("/whoami")
+        follower = self.get("/whoami")
+
+        self.assertEqual(leader["X-Cache"], "MISS")
+        self.assertEqual(follower["X-Cache"], "COALESCED")
+        self.assertIn(b"<p>sid=alice</p>", self.read(leader))
+        self.assertIn(b"<p>sid=alice</p>", self.read(follower))
+
+    def test_users_with_different_cookies_do_not_share_a_flight(self):
+        bob = self.create_user("bob")
+        self.read(self.get("/login/alice"))
+        self.read(self.get("/login/bob", user=bob))
+
+        leader = self.get("/whoami")
+        other = self.get("/whoami", user=bob)
+
+        self.assertEqual(other["X-Cache"], "MISS")
+        self.assertIn(b"<p>sid=bob</p>", self.read(other))
+        self.assertIn(b"<p>sid=alice</p>", self.read(leader))
+
+
+class CacheTests(ProxyTestCase):
+    def test_fresh_response_is_served_from_the_cache(self):
+        self.read(self.get("/page"))
+        response = self.get("/page")
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertIn(b"<p>uk</p>", self.read(response))
+        self.assertEqual(self.upstream_paths(), ["/page"])
+
+    def test_rewritten_page_is_served_from_the_cache(self):
+        self.read(self.get("/page"))
+        with mock.patch("websites.views.create_rewriter") as create_rewriter:
+            response = self.get("/page")
+            self.assertIn(b"<p>uk</p>", self.read(response))
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        create_rewriter.assert_not_called()
+
+    def test_stale_response_is_revalidated(self):
+        self.read(self.get("/page/no-cache"))
+        response = self.get("/page/no-cache")
+
+        self.assertEqual(response["X-Cache"], "REVALIDATED")
+        self.assertIn(b"<p>uk</p>", self.read(response))
+        self.assertEqual(self.upstream_paths(), ["/page/no-cache"] * 2)
+
+    def test_vary_header_selects_the_response(self):
+        self.read(self.get("/page"))
+        response = self.get("/page", **{"Accept-Language": "en"})
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertIn(b"<p>en</p>", self.read(response))
+
+    def test_rewritten_etag_gets_not_modified(self):
+        first = self.get("/page")
+        self.read(first)
+        etag = first["ETag"]
+        self.assertNotEqual(etag, '"v1"')
+        response = self.get("/page", **{"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["X-Cache"], "HIT")
+
+    def test_responses_fetched_with_cookies_are_not_shared(self):
+        bob = self.create_user("bob")
+        self.read(self.get("/login/alice"))
+        self.read(self.get("/login/bob", user=bob))
+        self.read(self.get("/whoami"))
+
+        response = self.get("/whoami", user=bob)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertIn(b"<p>sid=bob</p>", self.read(response))
+        response = self.get("/whoami")
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertIn(b"<p>sid=alice</p>", self.read(response))
+
+    def test_responses_fetched_without_cookies_are_shared(self):
+        self.read(self.get("/whoami"))
+        response = self.get("/whoami", user=self.create_user("bob"))
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertIn(b"<p>None</p>", self.read(response))
+
+
+class RewriteLinkTests(SimpleTestCase):
+    prefix = "http://testserver/vpn/site"
+
+    def rewrite(self, value, subpath="/dir/page.html"):
+        return rewrite_link(value, self.prefix, "https", "example.com", subpath)
+
+    def test_relative_links_are_resolved_against_the_page(self):
+        self.assertEqual(self.rewrite("/x"), f"{self.prefix}/x")
+        self.assertEqual(self.rewrite("rel"), f"{self.prefix}/dir/rel")
+        self.assertEqual(self.rewrite("../up"), f"{self.prefix}/up")
+
+    def test_links_to_the_website_host_go_through_the_proxy(self):
+        self.assertEqual(self.rewrite("https://example.com/abs"), f"{self.prefix}/abs")
+        self.assertEqual(self.rewrite("https://EXAMPLE.com:443/abs"), f"{self.prefix}/abs")
+        self.assertEqual(self.rewrite("https://example.com"), f"{self.prefix}/")
+        self.assertEqual(self.rewrite("//example.com/p"), f"{self.prefix}/p")
+
+    def test_links_to_other_hosts_are_left_alone(self):
+        for value in [
+            "https://static.example.com/a.css",
+            "https://notexample.com/",
+            "https://example.com.evil.org/",
+            "https://example.com:8443/admin",
+        ]:
+            with self.subTest(value):
+                self.assertEqual(self.rewrite(value), value)
+
+    def test_protocol_relative_links_get_the_page_scheme(self):
+        self.assertEqual(self.rewrite("//static.example.com/a.js"), "https://static.example.com/a.js")
+
+    def test_website_with_a_port(self):
+        rewritten = rewrite_link("http://127.0.0.1:8000/x", self.prefix, "http", "127.0.0.1:8000", "/")
+        self.assertEqual(rewritten, f"{self.prefix}/x")
+        other = rewrite_link("http://127.0.0.1:9000/x", self.prefix, "http", "127.0.0.1:8000", "/")
+        self.assertEqual(other, "http://127.0.0.1:9000/x")
+
+
+class HtmlRewriterTests(SimpleTestCase):
+    def rewrite(self, html, chunk_size=7):
+        rewriter = HtmlRewriter(LinkRewriter("http://testserver/vpn/site", "https://example.com/", "/dir/page.html"))
+        parts = [rewriter.feed(html[start:start + chunk_size]) for start in range(0, len(html), chunk_size)]
+        return "".join(parts) + rewriter.close()
+
+    def test_attributes_are_rewritten(self):
+        html = (
+            '<a href="/a">a</a><img src="//cdn.example.com/i.png" srcset="/s.png 2x">'
+            '<form action="https://example.com/f"></form><a href="https://other.org/">o</a>'
+        )
+        self.assertEqual(self.rewrite(html), (
+            '<a href="http://testserver/vpn/site/a">a</a>'
+            '<img src="https://cdn.example.com/i.png" srcset="http://testserver/vpn/site/s.png 2x">'
+            '<form action="http://testserver/vpn/site/f"></form><a href="https://other.org/">o</a>'
+        ))
+
+    def test_raw_text_is_left_alone(self):
+        html = '<script>var a = \'<a href="/x">\';</script><!-- <a href="/y"> -->'
+        self.assertEqual(self.rewrite(html), html)
+
+    def test_attributes_that_are_not_urls_are_left_alone(self):
+        html = (
+            '<a href="/a" title="Read more at https://example.com" data-id="/api/1">a</a>'
+            '<button value="/v">b</button>'
+        )
+        self.assertEqual(self.rewrite(html), html.replace('"/a"', '"http://testserver/vpn/site/a"'))
+
+    def test_http_links_of_an_https_website_are_left_alone(self):
+        html = '<a href="http://example.com/x">x</a>'
+        self.assertEqual(self.rewrite(html), html)
+
+    def test_http_website(self):
+        rewriter = HtmlRewriter(LinkRewriter("http://testserver/vpn/site", "http://example.com:8000/", "/"))
+        html = '<a href="http://example.com:8000/x">x</a><a href="http://example.com/y">y</a>'
+        self.assertEqual(rewriter.feed(html) + rewriter.close(), (
+            '<a href="http://testserver/vpn/site/x">x</a><a href="http://example.com/y">y</a>'
+        ))
+
+
+# Every engine must rewrite these pages to the same markup
+CORPUS = {
+    "links": """<!DOCTYPE html><html><head><title>Links</title></head><body>
+        <a href="/x?a=1&amp;b=2">query</a> <a href='rel/path'>relative</a> <a href=unquoted>bare</a>
+        <a href="https://example.com/abs">absolute</a> <a href="https://other.org/page">other site</a>
+        <a href="http://example.com/plain">plain http</a> <a href="#top">fragment</a>
+        <a href="mailto:user@example.com">mail</a> <a href="javascript:void(0)">script</a>
+        <A HREF="/UPPER">upper</A> <a href="  /spaced  ">spaced</a>
+        <a data-url="/data" title="https is mentioned">data attribute</a>
+        <a href="/caf&eacute;?q=ü">Café</a> <area href="/map" alt="">
+        </body></html>""",
+    "forms": """<html><body>
+        <form action="/submit" method=post><input name="q" value="/not-rewritten">
+        <input type=image src="/button.png" formaction="/alternative">
+        <button formaction="/button" value="/value">Send</button></form>
+        <form action="https://other.org/search"><button>Search</button></form>
+        </body></html>""",
+    "assets": """<html><head>
+        <link rel="stylesheet" href="/css/site.css" integrity="sha384-abc" crossorigin="anonymous">
+        <link rel="icon" href="favicon.ico"><script src="/js/app.js"></script>
+        </head><body background="/bg.png">
+        <img src="/img/a.jpg" srcset="/img/a.jpg 1x, /img/a@2x.jpg 2x" alt="">
+        <img src="data:image/gif;base64,R0lGODlhAQABAAAAACw=" alt="">
+        <picture><source srcset="/img/b.webp" type="image/webp"><img src="/img/b.jpg" alt=""></picture>
+        <video poster="/poster.jpg" controls><source src="/movie.mp4"><track src="/subs.vtt"></video>
+        <audio src="/sound.mp3"></audio><iframe src="/frame.html"></iframe>
+        <object data="/movie.swf"><embed src="/embed.swf"></object>
+        <table background="/table.png"><tr><td background="/cell.png">cell</td></tr></table>
+        </body></html>""",
+    "css": """<html><head><style>
+        @import "print.css";
+        @import url(/base.css);
+        .a { background: url('/img/a.png') }
+        .b { background: url("https://example.com/b.png") }
+        .c { background: url(data:image/png;base64,AAAA) }
+        </style></head><body>
+        <div style="background-image: url(/img/div.png); color: red">styled</div>
+        <p style="color: blue">no urls</p>
+        </body></html>""",
+    "refresh": """<html><head>
+        <meta http-equiv="Refresh" content="5; url=/next">
+        <meta name="description" content="/not-a-link">
+        </head><body></body></html>""",
+    "refresh_quoted": """<html><head>
+        <meta http-equiv=refresh content="0;URL='https://example.com/moved'">
+        </head><body></body></html>""",
+    "raw_text": """<html><head><title>a <b href="/x"> title &amp; more</title>
+        <script>var link = '<a href="/not">'; if (a < b && c > d) {}</script>
+        </head><body><!-- <a href="/comment"> -->
+        <p>1 &lt; 2 &amp;&amp; 3 &gt; 2</p><textarea><a href="/not"></textarea></body></html>""",
+    "no_head": """<p>Fragment with <a href="/link">a link</a> and <img src="pic.png" alt=""></p>""",
+    "empty": "",
+}
+
+# HTML the engines may add or drop without changing the page
+IMPLIED_TAGS = {"html", "head", "body", "tbody"}
+
+
+class Normalizer(HTMLParser):
+    """Start tags, text and comments of a page, ignoring serialization details."""
+
+    # Parsed like browsers do: markup in <title> and <textarea> is text
+    CDATA_CONTENT_ELEMENTS = ("script", "style", "title", "textarea")
+    RCDATA_ELEMENTS = ("title", "textarea")
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in IMPLIED_TAGS:
+            self.events.append(("tag", tag, tuple(sorted((name, value or "") for name, value in attrs))))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_data(self, data):
+        if self.cdata_elem in self.RCDATA_ELEMENTS:
+            data = unescape(data)
+        data = " ".join(data.split())
+        if data:
+            self.events.append(("text", data))
+
+    def handle_comment(self, data):
+        self.events.append(("comment", data))
+
+    def handle_decl(self, decl):
+        self.events.append(("decl", decl.lower()))
+
+
+def normalize(html):
+    parser = Normalizer()
+    parser.feed(html)
+    parser.close()
+    return parser.events
+
+
+class LinkList(list):
+    """Links an engine reports to the prefetcher, in document order; attributes without a value are left out."""
+
+    def add(self, tag, attrs):
+        self.append((tag, tuple(sorted((name, value) for name, value in attrs.items() if value))))
+
+    def close(self):
+        self.append("close")
+
+
+class HtmlEngineTests(SimpleTestCase):
+    """Every installed HTML engine must rewrite the corpus like the streaming one."""
+
+    def rewrite(self, engine, html, chunk_size=CHUNK_SIZE, links=None):
+        link_rewriter = LinkRewriter("http://testserver/vpn/site", "https://example.com/", "/dir/page.html")
+        rewriter = engine(link_rewriter, base_href="https://example.com/dir/page.html", links=links)
+        parts = [rewriter.feed(html[start:start + chunk_size]) for start in range(0, len(html), chunk_size)]
+        return "".join(parts) + rewriter.close()
+
+    def assertEnginesAgree(self, name, html):
+        stream = get_html_engine("stream")
+        expected_links = LinkList()
+        expected = normalize(self.rewrite(stream, html, links=expected_links))
+        for engine_name in available_engines():
+            with self.subTest(page=name, engine=engine_name):
+                links = LinkList()
+                output = self.rewrite(get_html_engine(engine_name), html, links=links)
+                self.assertEqual(normalize(output), expected)
+                self.assertEqual(links, expected_links)
+
+    def test_corpus(self):
+        for name, html in CORPUS.items():
+            self.assertEnginesAgree(name, html)
+
+    def test_benchmark_pages(self):
+        for name, page in build_corpus().items():
+            if page.get("content_type", "text/html").startswith("text/html"):
+                self.assertEnginesAgree(name, page["body"].decode())
+
+    def test_stream_output_does_not_depend_on_chunk_size(self):
+        stream = get_html_engine("stream")
+        for name, html in CORPUS.items():
+            with self.subTest(page=name):
+                self.assertEqual(self.rewrite(stream, html, chunk_size=7), self.rewrite(stream, html))
+
+
+class RedirectTests(ProxyTestCase):
+    def rewrite(self, location, base_url="https://example.com"):
+        headers = {"Location": location}
+        request = RequestFactory().get("/vpn/site/a")
+        rewrite_redirect_headers(request, headers, Website(name="site"), base_url, f"{base_url}/a", "/a")
+        return headers["Location"]
+
+    def test_same_site_redirect_goes_through_the_proxy(self):
+        self.assertEqual(self.rewrite("/b?x=1#top"), "http://testserver/vpn/site/b%3Fx=1#top")
+        self.assertEqual(self.rewrite("https://example.com/b"), "http://testserver/vpn/site/b")
+        self.assertEqual(self.rewrite("https://example.com/b", "http://example.com"), "http://testserver/vpn/site/b")
+
+    def test_redirect_leaving_the_website_is_left_alone(self):
+        for location in ["http://example.com/a", "https://www.example.com/a", "https://example.com:8443/a"]:
+            with self.subTest(location):
+                self.assertEqual(self.rewrite(location), location)
+
+    def test_scheme_upgrade_is_followed(self):
+        def response(location, status=301):
+            return mock.Mock(status_code=status, headers={"Location": location})
+
+        upgrade = get_scheme_upgrade("http://example.com/a?b=1", "GET", response("https://example.com/a?b=1"))
+        self.assertEqual(upgrade, "https://example.com/a?b=1")
+        self.assertIsNone(get_scheme_upgrade("http://example.com/a", "GET", response("https://example.com/b")))
+        self.assertIsNone(get_scheme_upgrade("http://example.com/a", "POST", response("https://example.com/a")))
+        self.assertIsNone(get_scheme_upgrade("http://example.com/a", "GET", response("https://example.com/a", 200)))
+        self.assertIsNone(get_scheme_upgrade("https://example.com/a", "GET", response("http://example.com/a")))
+
+    def test_call_upstream_follows_the_upgrade(self):
+        request = RequestFactory().get("/vpn/site/a")
+        request.stage_timer = StageTimer()
+        request.cookie_scope = ""
+        responses = {
+            "http://example.com/a": mock.Mock(status_code=301, headers={"Location": "https://example.com/a"}),
+            "https://example.com/a": mock.Mock(status_code=200, headers={}),
+        }
+        response = call_upstream(request, Website(pk=1, name="site"), "http://example.com/a", responses.get)
+
+        self.assertIs(response, responses["https://example.com/a"])
+        responses["http://example.com/a"].close.assert_called_once()
+
+    def test_proxied_redirect(self):
+        response = self.get("/redirect/page")
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "http://testserver/vpn/site/page")
+
+
+class EncodingTests(ProxyTestCase):
+    def test_compressed_body_is_passed_to_a_client_accepting_it(self):
+        response = self.get("/script", **{"Accept-Encoding": "gzip, br"})
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", vary(response))
+        self.assertEqual(gzip.decompress(self.read(response)), b"var a = 1;" * 100)
+
+    def test_compressed_body_is_decoded_for_a_client_not_accepting_it(self):
+        for accept_encoding in ["identity", "gzip;q=0", None]:
+            with self.subTest(accept_encoding):
+                headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+                response = self.get("/script", **headers)
+
+                self.assertFalse(response.has_header("Content-Encoding"))
+                self.assertFalse(response.has_header("Content-Length"))
+                self.assertIn("Accept-Encoding", vary(response))
+                self.assertEqual(self.read(response), b"var a = 1;" * 100)
+
+    def test_rewritten_page_is_compressed_for_the_client(self):
+        response = self.get("/page", **{"Accept-Encoding": "gzip"})
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertLessEqual({"Accept-Language", "Accept-Encoding"}, vary(response))
+        self.assertIn(b"<p>uk</p>", gzip.decompress(self.read(response)))
+
+
+class EncodedStreamTests(SimpleTestCase):
+    def test_compressed_chunk_is_decoded_piece_by_piece(self):
+        body = bytes(range(256)) * (CHUNK_SIZE // 64)
+        stream = EncodedStream(IdentityStream(), create_decoder("gzip"), IdentityCoder())
+
+        pieces = list(rewrite_stream([gzip.compress(body)], stream))
+
+        self.assertGreater(len(pieces), 1)
+        self.assertLessEqual(max(map(len, pieces)), CHUNK_SIZE)
+        self.assertEqual(b"".join(pieces), body)
+
+
+class SendTests(ProxyTestCase):
+    def send(self, method, path, data, **extra):
+        self.client.force_login(self.user)
+        return self.client.generic(method, f"/vpn/site{path}", data, content_type="text/plain", **extra)
+
+    def test_body_is_sent_upstream(self):
+        response = self.send("POST", "/echo", b"name=value")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<p>POST name=value</p>", self.read(response))
+        self.assertEqual(self.upstream.requests[-1][3], b"name=value")
+
+    def test_chunked_body_is_sent_upstream(self):
+        response = self.send(
+            "PUT", "/echo", b"", HTTP_TRANSFER_ENCODING="chunked",
+            CONTENT_LENGTH="", **{"wsgi.input": io.BytesIO(b"chunked body"), "wsgi.input_terminated": True},
+        )
+
+        self.assertIn(b"<p>PUT chunked body</p>", self.read(response))
+        self.assertEqual(self.upstream.requests[-1][2]["Transfer-Encoding"], "chunked")
+
+    def test_error_response_is_proxied(self):
+        response = self.send("POST", "/echo/422", b"bad")
+
+        self.assertEqual(response.status_code, 422)
+        body = self.read(response)
+        self.assertIn(b"<p>POST bad</p>", body)
+        self.assertIn(b'<base href="', body)
+
+    def test_successful_request_invalidates_the_cache(self):
+        self.read(self.get("/page"))
+        self.read(self.send("POST", "/page", b""))
+        response = self.get("/page")
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.read(response)
+
+    def test_options_is_sent_with_the_session(self):
+        self.read(self.get("/login/alice"))
+        self.read(self.get("/page"))
+        response = self.send("OPTIONS", "/echo", b"")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<p>OPTIONS </p>", self.read(response))
+        self.assertEqual(self.upstream.requests[-1][2]["Cookie"], "sid=alice")
+        self.assertEqual(self.get("/page")["X-Cache"], "HIT")
+
+
+class RangeTests(ProxyTestCase):
+    def test_partial_content_is_passed_through(self):
+        response = self.get("/video", Range="bytes=2-5")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(self.read(response), b"2345")
+        self.assertEqual(self.upstream.requests[-1][2]["Range"], "bytes=2-5")
+
+    def test_ranged_requests_skip_the_cache(self):
+        self.read(self.get("/video"))
+        self.read(self.get("/video", Range="bytes=0-1"))
+        response = self.get("/video")
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual(self.read(response), b"0123456789")
+        self.assertEqual([headers.get("Range") for _, _, headers, _ in self.upstream.requests], [None, "bytes=0-1"])
+
+    def test_head(self):
+        self.client.force_login(self.user)
+        response = self.client.head("/vpn/site/video")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(self.read(response), b"")
+        self.assertEqual(self.upstream.requests[-1][0], "HEAD")
+
+
+class AsyncProxyTests(ProxyTestCase):
+    """The async view, served when VPN_ASYNC_PROXY is on."""
+
+    def setUp(self):
+        super().setUp()
+        clients = SessionPool(100, 600, 200, factory=create_async_client, close=close_async_client)
+        patcher = mock.patch("websites.views.async_clients", clients)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def request(self, method, path, data=None, **headers):
+        """Proxied request through async_vpn_website; the response is returned with its body read."""
+        headers = {"Accept": "text/html", "Accept-Language": "uk", **headers}
+        factory = AsyncRequestFactory()
+        if data is None:
+            request = factory.generic(method, f"/vpn/site{path}", headers=headers)
+        else:
+            request = factory.generic(method, f"/vpn/site{path}", data, content_type="text/plain", headers=headers)
+        request.user = self.user
+
+        async def auser():
+            return self.user
+
+        request.auser = auser
+        response = await async_vpn_website(request, "site", path.lstrip("/"))
+        if response.streaming:
+            response.body = b"".join([chunk async for chunk in response.streaming_content])
+        else:
+            response.body = response.content
+        return response
+
+    async def test_fresh_response_is_served_from_the_cache(self):
+        first = await self.request("GET", "/page")
+        second = await self.request("GET", "/page")
+
+        self.assertEqual(first["X-Cache"], "MISS")
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertIn(b"<p>uk</p>", second.body)
+        self.assertEqual(self.upstream_paths(), ["/page"])
+
+    async def test_proxied_redirect(self):
+        response = await self.request("GET", "/redirect/page")
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "http://testserver/vpn/site/page")
+
+    async def test_partial_content_is_passed_through(self):
+        response = await self.request("GET", "/video", Range="bytes=2-5")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(response.body, b"2345")
+
+    async def test_head(self):
+        response = await self.request("HEAD", "/video")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response.body, b"")
+        self.assertEqual(self.upstream.requests[-1][0], "HEAD")
+
+    async def test_body_is_sent_upstream(self):
+        response = await self.request("POST", "/echo", b"name=value")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<p>POST name=value</p>", response.body)
+        self.assertEqual(self.upstream.requests[-1][3], b"name=value")
+
+    async def test_options_is_sent_upstream(self):
+        response = await self.request("OPTIONS", "/echo")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<p>OPTIONS </p>", response.body)
+
+    def test_clients_closed_outside_the_event_loop(self):
+        client = create_async_client(self.upstream_url)
+        close_async_client(client)
+
+        self.assertTrue(client.is_closed)
+
+
+def transcode_now(data, image_format):
+    future = Future()
+    future.set_result(transcode(data, image_format, settings.VPN_DATA_SAVER_QUALITY, 1280))
+    return future
+
+
+@skipIf(Image is None, "data saver needs Pillow")
+@mock.patch.object(image_saver, "submit", transcode_now)
+class DataSaverTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saver = self.create_user("carol")
+        Website.objects.filter(user=self.saver).update(data_saver=True)
+
+    def test_image_is_transcoded(self):
+        response = self.get("/photo", user=self.saver)
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertLess(len(self.read(response)), len(photo.body))
+
+    def test_image_source_is_cached(self):
+        self.read(self.get("/photo", user=self.saver))
+        response = self.get("/photo", user=self.saver)
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertLess(len(self.read(response)), len(photo.body))
+        self.assertEqual(self.upstream_paths(), ["/photo"])
+
+    def test_image_cached_without_data_saver_is_transcoded(self):
+        self.assertEqual(self.read(self.get("/photo")), photo.body)
+        response = self.get("/photo", user=self.saver)
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertLess(len(self.read(response)), len(photo.body))
+        self.assertEqual(self.upstream_paths(), ["/photo"])
+
+
+class HealthTests(ProxyTestCase):
+    def test_missing_page_is_remembered(self):
+        self.read(self.get("/private"))
+        response = self.get("/private")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.content.decode(), "Сторінку не знайдено")
+        self.assertEqual(self.upstream_paths(), ["/private"])
+
+    def test_missing_page_is_not_shared_with_users_with_cookies(self):
+        self.read(self.get("/private"))
+        bob = self.create_user("bob")
+        self.read(self.get("/login/bob", user=bob))
+        response = self.get("/private", user=bob)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<p>private</p>", self.read(response))
+
+
+class CookieStoreTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.store = DjangoCookieStore(timeout=60)
+        self.worker(SessionPool(100, 600, 200, cookie_store=self.store))
+
+    def worker(self, pool):
+        """Route the next requests through ``pool``, as if another worker served them."""
+        patcher = mock.patch("websites.views.sessions", pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pool
+
+    def test_login_reaches_other_workers(self):
+        self.read(self.get("/login/alice"))
+        self.worker(SessionPool(100, 600, 200, cookie_store=self.store))
+
+        self.assertIn(b"<p>sid=alice</p>", self.read(self.get("/whoami")))
+
+    def test_newer_cookies_replace_the_session_jar(self):
+        first = self.worker(SessionPool(100, 600, 200, cookie_store=self.store))
+        self.read(self.get("/login/alice"))
+        self.worker(SessionPool(100, 600, 200, cookie_store=self.store))
+        self.read(self.get("/login/again"))
+        self.worker(first)
+
+        self.assertIn(b"<p>sid=again</p>", self.read(self.get("/whoami")))
+
+    def test_login_outlives_an_idle_session(self):
+        # Every session is closed as soon as it was used
+        self.worker(SessionPool(100, 0, 200, cookie_store=self.store))
+        self.read(self.get("/login/alice"))
+
+        self.assertIn(b"<p>sid=alice</p>", self.read(self.get("/whoami")))
+
+    def test_discarded_sessions_forget_their_cookies(self):
+        pool = self.worker(SessionPool(100, 600, 200, cookie_store=self.store))
+        self.read(self.get("/login/alice"))
+        pool.discard(user_id=self.user.pk)
+
+        self.assertIn(b"<p>None</p>", self.read(self.get("/whoami")))
+
+
+class ForwardedHeadersTests(SimpleTestCase):
+    def headers(self, **headers):
+        request = RequestFactory().get("/vpn/site/page", headers=headers)
+        return get_forwarded_headers(request, "https://example.com", "site")
+
+    def test_referer_on_the_proxy_points_at_the_upstream_page(self):
+        headers = self.headers(Referer="http://testserver/vpn/site/docs/a%20b?q=1")
+
+        self.assertEqual(headers["Referer"], "https://example.com/docs/a b")
+
+    def test_referer_of_the_website_root(self):
+        self.assertEqual(self.headers(Referer="http://testserver/vpn/site/")["Referer"], "https://example.com/")
+
+    def test_referer_off_the_proxy_is_dropped(self):
+        for referer in ["https://elsewhere.com/vpn/site/page", "http://testserver/vpn/other/page"]:
+            with self.subTest(referer=referer):
+                self.assertNotIn("Referer", self.headers(Referer=referer))
+
+    def test_origin_is_the_upstream_site(self):
+        self.assertEqual(self.headers(Origin="http://testserver")["Origin"], "https://example.com")
+        self.assertNotIn("Origin", self.headers())
+
+    def test_only_listed_headers_are_forwarded(self):
+        headers = self.headers(
+            Accept="text/html", Cookie="sessionid=1", Authorization="Basic x", **{"User-Agent": "me"}
+        )
+
+        self.assertEqual(headers, {"Accept": "text/html"})
+
+
+class WebsiteFormTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("alice", password="secret")
+        self.website = Website.objects.create(user=self.user, name="Site", url="https://example.com/")
+
+    def form(self, name, instance=None):
+        instance = instance or Website(user=self.user)
+        return WebsiteCreateUpdateForm({"name": name, "url": "https://example.org/"}, instance=instance)
+
+    def test_name_is_unique_per_user_whatever_its_case(self):
+        form = self.form("SITE")
+
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors["name"], ["У вас вже є сайт з такою назвою."])
+
+    def test_website_keeps_its_own_name(self):
+        self.assertTrue(self.form("site", instance=self.website).is_valid())
+
+    def test_other_users_may_use_the_name(self):
+        bob = get_user_model().objects.create_user("bob", password="secret")
+
+        self.assertTrue(self.form("site", instance=Website(user=bob)).is_valid())
+
+
+class WebsiteCacheTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        # The views invalidate the cache they imported, find_website reads the module's
+        website_cache = WebsiteCache(60)
+        for target in ["websites.utils.website_cache", "websites.views.website_cache"]:
+            patcher = mock.patch(target, website_cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.website = Website.objects.get(user=self.user)
+
+    def test_renamed_website_is_not_found_by_its_old_name(self):
+        self.read(self.get("/page"))
+        self.client.post(
+            reverse("websites:update", args=[self.website.pk]), {"name": "renamed", "url": self.website.url}
+        )
+
+        self.assertEqual(self.get("/page").status_code, 404)
+        response = self.client.get("/vpn/renamed/page")
+        self.assertEqual(response.status_code, 200)
+        self.read(response)
+
+    def test_deleted_website_is_not_found(self):
+        self.read(self.get("/page"))
+        self.client.post(reverse("websites:delete", args=[self.website.pk]))
+
+        self.assertEqual(self.get("/page").status_code, 404)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = WebsiteCache(60, max_size=2)
+        cache.set(1, "a", "website a")
+        cache.set(1, "b", "website b")
+        cache.get(1, "A")
+        cache.set(1, "c", "website c")
+
+        self.assertEqual(cache.get(1, "a"), (True, "website a"))
+        self.assertEqual(cache.get(1, "b"), (False, None))
+        self.assertEqual(cache.get(1, "c"), (True, "website c"))
+
+
+class PrefetchTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("websites.prefetch.sessions", SessionPool(100, 600, 200))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.prefetcher = Prefetcher(1, 1, 100, 0, 3, 20)
+        self.website = Website.objects.get(user=self.user)
+
+    def prefetch(self, path):
+        headers = {"Accept": "text/html", "Accept-Language": "uk"}
+        return self.prefetcher.fetch(self.website.pk, f"{self.upstream_url}/", f"{self.upstream_url}{path}", headers)
+
+    def test_prefetched_page_is_served_to_users_without_cookies(self):
+        self.assertEqual(self.prefetch("/page")[0], "stored")
+        response = self.get("/page")
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertIn(b"<p>uk</p>", self.read(response))
+        self.assertEqual(self.upstream_paths(), ["/page"])
+
+    def test_prefetched_page_is_not_served_to_users_with_cookies(self):
+        self.read(self.get("/login/alice"))
+        self.prefetch("/page")
+        response = self.get("/page")
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.read(response)
+
+    def test_cached_page_is_not_fetched_again(self):
+        self.read(self.get("/page"))
+
+        self.assertEqual(self.prefetch("/page"), ("cached", 0))
+        self.assertEqual(self.prefetch("/page"), ("cached", 0))
+        self.assertEqual(self.upstream_paths(), ["/page"])
+
+    def test_missing_page_is_not_remembered(self):
+        self.assertEqual(self.prefetch("/private")[0], "not_storable")
+        self.read(self.get("/private"))
+
+        self.assertEqual(self.upstream_paths(), ["/private", "/private"])
+
+
+def cookie(name, expires):
+    return Cookie(
+        0, name, "value", None, False, "example.com", False, False, "/", False, False, expires, False, None, None, {}
+    )
+
+
+class SessionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.closed = []
+        self.pool = SessionPool(2, 600, 200, close=self.closed.append)
+        self.addCleanup(self.pool.discard)
+
+    def test_session_is_reused(self):
+        session = self.pool.get(1, 1, "https://example.com/")
+
+        self.assertIs(self.pool.get(1, 1, "https://example.com/"), session)
+        self.assertIsNot(self.pool.get(2, 1, "https://example.com/"), session)
+
+    @mock.patch("websites.sessions.time.monotonic")
+    def test_idle_session_is_closed(self, monotonic):
+        monotonic.return_value = 1000.0
+        idle = self.pool.get(1, 1, "https://example.com/")
+        monotonic.return_value = 1300.0
+        used = self.pool.get(2, 1, "https://example.com/")
+        monotonic.return_value = 1601.0
+        self.pool.get(2, 1, "https://example.com/")
+
+        self.assertEqual(self.closed, [idle])
+        self.assertIs(self.pool.get(2, 1, "https://example.com/"), used)
+        self.assertIsNot(self.pool.get(1, 1, "https://example.com/"), idle)
+
+    def test_least_recently_used_session_is_closed(self):
+        first = self.pool.get(1, 1, "https://example.com/")
+        second = self.pool.get(2, 1, "https://example.com/")
+        self.pool.get(1, 1, "https://example.com/")
+        self.pool.get(3, 1, "https://example.com/")
+
+        self.assertEqual(self.closed, [second])
+        self.assertIs(self.pool.get(1, 1, "https://example.com/"), first)
+
+    def test_jar_is_pruned_when_the_session_is_reused(self):
+        pool = SessionPool(2, 600, 2)
+        self.addCleanup(pool.discard)
+        session = pool.get(1, 1, "https://example.com/")
+        for name, expires in [("old", 1), ("soon", time.time() + 60), ("late", time.time() + 3600), ("session", None)]:
+            session.cookies.set_cookie(cookie(name, expires))
+        pool.get(1, 1, "https://example.com/")
+
+        self.assertEqual(sorted(cookie.name for cookie in session.cookies), ["late", "session"])
+
+    def test_jar_within_the_limit_only_loses_expired_cookies(self):
+        jar = create_session("https://example.com/").cookies
+        jar.set_cookie(cookie("expired", 1))
+        jar.set_cookie(cookie("kept", time.time() + 60))
+        prune_cookies(jar, 5)
+
+        self.assertEqual([cookie.name for cookie in jar], ["kept"])
+
+
+@mock.patch("websites.health.time.monotonic", return_value=1000.0)
+class CircuitBreakerTests(SimpleTestCase):
+    def open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure("example.com")
+        self.assertEqual(breaker.allow("example.com"), (True, 0))
+        breaker.record_failure("example.com")
+        return breaker
+
+    def test_opens_after_the_threshold(self, now):
+        breaker = self.open_breaker()
+
+        self.assertEqual(breaker.allow("example.com"), (False, 30))
+        self.assertEqual(breaker.allow("other.org"), (True, 0))
+
+    def test_half_open_lets_one_probe_through(self, now):
+        breaker = self.open_breaker()
+        now.return_value += 30
+
+        self.assertEqual(breaker.allow("example.com"), (True, 0))
+        self.assertFalse(breaker.allow("example.com")[0])
+
+    def test_failed_probe_reopens(self, now):
+        breaker = self.open_breaker()
+        now.return_value += 30
+        breaker.allow("example.com")
+        breaker.record_failure("example.com")
+
+        self.assertEqual(breaker.allow("example.com"), (False, 30))
+
+    def test_successful_probe_closes(self, now):
+        breaker = self.open_breaker()
+        now.return_value += 30
+        breaker.allow("example.com")
+        breaker.record_success("example.com")
+
+        self.assertEqual([breaker.allow("example.com") for _ in range(3)], [(True, 0)] * 3)
+
+
+class MetricsTests(ProxyTestCase):
+    def test_website_named_metrics_is_proxied(self):
+        Website.objects.create(user=self.user, name="metrics", url=f"{self.upstream_url}/whoami/")
+        self.client.force_login(self.user)
+        response = self.client.get("/vpn/metrics/", headers={"Accept": "text/html"})
+
+        self.assertEqual(response.status_code, 200)
+        self.read(response)
+        self.assertEqual(self.upstream_paths(), ["/whoami/"])
+
+    @override_settings(VPN_METRICS_TOKEN="secret")
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+        response = self.client.get("/metrics/", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+
+
+@mock.patch("websites.limits.time.time", return_value=1000.0)
+class TokenBucketTests(SimpleTestCase):
+    def bucket(self):
+        return TokenBucket(MemoryLimitStore(), "requests:user:1", rate=10, capacity=20)
+
+    def test_burst_up_to_the_capacity(self, now):
+        bucket = self.bucket()
+
+        self.assertEqual([bucket.take(1) for _ in range(20)], [0] * 20)
+        self.assertAlmostEqual(bucket.take(1), 0.1)
+
+    def test_refused_request_takes_nothing(self, now):
+        bucket = self.bucket()
+        bucket.take(20)
+
+        self.assertAlmostEqual(bucket.take(5), 0.5)
+        now.return_value += 0.5
+        self.assertEqual(bucket.take(5), 0)
+
+    def test_reserved_tokens_are_owed(self, now):
+        bucket = self.bucket()
+        bucket.take(20)
+
+        self.assertAlmostEqual(bucket.take(10, reserve=True), 1.0)
+        self.assertAlmostEqual(bucket.take(10, reserve=True), 2.0)
+
+    def test_idle_bucket_holds_at_most_its_capacity(self, now):
+        bucket = self.bucket()
+        bucket.take(1)
+        now.return_value += 3600
+
+        self.assertEqual(bucket.take(20), 0)
+        self.assertAlmostEqual(bucket.take(1), 0.1)
+
+    async def test_async_take(self, now):
+        bucket = self.bucket()
+
+        self.assertEqual(await bucket.atake(20), 0)
+        self.assertAlmostEqual(await bucket.atake(5), 0.5)
+        self.assertAlmostEqual(await bucket.atake(10, reserve=True), 1.0)
+
+    def test_retry_after_is_at_least_a_second(self, now):
+        for error in [LimitExceeded(429, "", 0.1), UpstreamError(503, "", 0.1)]:
+            with self.subTest(error=error):
+                self.assertEqual(error.response()["Retry-After"], "1")
+
+
+class LimitStoreTests(SimpleTestCase):
+    def test_local_memory_cache_is_not_shared(self):
+        self.assertFalse(MemoryLimitStore().shared)
+        self.assertFalse(DjangoLimitStore().shared)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                                           "LOCATION": "/tmp/vpn-limits"}})
+    def test_shared_cache(self):
+        self.assertTrue(DjangoLimitStore().shared)
+
+    @override_settings(VPN_USER_BYTES_PER_SECOND=10, VPN_WEBSITE_BYTES_PER_SECOND=0)
+    @mock.patch("websites.limits.limit_store", DjangoLimitStore())
+    @mock.patch.object(DjangoLimitStore, "incr", side_effect=AssertionError("blocking cache call"))
+    async def test_async_throttle_uses_the_async_cache_api(self, incr):
+        async def content():
+            yield b"12345"
+            yield b"67890"
+
+        chunks = [chunk async for chunk in athrottle(content(), RequestLimits(1, 1))]
+
+        self.assertEqual(chunks, [b"12345", b"67890"])
+
+    @mock.patch("websites.management.commands.serve.ProxyServer.run")
+    @mock.patch("websites.management.commands.serve.limit_store", MemoryLimitStore())
+    def test_serve_warns_about_per_process_limits(self, run):
+        for workers, warned in [(3, True), (1, False)]:
+            with self.subTest(workers=workers):
+                stdout, stderr = io.StringIO(), io.StringIO()
+                call_command("serve", workers=workers, stdout=stdout, stderr=stderr)
+                self.assertEqual("per process" in stderr.getvalue(), warned)
+
+
+@mock.patch.object(TrafficCounter, "_start")
+class TrafficCounterTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user("alice", password="secret")
+        self.website = Website.objects.create(user=user, name="site", url="https://example.com/", transition_count=5)
+        self.counter = TrafficCounter(60)
+
+    def test_flush_adds_the_buffered_traffic(self, start):
+        self.counter.add(self.website.pk, transitions=1, bytes_in=10, bytes_out=100, bytes_saved=7, latency=0.5)
+        self.counter.add(self.website.pk, transitions=1, bytes_out=50, cache_hit=True, latency=0.25)
+        self.counter.flush()
+
+        self.website.refresh_from_db()
+        self.assertEqual(
+            (self.website.transition_count, self.website.bytes_count, self.website.bytes_saved), (7, 160, 7)
+        )
+        rollup = TrafficRollup.objects.get(website=self.website)
+        self.assertEqual((rollup.requests, rollup.bytes_out, rollup.cache_hits), (2, 150, 1))
+        self.assertEqual(rollup.latency_sum, 0.75)
+
+    def test_failed_flush_keeps_the_counts(self, start):
+        self.counter.add(self.website.pk, transitions=1, bytes_out=100)
+        with mock.patch.object(TrafficRollup.objects, "bulk_create", side_effect=DatabaseError):
+            with self.assertLogs("websites.traffic", "ERROR"):
+                self.counter.flush()
+        self.assertFalse(TrafficRollup.objects.exists())
+
+        self.counter.add(self.website.pk, transitions=1, bytes_out=50)
+        self.counter.flush()
+
+        self.website.refresh_from_db()
+        self.assertEqual((self.website.transition_count, self.website.bytes_count), (7, 150))
+        self.assertEqual(TrafficRollup.objects.get(website=self.website).requests, 2)
+
+
+class CompactTrafficTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user("alice", password="secret")
+        self.website = Website.objects.create(user=user, name="site", url="https://example.com/")
+        self.now = timezone.now()
+
+    def rollup(self, period_start, requests, period=TrafficRollup.HOUR):
+        TrafficRollup.objects.create(
+            website=self.website, period=period, period_start=period_start, requests=requests, bytes_out=requests * 10
+        )
+
+    def rows(self):
+        return list(TrafficRollup.objects.order_by("period_start").values_list("period", "period_start", "requests"))
+
+    def compact(self):
+        call_command("compact_traffic", hourly_days=7, stdout=io.StringIO())
+
+    def test_rows_of_the_same_hour_are_merged(self):
+        hour = self.now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        current_hour = hour + timedelta(hours=2)
+        for requests in [1, 2, 3]:
+            self.rollup(hour, requests)
+        self.rollup(current_hour, 1)
+        self.rollup(current_hour, 1)
+        self.compact()
+
+        self.assertEqual(self.rows(), [
+            ("hour", hour, 6), ("hour", current_hour, 1), ("hour", current_hour, 1),
+        ])
+        self.assertEqual(TrafficRollup.objects.get(period_start=hour).bytes_out, 60)
+
+    def test_old_hours_are_rolled_into_their_day(self):
+        day = (self.now - timedelta(days=10)).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.rollup(day + timedelta(hours=1), 1)
+        self.rollup(day + timedelta(hours=5), 2)
+        self.rollup(day + timedelta(hours=5), 4)
+        self.rollup(day - timedelta(days=1), 8, TrafficRollup.DAY)
+        self.compact()
+
+        self.assertEqual(self.rows(), [("day", day - timedelta(days=1), 8), ("day", day, 7)])
+
+    def test_second_run_changes_nothing(self):
+        hour = self.now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        for period_start in [hour, hour, hour - timedelta(days=10), hour - timedelta(days=10, hours=1)]:
+            self.rollup(period_start, 1)
+        self.compact()
+        rows = self.rows()
+        stdout = io.StringIO()
+        call_command("compact_traffic", hourly_days=7, stdout=stdout)
+
+        self.assertEqual(self.rows(), rows)
+        self.assertIn("Merged 0 hourly rows, rolled up 0 daily rows, deleted 0 expired rows", stdout.getvalue())
@@ -0,0 +1,134 @@
+import atexit
+import logging
+import threading
+
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from websites.models import PageVisit, TrafficRollup, Website
+
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_PAGES = 10000
+URL_MAX_LENGTH = PageVisit._meta.get_field("url").max_length
+
+FIELDS = ["requests", "transitions", "bytes_in", "bytes_out", "bytes_saved", "cache_hits", "errors", "latency_sum"]
+
+
+class TrafficCounter:
+    """
+    Per-process buffer for website traffic.
+
+    The request path only touches an in-memory dict keyed by website and
+    hour; a daemon thread flushes the accumulated deltas every
+    VPN_TRAFFIC_FLUSH_INTERVAL seconds as appended TrafficRollup rows plus
+    F() updates of the lifetime counters on Website, so no proxied request
+    writes to the database and concurrent increments are never lost. Page
+    visits of websites with prefetching on are buffered the same way.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = defaultdict(lambda: [0] * len(FIELDS))
+        self._pages = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, website_id, transitions=0, bytes_in=0, bytes_out=0, bytes_saved=0, cache_hit=False, error=False,
+            latency=0.0):
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self._add(
+            website_id, hour, [1, transitions, bytes_in, bytes_out, bytes_saved, int(cache_hit), int(error), latency]
+        )
+
+    def _add(self, website_id, hour, values):
+        with self._lock:
+            counts = self._pending[website_id, hour]
+            for index, value in enumerate(values):
+                counts[index] += value
+            if self._thread is None:
+                self._start()
+
+    def add_page(self, website_id, url):
+        if len(url) > URL_MAX_LENGTH:
+            return
+        with self._lock:
+            if len(self._pages) < MAX_PENDING_PAGES or (website_id, url) in self._pages:
+                self._pages[website_id, url] += 1
+            if self._thread is None:
+                self._start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0] * len(FIELDS))
+            pages, self._pages = self._pages, Counter()
+        if not pending and not pages:
+            return
+
+        lifetime = defaultdict(lambda: [0, 0, 0])
+        for (website_id, _), values in pending.items():
+            counts = dict(zip(FIELDS, values))
+            lifetime[website_id][0] += counts["transitions"]
+            lifetime[website_id][1] += counts["bytes_in"] + counts["bytes_out"]
+            lifetime[website_id][2] += counts["bytes_saved"]
+
+        try:
+            with transaction.atomic():
+                TrafficRollup.objects.bulk_create([
+                    TrafficRollup(website_id=website_id, period=TrafficRollup.HOUR, period_start=hour,
+                                  **dict(zip(FIELDS, values)))
+                    for (website_id, hour), values in pending.items()
+                ])
+                for website_id, (transitions, bytes_count, bytes_saved) in lifetime.items():
+                    Website.objects.filter(pk=website_id).update(
+                        transition_count=F("transition_count") + transitions,
+                        bytes_count=F("bytes_count") + bytes_count,
+                        bytes_saved=F("bytes_saved") + bytes_saved,
+                    )
+                self._flush_pages(pages)
+        except Exception:
+            website_ids = set(lifetime) | {website_id for website_id, _ in pages}
+            logger.exception("Failed to flush traffic for %s websites", len(website_ids))
+            # Rows of websites deleted in the meantime fail the whole batch; drop those
+            try:
+                existing = set(Website.objects.filter(pk__in=website_ids).values_list("pk", flat=True))
+            except Exception:
+                existing = website_ids
+            for (website_id, hour), values in pending.items():
+                if website_id in existing:
+                    self._add(website_id, hour, values)
+            with self._lock:
+                for (website_id, url), visits in pages.items():
+                    if website_id in existing:
+                        self._pages[website_id, url] += visits
+
+    @staticmethod
+    def _flush_pages(pages):
+        now = timezone.now()
+        new_pages = []
+        for (website_id, url), visits in pages.items():
+            updated = PageVisit.objects.filter(website_id=website_id, url=url).update(
+                visits=F("visits") + visits, last_visited=now
+            )
+            if not updated:
+                new_pages.append(PageVisit(website_id=website_id, url=url, visits=visits, last_visited=now))
+        # Another process may have created the same page since; its count wins
+        PageVisit.objects.bulk_create(new_pages, ignore_conflicts=True)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="traffic-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            close_old_connections()
+            self.flush()
+
+
+traffic = TrafficCounter(settings.VPN_TRAFFIC_FLUSH_INTERVAL)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path, re_path
 from websites.views import (
     index,
@@ -5,7 +6,9 @@ from websites.views import (
     WebsiteCreationView,
     WebsiteUpdateView,
     WebsiteDeleteView,
-    vpn_website
+    WebsiteStatsView,
+    vpn_website,
+    async_vpn_website,
 )
 
 
@@ -15,7 +18,12 @@ urlpatterns = [
     path("websites/create/", WebsiteCreationView.as_view(), name="create"),
     path("websites/<int:pk>/update/", WebsiteUpdateView.as_view(), name="update"),
     path("websites/<int:pk>/delete/", WebsiteDeleteView.as_view(), name="delete"),
-    re_path(r'^(?P<website_name>[^/]+)/?(?P<subpath>.*)?$', vpn_website, name='get_website'),
+    path("websites/<int:pk>/stats/", WebsiteStatsView.as_view(), name="stats"),
+    re_path(
+        r'^(?P<website_name>[^/]+)/?(?P<subpath>.*)?$',
+        async_vpn_website if settings.VPN_ASYNC_PROXY else vpn_website,
+        name='get_website'
+    ),
 ]
 
 
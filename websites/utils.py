@@ -1,47 +1,15 @@
-import re
+import threading
+import time
 
-from urllib.parse import urljoin, urlencode, urlunparse, urlparse
-from bs4 import BeautifulSoup
+from collections import OrderedDict
+from urllib.parse import unquote, urljoin, urlunparse, urlparse
+from django.conf import settings
+from django.db.models.functions import Lower
 from django.urls.base import reverse
 
+from websites.engines import get_html_engine
 from websites.models import Website
-
-
-def update_links(request, tag, tag_attr, parsed_base_url, main_domain, subpath, website_name):
-    tag[tag_attr] = tag[tag_attr].replace(r'\/', '/')
-    tag[tag_attr] = tag[tag_attr].replace(r'/\\', '/')
-    parsed_url = urlparse(tag[tag_attr])
-    domain = f"{parsed_base_url.scheme}://{parsed_url.netloc}"
-    if main_domain in domain:
-        tag[tag_attr] = tag[tag_attr][len(domain):]
-
-    if tag[tag_attr].startswith('https:'):
-        return
-
-    new_href = urljoin(subpath, tag[tag_attr])
-    if new_href and new_href[0] != '/':
-        new_href = '/' + new_href
-    tag[tag_attr] = request.build_absolute_uri(reverse("websites:get_website", args=[website_name, new_href]))
-
-
-def update_links_and_forms(request, soup, url, website_name, subpath):
-    parsed_base_url = urlparse(url)
-    main_domain = f"{parsed_base_url.netloc}"
-
-    for tag in soup.find_all(['a', 'form', 'button']):
-        for attr, value in tag.attrs.items():
-            if isinstance(value, str) and ('https' in value or value.startswith('/')):
-                update_links(request, tag, attr, parsed_base_url, main_domain, subpath, website_name)
-
-
-def insert_base_tag(soup, url):
-    base_tag = soup.new_tag('base', href=url)
-    if soup.head:
-        soup.head.insert(0, base_tag)
-    else:
-        head_tag = soup.new_tag('head')
-        head_tag.insert(0, base_tag)
-        soup.insert(0, head_tag)
+from websites.rewriter import CHUNK_SIZE, DEFAULT_PORTS, CssRewriter, LinkRewriter
 
 
 def ensure_https(url):
@@ -62,26 +30,189 @@ def ensure_base_path(base_url, subpath):
     return base_url, subpath
 
 
-def filter_headers(headers):
+BODY_HEADERS = ['content-length', 'content-encoding']
+
+
+def normalize_url(url):
+    parsed_url = urlparse(url)
+    scheme = parsed_url.scheme.lower()
+    netloc = (parsed_url.hostname or '').lower()
+    if parsed_url.port and parsed_url.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parsed_url.port}"
+    return urlunparse((scheme, netloc, parsed_url.path or '/', parsed_url.params, parsed_url.query, ''))
+
+
+# Upstream cookies stay in the session's jar; the browser would drop them anyway
+SERVER_SIDE_HEADERS = ['set-cookie', 'set-cookie2']
+
+
+def filter_headers(headers, exclude=()):
     hop_by_hop_headers = [
         'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
         'te', 'trailer', 'transfer-encoding', 'upgrade'
     ]
-    return {key: value for key, value in headers.items() if key.lower() not in hop_by_hop_headers}
+    return {
+        key: value for key, value in headers.items()
+        if key.lower() not in hop_by_hop_headers and key.lower() not in SERVER_SIDE_HEADERS
+        and key.lower() not in exclude
+    }
+
+
+def get_forwarded_headers(request, base_url, website_name):
+    """
+    Client request headers to send upstream: those on
+    VPN_FORWARDED_REQUEST_HEADERS, plus Referer and Origin pointed back at
+    the upstream site. Cookies, credentials and the browser's User-Agent
+    never leave the proxy.
+    """
+    headers = {
+        name: request.headers[name] for name in settings.VPN_FORWARDED_REQUEST_HEADERS if name in request.headers
+    }
+    prefix = reverse("websites:get_website", args=[website_name, ''])
+    referer = urlparse(request.headers.get('Referer', ''))
+    if referer.netloc == request.get_host() and referer.path.lower().startswith(prefix.lower()):
+        headers['Referer'] = urljoin(base_url, unquote(referer.path[len(prefix):]) or '/')
+    if 'Origin' in request.headers:
+        headers['Origin'] = base_url
+    return headers
+
+
+def get_request_size(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+REQUEST_BODY_HEADERS = ['Content-Type', 'Content-Encoding']
+
+
+class RequestBody:
+    """
+    The client's request body as a sized, file-like stream.
+
+    requests sends it with the client's Content-Length, reading it in
+    blocks instead of Django parsing the whole form into memory first. A
+    chunked body has no length; it is false only when there is no body.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.length = get_request_size(request)
+        self.chunked = not self.length and 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return bool(self.length) or self.chunked
+
+    def __iter__(self):
+        while chunk := self.read(CHUNK_SIZE):
+            yield chunk
 
+    def read(self, size=-1):
+        if self.chunked and self.request.META.get('wsgi.input_terminated'):
+            # Django reads WSGI input up to Content-Length only; the server
+            # has already decoded the chunks and marks where the body ends
+            return self.request.META['wsgi.input'].read(size)
+        return self.request.read(size)
 
-def create_correct_soup(request, response, base_url, website_name, subpath, url=None):
-    soup = BeautifulSoup(response.content, 'html.parser')
-    if url:
-        insert_base_tag(soup, url)
-    update_links_and_forms(request, soup, base_url, website_name, subpath)
-    return soup
+
+def get_body_headers(request):
+    headers = {name: request.headers[name] for name in REQUEST_BODY_HEADERS if name in request.headers}
+    if request.headers.get('Content-Length'):
+        headers['Content-Length'] = request.headers['Content-Length']
+    return headers
+
+
+def get_content_length(headers):
+    try:
+        return int(headers.get('Content-Length') or 0)
+    except ValueError:
+        return 0
+
+
+def get_media_type(content_type):
+    return (content_type or '').split(';', 1)[0].strip().lower()
+
+
+def create_link_rewriter(request, base_url, website_name, subpath):
+    proxy_prefix = request.build_absolute_uri(reverse("websites:get_website", args=[website_name, '']))
+    return LinkRewriter(proxy_prefix, base_url, subpath)
+
+
+def create_rewriter(request, base_url, website_name, subpath, url=None, links=None):
+    engine = get_html_engine()
+    return engine(create_link_rewriter(request, base_url, website_name, subpath), base_href=url, links=links)
+
+
+def create_css_rewriter(request, base_url, website_name, subpath):
+    return CssRewriter(create_link_rewriter(request, base_url, website_name, subpath))
+
+
+class WebsiteCache:
+    """
+    In-process cache of website resolution keyed by (user, lower(name)).
+
+    Missing names are cached too. The website views invalidate a user's
+    entries on create, update and delete; other worker processes pick the
+    change up once ``ttl`` seconds have passed. Beyond ``max_size``
+    entries the least recently used one is dropped.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, website_name):
+        """Returns (found, website)."""
+        key = (user_id, website_name.lower())
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries.move_to_end(key)
+        if item is None or item[0] <= time.monotonic():
+            return False, None
+        return True, item[1]
+
+    def set(self, user_id, website_name, website):
+        key = (user_id, website_name.lower())
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, website)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+
+website_cache = WebsiteCache(settings.VPN_WEBSITE_CACHE_TTL)
+
+
+def website_lookup(user, website_name):
+    # Lower() rather than name__iexact, so the (user, lower(name)) unique index is used
+    return Website.objects.annotate(name_lower=Lower("name")).filter(user=user, name_lower=website_name.lower())
 
 
 def find_website(request, website_name):
-    website = Website.objects.filter(user=request.user, name__iexact=website_name).first()
-    if not website:
-        return None
+    found, website = website_cache.get(request.user.pk, website_name)
+    if not found:
+        website = website_lookup(request.user, website_name).first()
+        website_cache.set(request.user.pk, website_name, website)
+    return website
+
+
+async def afind_website(user, website_name):
+    found, website = website_cache.get(user.pk, website_name)
+    if not found:
+        website = await website_lookup(user, website_name).afirst()
+        website_cache.set(user.pk, website_name, website)
     return website
 
 
@@ -1,18 +1,86 @@
-import requests
-import cloudscraper
+import asyncio
 
+from asgiref.sync import sync_to_async
+from concurrent.futures import BrokenExecutor
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import render
+from django.db.models import F, Q, Sum
+from django.db.models.functions import TruncDay
 from django.urls import reverse_lazy
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.crypto import constant_time_compare
 from django.views import generic
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse, urlunparse
 from django.views.decorators.csrf import csrf_exempt
+from requests.structures import CaseInsensitiveDict
 
-from websites.models import Website
+from websites.cache import (
+    CachedResponse,
+    get_cache_key,
+    is_storable,
+    parse_http_date,
+    response_cache,
+    rewritten_etag,
+    translate_validators,
+)
+from websites.coalesce import async_flights, flights, get_flight_key
+from websites.compression import (
+    EncodedStream,
+    IdentityStream,
+    accepts_encoding,
+    add_vary,
+    choose_encoding,
+    create_decoder,
+    create_encoder,
+)
+from websites.errors import ProxyError
+from websites.models import TrafficRollup, Website
 from websites.forms import WebsiteCreateUpdateForm
-from websites.utils import filter_headers, create_correct_soup, find_website, get_baseurl_and_path
+from websites.health import (
+    UPSTREAM_ERRORS,
+    check_upstream,
+    get_upstream_timeout,
+    record_exception,
+    record_response,
+)
+from websites.images import get_image_format, get_variant_key, image_saver
+from websites.limits import RequestLimits, athrottle, throttle
+from websites.metrics import StageTimer, count_request, count_upstream, metrics
+from websites.prefetch import prefetcher
+from websites.rewriter import (
+    CHUNK_SIZE,
+    RewriteStream,
+    arewrite_stream,
+    get_host_port,
+    rewrite_refresh,
+    rewrite_stream,
+)
+from websites.utils import (
+    BODY_HEADERS,
+    RequestBody,
+    afind_website,
+    filter_headers,
+    create_css_rewriter,
+    create_link_rewriter,
+    create_rewriter,
+    find_website,
+    get_baseurl_and_path,
+    get_body_headers,
+    get_forwarded_headers,
+    get_media_type,
+    get_content_length,
+    get_request_size,
+    website_cache,
+)
+from websites.sessions import async_clients, get_cookie_scope, sessions
+from websites.traffic import traffic
 
 
 def index(request: HttpRequest) -> HttpResponse:
@@ -24,9 +92,53 @@ class WebsiteListView(LoginRequiredMixin, generic.ListView):
     paginate_by = 10
     template_name = "websites/list.html"
 
+    def get_queryset(self):
+        recent = Q(traffic__period_start__gte=timezone.now() - timedelta(days=30))
+        return Website.objects.filter(user=self.request.user).annotate(
+            recent_requests=Sum("traffic__requests", filter=recent, default=0),
+            recent_bytes=Sum(F("traffic__bytes_in") + F("traffic__bytes_out"), filter=recent, default=0),
+        ).order_by("pk")
+
+
+class WebsiteStatsView(LoginRequiredMixin, generic.DetailView):
+    model = Website
+    template_name = "websites/stats.html"
+
     def get_queryset(self):
         return Website.objects.filter(user=self.request.user)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        now = timezone.now()
+        traffic_rows = self.object.traffic.all()
+        context["hourly"] = get_traffic_stats(
+            traffic_rows.filter(period=TrafficRollup.HOUR, period_start__gte=now - timedelta(hours=48)),
+            F("period_start"),
+        )
+        context["daily"] = get_traffic_stats(
+            traffic_rows.filter(period_start__gte=now - timedelta(days=30)),
+            TruncDay("period_start"),
+        )
+        return context
+
+
+def get_traffic_stats(rows, bucket):
+    stats = list(
+        rows.annotate(bucket=bucket).values("bucket").annotate(
+            requests=Sum("requests"),
+            transitions=Sum("transitions"),
+            bytes_in=Sum("bytes_in"),
+            bytes_out=Sum("bytes_out"),
+            bytes_saved=Sum("bytes_saved"),
+            cache_hits=Sum("cache_hits"),
+            errors=Sum("errors"),
+            latency_sum=Sum("latency_sum"),
+        ).order_by("-bucket")
+    )
+    for row in stats:
+        row["latency_ms"] = row["latency_sum"] * 1000 / row["requests"] if row["requests"] else 0
+    return stats
+
 
 class WebsiteCreationView(LoginRequiredMixin, generic.CreateView):
     model = Website
@@ -34,9 +146,15 @@ class WebsiteCreationView(LoginRequiredMixin, generic.CreateView):
     form_class = WebsiteCreateUpdateForm
     success_url = reverse_lazy("websites:list")
 
-    def form_valid(self, form):
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        return form
+
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        website_cache.invalidate(self.request.user.pk)
+        return response
 
 
 class WebsiteUpdateView(LoginRequiredMixin, generic.UpdateView):
@@ -48,6 +166,13 @@ class WebsiteUpdateView(LoginRequiredMixin, generic.UpdateView):
     def get_queryset(self):
         return Website.objects.filter(user=self.request.user)
 
+    def form_valid(self, form):
+        sessions.discard(website_id=self.object.pk)
+        async_clients.discard(website_id=self.object.pk)
+        response = super().form_valid(form)
+        website_cache.invalidate(self.request.user.pk)
+        return response
+
 
 class WebsiteDeleteView(LoginRequiredMixin, generic.DeleteView):
     model = Website
@@ -56,69 +181,927 @@ class WebsiteDeleteView(LoginRequiredMixin, generic.DeleteView):
     def get_queryset(self):
         return Website.objects.filter(user=self.request.user)
 
+    def form_valid(self, form):
+        sessions.discard(website_id=self.object.pk)
+        async_clients.discard(website_id=self.object.pk)
+        response = super().form_valid(form)
+        website_cache.invalidate(self.request.user.pk)
+        return response
+
 
-session = cloudscraper.create_scraper()
+def vpn_metrics(request: HttpRequest) -> HttpResponse:
+    """Prometheus text exposition of this process; staff only unless VPN_METRICS_TOKEN is set."""
+    if settings.VPN_METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        allowed = constant_time_compare(authorization, f"Bearer {settings.VPN_METRICS_TOKEN}")
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
-def get_website(request, website, base_url, url, subpath):
-    response = session.get(url, stream=True)
-    response.raise_for_status()
+def visit_page(request, website, url):
+    """Count a visit of an HTML page for prefetching and warm_cache; False when the website doesn't prefetch."""
+    if request.method != 'GET' or not website.prefetch:
+        return False
+    traffic.add_page(website.pk, url)
+    return True
 
-    if response.status_code == 200:
-        soup = create_correct_soup(request, response, base_url, website.name, subpath, url)
-        filtered_headers = filter_headers(response.headers)
 
-        filtered_headers['Content-Type'] = 'text/html; charset=utf-8'
+def rewrite_page(request, upstream_headers, website, base_url, url, subpath, headers):
+    content_type = upstream_headers.get('Content-Type')
+    headers.update(filter_headers(upstream_headers, exclude=BODY_HEADERS + ['accept-ranges', 'content-type', 'etag']))
+    headers['Content-Type'] = f"{get_media_type(content_type)}; charset=utf-8"
 
-        website.transition_count += 1
-        website.bytes_count += len(str(soup))
-        website.save()
+    links = None
+    if visit_page(request, website, url):
+        links = prefetcher.page_links(website, base_url, url, request.forwarded_headers)
+    rewriter = create_rewriter(request, base_url, website.name, subpath, url, links)
+    return RewriteStream(rewriter, content_type)
 
-        return StreamingHttpResponse(
-            str(soup),
-            headers=filtered_headers,
-            status=response.status_code,
-            reason=response.reason
-        )
 
+def rewrite_stylesheet(request, upstream_headers, website, base_url, url, subpath, headers):
+    content_type = upstream_headers.get('Content-Type')
+    headers.update(filter_headers(upstream_headers, exclude=BODY_HEADERS + ['accept-ranges', 'content-type', 'etag']))
+    headers['Content-Type'] = 'text/css; charset=utf-8'
 
-def post_to_website(request, website, base_url, url, subpath):
-    post_data = {key: value for key, value in request.POST.items()}
-    response = session.post(url, data=post_data, stream=True)
+    rewriter = create_css_rewriter(request, base_url, website.name, subpath)
+    return RewriteStream(rewriter, content_type)
 
-    filtered_headers = filter_headers(response.headers)
 
-    if response.status_code == 200:
-        soup = create_correct_soup(request, response, base_url, website.name, subpath, url)
+def pass_through(request, upstream_headers, website, base_url, url, subpath, headers):
+    headers.update(filter_headers(upstream_headers))
+    return None
 
-        return StreamingHttpResponse(
-            str(soup),
-            headers=filtered_headers,
-            status=response.status_code,
-            reason=response.reason
-        )
+
+CONTENT_HANDLERS = {
+    'text/html': rewrite_page,
+    'application/xhtml+xml': rewrite_page,
+    'text/css': rewrite_stylesheet,
+}
+
+
+def is_proxied_redirect(base_url, target):
+    """
+    Whether a redirect to the parsed ``target`` can be sent through the
+    proxy: same host and port, and the website's scheme or an upgrade from
+    http to https, which call_upstream follows. Anything else would come
+    back to the proxy for the website's own URL and loop.
+    """
+    base = urlparse(base_url)
+    if get_host_port(target) != get_host_port(base):
+        return False
+    return target.scheme == base.scheme or (base.scheme, target.scheme) == ('http', 'https')
+
+
+def rewrite_redirect_headers(request, headers, website, base_url, url, subpath):
+    """
+    Point Location and Refresh at vpn/<website_name>/, so the browser
+    follows upstream redirects through the proxy instead of us following
+    them server-side. Redirects leaving the website, including from its
+    apex to its www host or from https to http, are left as they are and
+    take the browser off the proxy; such a website is best added with its
+    final URL.
+    """
+    names = {key.lower(): key for key in headers}
+    if 'location' not in names and 'refresh' not in names:
+        return
+    rewrite_url = create_link_rewriter(request, base_url, website.name, subpath)
+
+    def rewrite_target(value):
+        target = urlparse(urljoin(url, value.strip()))
+        if not is_proxied_redirect(base_url, target):
+            return value
+        location = rewrite_url(urlunparse(('', '', target.path or '/', target.params, target.query, '')))
+        return f"{location}#{target.fragment}" if target.fragment else location
+
+    if 'location' in names:
+        headers[names['location']] = rewrite_target(headers[names['location']])
+    if 'refresh' in names:
+        headers[names['refresh']] = rewrite_refresh(headers[names['refresh']], rewrite_target)
+
+
+def prepare_response(request, upstream_headers, website, base_url, url, subpath, rewrite=True):
+    """
+    Pick the content handler; returns the client headers and the body
+    transformer, if any. The transformer takes the upstream body as it
+    came over the wire and produces it in the encoding the client accepts.
+    Other bodies are passed through untouched unless they are compressed
+    in a way the client doesn't accept, which are transcoded; bodies in an
+    encoding we can't decode, and partial content, always pass as they are.
+    """
+    handler = CONTENT_HANDLERS.get(get_media_type(upstream_headers.get('Content-Type')), pass_through)
+    content_encoding = upstream_headers.get('Content-Encoding')
+    decoder = create_decoder(content_encoding)
+    if decoder is None or not rewrite:
+        handler = pass_through
+
+    headers = {}
+    stream = handler(request, upstream_headers, website, base_url, url, subpath, headers)
+    rewrite_redirect_headers(request, headers, website, base_url, url, subpath)
+    accept_encoding = request.headers.get('Accept-Encoding')
+    if stream is None and rewrite and decoder is not None and not accepts_encoding(accept_encoding, content_encoding):
+        # The upstream session asked for compression the client may not support
+        for key in [key for key in headers if key.lower() in BODY_HEADERS + ['accept-ranges']]:
+            del headers[key]
+        stream = IdentityStream()
+    if stream is not None:
+        encoding = choose_encoding(accept_encoding)
+        stream = EncodedStream(stream, decoder, create_encoder(encoding))
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        add_vary(headers, 'Accept-Encoding')
+        if upstream_headers.get('ETag'):
+            headers['ETag'] = rewritten_etag(upstream_headers['ETag'], get_page_cache_key(request, website, url))
+    elif content_encoding and content_encoding.strip().lower() != 'identity':
+        add_vary(headers, 'Accept-Encoding')
+    return headers, request.stage_timer.time_stream(stream, 'rewrite')
+
+
+def upstream_chunks(response):
+    """
+    The upstream body as it came over the wire, each piece as soon as it
+    arrives: stream() would wait for CHUNK_SIZE bytes of a slow upstream.
+    """
+    while chunk := response.raw.read1(CHUNK_SIZE, decode_content=False):
+        yield chunk
+
+
+def body_chunks(body):
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start:start + CHUNK_SIZE]
+
+
+def get_page_cache_key(request, website, url):
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    proxy_url = request.build_absolute_uri('/')
+    return f"{url} {proxy_url} {website.name} {encoding} {settings.VPN_HTML_ENGINE} {request.cookie_scope}"
+
+
+def cache_entries(response, reason, headers, stream):
+    """Cache entries for the upstream body and, when it is rewritten, for the rewritten page."""
+    if not is_storable(response.status_code, response.headers):
+        return None, None
+    if get_content_length(response.headers) > response_cache.max_entry_size:
+        return None, None
+
+    entry = CachedResponse(response.status_code, reason, response.headers, response.request.headers)
+    if stream is None:
+        return entry, None
+    return entry, response_cache.derive(entry, response.status_code, reason, headers)
+
+
+NOT_MODIFIED_HEADERS = ['cache-control', 'content-location', 'date', 'etag', 'expires', 'last-modified', 'vary']
+
+
+CACHE_HITS = ['HIT', 'REVALIDATED', 'COALESCED']
+
+
+def record_traffic(request, website, count_transition, bytes_received, bytes_sent):
+    timer = request.stage_timer
+    timer.finish(website, bytes_received, bytes_sent)
+    traffic.add(
+        website.pk,
+        transitions=int(count_transition),
+        bytes_in=bytes_received,
+        bytes_out=bytes_sent,
+        bytes_saved=request.bytes_saved,
+        cache_hit=timer.cache_status in CACHE_HITS,
+        error=(timer.status or 0) >= 400,
+        latency=timer.stages['total'],
+    )
+
+
+def finish_not_modified(request, website, response, cache_status):
+    response['X-Cache'] = cache_status
+    request.stage_timer.set_response(response)
+    record_traffic(request, website, True, get_request_size(request), 0)
+    return response
+
+
+def conditional_response(request, website, headers, cache_status):
+    """304 Not Modified when the client's validators match a response with ``headers``, otherwise None."""
+    probe = HttpResponse(headers=headers)
+    last_modified = parse_http_date(probe.get('Last-Modified'))
+    response = get_conditional_response(
+        request,
+        etag=probe.get('ETag'),
+        last_modified=int(last_modified) if last_modified else None,
+        response=probe,
+    )
+    if response is probe:
+        return None
+    return finish_not_modified(request, website, response, cache_status)
+
+
+def upstream_not_modified(request, website, upstream_headers, page_key, translated):
+    """Pass an upstream 304 for the client's own validators through; the parser never runs."""
+    response = HttpResponseNotModified()
+    for key, value in upstream_headers.items():
+        if key.lower() in NOT_MODIFIED_HEADERS:
+            response[key] = value
+    if translated:
+        if response.has_header('ETag'):
+            response['ETag'] = rewritten_etag(response['ETag'], page_key)
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return finish_not_modified(request, website, response, 'MISS')
+
+
+def count_traffic(content, request, website, count_transition, response=None):
+    bytes_received = get_request_size(request)
+    bytes_sent = 0
+    try:
+        for chunk in throttle(content, request.limits):
+            bytes_sent += len(chunk)
+            yield chunk
+    finally:
+        if response is not None:
+            response.close()
+        record_traffic(request, website, count_transition, bytes_received, bytes_sent)
+
+
+def capture_content(content, key, entry):
+    """Cache ``content`` under ``key`` as it streams by, whether it is iterated or async iterated."""
+    if hasattr(content, '__aiter__'):
+        return response_cache.acapture(content, key, entry)
+    return response_cache.capture(content, key, entry)
+
+
+def rewrite_content(content, stream):
+    if hasattr(content, '__aiter__'):
+        return arewrite_stream(content, stream)
+    return rewrite_stream(content, stream)
+
+
+def proxied_content(request, response, reason, content, website, base_url, url, subpath, page_key=None, flight=None):
+    """
+    Client headers and body of an upstream response whose body comes over
+    the wire as ``content``. With a ``page_key`` the body and the rewritten
+    page are cached on the way, and fed to the followers of ``flight``.
+    """
+    headers, stream = prepare_response(
+        request, response.headers, website, base_url, url, subpath, rewrite=response.status_code != 206
+    )
+    entry, page = cache_entries(response, reason, headers, stream) if page_key else (None, None)
+    if flight is not None:
+        flight.start(entry)
+        if entry is not None:
+            content = flight.feed(content)
+    if entry is not None:
+        content = capture_content(content, get_cache_key(url, request.cookie_scope), entry)
+    if stream is not None:
+        content = rewrite_content(content, stream)
+        if page is not None:
+            content = capture_content(content, page_key, page)
+    headers['X-Cache'] = 'MISS'
+    return headers, content
+
+
+def proxy_response(
+    request, response, website, base_url, url, subpath, count_transition=False, page_key=None, flight=None
+):
+    content = request.stage_timer.time_chunks(upstream_chunks(response), 'fetch')
+    headers, content = proxied_content(
+        request, response, response.reason, content, website, base_url, url, subpath, page_key, flight
+    )
+    return StreamingHttpResponse(
+        count_traffic(content, request, website, count_transition, response),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason
+    )
+
+
+def cached_content(request, entry, page, page_key, website, base_url, url, subpath, cache_status, chunks=None):
+    """
+    Headers and body for a cached upstream response; a cached rewritten page
+    skips the parser entirely. ``chunks`` replaces the stored body, e.g. with
+    the shared buffer of a coalesced fetch.
+    """
+    if page is not None:
+        headers = dict(page.headers)
+        content = body_chunks(page.body)
+        is_page = CONTENT_HANDLERS.get(get_media_type(headers.get('Content-Type'))) is rewrite_page
+        if is_page and visit_page(request, website, url):
+            prefetcher.visit(website.pk, url)
+    else:
+        headers, stream = prepare_response(request, entry.headers, website, base_url, url, subpath)
+        content = body_chunks(entry.body) if chunks is None else chunks
+        if stream is not None:
+            page = response_cache.derive(entry, entry.status, entry.reason, headers)
+            content = capture_content(rewrite_content(content, stream), page_key, page)
+
+    set_cache_headers(headers, entry, cache_status)
+    return headers, content
+
+
+def set_cache_headers(headers, entry, cache_status):
+    headers['X-Cache'] = cache_status
+    headers['Age'] = str(int(entry.age))
+
+
+def cached_response(request, entry, page, page_key, website, base_url, url, subpath, cache_status, chunks=None):
+    image_format = get_image_format(website, entry.status, entry.headers)
+    if image_format is not None:
+        source = entry.body if chunks is None else b''.join(chunks)
+        headers, content = saved_image_content(request, url, entry.headers, source, image_format)
+        set_cache_headers(headers, entry, cache_status)
     else:
-        return HttpResponse('Не вдалося обробити запит', status=response.status_code)
+        headers, content = cached_content(
+            request, entry, page, page_key, website, base_url, url, subpath, cache_status, chunks
+        )
+    not_modified = conditional_response(request, website, headers, cache_status)
+    if not_modified is not None:
+        return not_modified
+    return StreamingHttpResponse(
+        count_traffic(content, request, website, True),
+        headers=headers,
+        status=entry.status,
+        reason=entry.reason
+    )
+
+
+def lookup_cached(request, url, page_key, session_headers):
+    """The cached upstream response for ``url`` in the request's cookie scope and its rewritten page."""
+    return response_cache.lookup_page(get_cache_key(url, request.cookie_scope), page_key, session_headers)
+
+
+def follow_flight(request, flight, session_headers, website, base_url, url, subpath, page_key):
+    """Serve a follower from the leader's shared buffer, or from the cache the leader refreshed."""
+    with request.stage_timer.stage('coalesce'):
+        entry = flight.wait(settings.VPN_COALESCE_TIMEOUT)
+    if entry is not None and entry.matches(session_headers):
+        chunks = flight.follow(settings.VPN_COALESCE_TIMEOUT)
+        return cached_response(request, entry, None, page_key, website, base_url, url, subpath, 'COALESCED', chunks)
+
+    entry, page = lookup_cached(request, url, page_key, session_headers)
+    if entry is not None and entry.is_fresh():
+        return cached_response(request, entry, page, page_key, website, base_url, url, subpath, 'HIT')
+    return None
+
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+def get_scheme_upgrade(url, method, response):
+    """
+    The https URL an http GET or HEAD of ``url`` is redirected to, when the
+    redirect changes nothing but the scheme. Handed to the browser, it
+    would come back to the proxy for the website's http URL and loop.
+    """
+    if method not in ('GET', 'HEAD') or response.status_code not in REDIRECT_STATUSES:
+        return None
+    source = urlparse(url)
+    target = urlparse(urljoin(url, response.headers.get('Location', '').strip()))
+    if (source.scheme, target.scheme) != ('http', 'https') or get_host_port(source) != get_host_port(target):
+        return None
+    if (target.path or '/', target.params, target.query) != (source.path or '/', source.params, source.query):
+        return None
+    return urlunparse(target._replace(fragment=''))
+
+
+def send_upstream(request, website, url, send):
+    check_upstream(url, request.method, request.cookie_scope)
+    try:
+        with request.stage_timer.stage('upstream'):
+            response = send(url)
+    except UPSTREAM_ERRORS as exc:
+        raise record_exception(url, exc) from exc
+    record_response(url, request.method, response.status_code, request.cookie_scope)
+    count_upstream(website, response.status_code)
+    return response
+
+
+def call_upstream(request, website, url, send):
+    """
+    Run ``send(url)`` under the upstream host's circuit breaker; connection
+    failures and timeouts become an UpstreamError with a gateway status.
+    A redirect to the same URL over https is followed here.
+    """
+    response = send_upstream(request, website, url, send)
+    upgrade = get_scheme_upgrade(url, request.method, response)
+    if upgrade is not None:
+        response.close()
+        response = send_upstream(request, website, upgrade, send)
+    return response
+
+
+def store_image_variant(key, future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    headers = {'Cache-Control': f"max-age={settings.VPN_DATA_SAVER_CACHE_TTL}"}
+    # An empty body records that transcoding didn't make the image smaller
+    response_cache.store(key, CachedResponse(200, 'OK', headers, body=future.result() or b''))
+
+
+def transcode_image(url, headers, source, image_format):
+    """
+    Submit a transcoding job unless the variant for this source is cached;
+    returns the cached image (None if it didn't get smaller) or the future.
+    """
+    key = get_variant_key(url, headers.get('ETag'), source)
+    variant = response_cache.lookup(key, {})
+    if variant is not None:
+        return variant.body or None, None
+    future = image_saver.submit(source, image_format)
+    future.add_done_callback(partial(store_image_variant, key))
+    return None, future
+
+
+def image_content(request, upstream_headers, source, image):
+    """Headers and body of a data-saver image; the source itself when transcoding didn't help."""
+    body = image or source
+    exclude = BODY_HEADERS + ['etag'] if image else BODY_HEADERS
+    headers = filter_headers(upstream_headers, exclude=exclude)
+    headers['Content-Length'] = str(len(body))
+    request.bytes_saved = len(source) - len(body)
+    return headers, body_chunks(body)
+
+
+def saved_image_content(request, url, upstream_headers, source, image_format):
+    """Headers and body of a data-saver image; the source is sent as it is if transcoding takes too long."""
+    with request.stage_timer.stage('transcode'):
+        try:
+            image, future = transcode_image(url, upstream_headers, source, image_format)
+            if future is not None:
+                image = future.result(timeout=settings.VPN_DATA_SAVER_TIMEOUT)
+        except TimeoutError:
+            image = None
+        except BrokenExecutor as exc:
+            image_saver.reset(exc)
+            image = None
+    return image_content(request, upstream_headers, source, image)
+
+
+def store_image_source(request, response, reason, url, source):
+    """Cache the image as the upstream sent it; a hit transcodes it again, or finds the cached variant."""
+    entry, _ = cache_entries(response, reason, {}, None)
+    if entry is not None:
+        entry.body = source
+        response_cache.store(get_cache_key(url, request.cookie_scope), entry)
+
+
+def saved_image_response(request, response, website, url, image_format):
+    source = b''.join(request.stage_timer.time_chunks(upstream_chunks(response), 'fetch'))
+    response.close()
+    store_image_source(request, response, response.reason, url, source)
+    headers, content = saved_image_content(request, url, response.headers, source, image_format)
+    headers['X-Cache'] = 'MISS'
+    return StreamingHttpResponse(
+        count_traffic(content, request, website, True),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason
+    )
+
+
+def get_conditional_headers(request, entry, page_key):
+    """
+    Validators for the upstream GET: the cached entry's, or else the
+    client's own translated back to the upstream's; the flag tells which.
+    """
+    if entry is not None:
+        return entry.conditional_headers(), False
+    return translate_validators(request.headers, page_key)
+
+
+def revalidate_cached(request, website, upstream_headers, url, entry, page, page_key, translated):
+    """
+    Handle an upstream 304. Without a cached entry the validators were the
+    client's, who gets the 304; otherwise the entry is refreshed and None
+    returned for the caller to serve it.
+    """
+    if entry is None:
+        return upstream_not_modified(request, website, upstream_headers, page_key, translated)
+    response_cache.revalidate(get_cache_key(url, request.cookie_scope), page_key, entry, page, upstream_headers)
+    return None
+
+
+def fetch_website(request, session, website, base_url, url, subpath, entry, page, page_key, flight):
+    conditional_headers, translated = get_conditional_headers(request, entry, page_key)
+    response = call_upstream(request, website, url, lambda target: session.get(
+        target, headers={**request.forwarded_headers, **conditional_headers},
+        stream=True, allow_redirects=False, timeout=get_upstream_timeout()
+    ))
+    if response.status_code == 304:
+        response.close()
+        not_modified = revalidate_cached(request, website, response.headers, url, entry, page, page_key, translated)
+        if not_modified is not None:
+            return not_modified
+        return cached_response(request, entry, page, page_key, website, base_url, url, subpath, 'REVALIDATED')
+
+    image_format = get_image_format(website, response.status_code, response.headers)
+    if image_format is not None:
+        return saved_image_response(request, response, website, url, image_format)
+
+    return proxy_response(
+        request, response, website, base_url, url, subpath,
+        count_transition=True, page_key=page_key, flight=flight
+    )
+
+
+RANGE_HEADERS = ['Range', 'If-Range']
+
+
+def get_range_headers(request):
+    range_headers = {name: request.headers[name] for name in RANGE_HEADERS if name in request.headers}
+    return {**request.forwarded_headers, **range_headers}
+
+
+def get_range(request, session, website, base_url, url, subpath):
+    """
+    Ranged GETs skip the cache and coalescing: a seek costs one ranged
+    upstream request whose 206 is streamed back as it is.
+    """
+    response = call_upstream(request, website, url, lambda target: session.get(
+        target, headers=get_range_headers(request),
+        stream=True, allow_redirects=False, timeout=get_upstream_timeout()
+    ))
+    return proxy_response(request, response, website, base_url, url, subpath, count_transition=True)
+
+
+def head_website(request, website, base_url, url, subpath):
+    session = sessions.get(request.user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(session, url)
+    response = call_upstream(request, website, url, lambda target: session.head(
+        target, headers=request.forwarded_headers, allow_redirects=False, timeout=get_upstream_timeout()
+    ))
+    headers, _ = prepare_response(request, response.headers, website, base_url, url, subpath)
+    return StreamingHttpResponse(
+        count_traffic(iter(()), request, website, False, response),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason
+    )
+
+
+def get_upstream_headers(request, session):
+    """Headers an upstream GET is sent with, to match cached responses and coalesced fetches against."""
+    return CaseInsensitiveDict({**session.headers, **request.forwarded_headers})
+
+
+def get_website(request, website, base_url, url, subpath):
+    session = sessions.get(request.user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(session, url)
+    if 'Range' in request.headers:
+        return get_range(request, session, website, base_url, url, subpath)
+    page_key = get_page_cache_key(request, website, url)
+    session_headers = get_upstream_headers(request, session)
+    with request.stage_timer.stage('cache'):
+        entry, page = lookup_cached(request, url, page_key, session_headers)
+    if entry is not None and entry.is_fresh():
+        return cached_response(request, entry, page, page_key, website, base_url, url, subpath, 'HIT')
+
+    flight, leader = flights.join(get_flight_key(url, session_headers, request.cookie_scope))
+    if not leader:
+        response = follow_flight(request, flight, session_headers, website, base_url, url, subpath, page_key)
+        if response is not None:
+            return response
+        flight = None
+
+    try:
+        return fetch_website(request, session, website, base_url, url, subpath, entry, page, page_key, flight)
+    finally:
+        if flight is not None:
+            flight.start(None)
+
+
+BODY_METHODS = ['POST', 'PUT', 'PATCH', 'DELETE']
+# Sent upstream as they come, like the BODY_METHODS, but change nothing there
+SENT_METHODS = BODY_METHODS + ['OPTIONS']
+
+
+def invalidate_cache(request, url):
+    """Drop the user's and the shared copy of ``url`` after an unsafe request to it."""
+    for key in {url, get_cache_key(url, request.cookie_scope)}:
+        response_cache.invalidate(key)
+
+
+def send_to_website(request, website, base_url, url, subpath):
+    """
+    Stream the client's request body upstream as is, whatever its
+    Content-Type, and the response back like a GET's, errors included.
+    A successful request with a BODY_METHODS method invalidates the cache.
+    """
+    session = sessions.get(request.user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(session, url)
+    body = RequestBody(request)
+    response = call_upstream(request, website, url, lambda target: session.request(
+        request.method, target, data=body or None, headers={**request.forwarded_headers, **get_body_headers(request)},
+        stream=True, allow_redirects=False, timeout=get_upstream_timeout()
+    ))
+
+    if request.method in BODY_METHODS and response.status_code < 400:
+        invalidate_cache(request, url)
+    return proxy_response(request, response, website, base_url, url, subpath)
+
+
+def get_website_url(website, subpath):
+    """The website's base URL, the requested subpath under it and the upstream URL they make."""
+    base_url, subpath = get_baseurl_and_path(website, subpath)
+    url = urljoin(base_url, subpath) if subpath else base_url
+    return base_url, subpath, url
+
+
+def start_proxying(request, user, website, base_url):
+    request.limits = RequestLimits(user.pk, website.pk)
+    request.forwarded_headers = get_forwarded_headers(request, base_url, website.name)
+    request.bytes_saved = 0
+
+
+def error_response(request, website, error):
+    """The response for an UpstreamError or LimitExceeded, counted like a proxied one."""
+    response = count_request(error.response(), request, website)
+    record_traffic(request, website, False, get_request_size(request), len(response.content))
+    return response
 
 
 @csrf_exempt
 @login_required
 def vpn_website(request: HttpRequest, website_name: str, subpath: str = '') -> HttpResponse | StreamingHttpResponse:
-    website = find_website(request, website_name)
+    request.stage_timer = StageTimer()
+    with request.stage_timer.stage('find_website'):
+        website = find_website(request, website_name)
 
     if not website:
         return HttpResponse('У вас немає такого сайту. Добавте.', status=404)
 
-    base_url, subpath = get_baseurl_and_path(website, subpath)
-    url = urljoin(base_url, subpath) if subpath else base_url
+    base_url, subpath, url = get_website_url(website, subpath)
+    start_proxying(request, request.user, website, base_url)
+    try:
+        request.limits.check()
+        if request.method == "GET":
+            return count_request(get_website(request, website, base_url, url, subpath), request, website)
+
+        elif request.method == "HEAD":
+            return count_request(head_website(request, website, base_url, url, subpath), request, website)
+
+        elif request.method in SENT_METHODS:
+            return count_request(send_to_website(request, website, base_url, url, subpath), request, website)
+
+    except ProxyError as error:
+        return error_response(request, website, error)
+
+    return HttpResponse('Де сторінка', status=404)
+
+
+def aupstream_chunks(response):
+    # With a chunk size httpx would buffer up to it; without, it yields what each read returns
+    return response.aiter_raw()
+
+
+async def acount_traffic(content, request, website, count_transition, response=None):
+    bytes_received = get_request_size(request)
+    bytes_sent = 0
+    try:
+        async for chunk in athrottle(content, request.limits):
+            bytes_sent += len(chunk)
+            yield chunk
+    finally:
+        if response is not None:
+            await response.aclose()
+        record_traffic(request, website, count_transition, bytes_received, bytes_sent)
+
+
+def aproxy_response(
+    request, response, website, base_url, url, subpath, count_transition=False, page_key=None, flight=None
+):
+    content = request.stage_timer.atime_chunks(aupstream_chunks(response), 'fetch')
+    headers, content = proxied_content(
+        request, response, response.reason_phrase, content, website, base_url, url, subpath, page_key, flight
+    )
+    return StreamingHttpResponse(
+        acount_traffic(content, request, website, count_transition, response),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason_phrase
+    )
+
+
+async def aiterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def acached_response(
+    request, entry, page, page_key, website, base_url, url, subpath, cache_status, chunks=None
+):
+    image_format = get_image_format(website, entry.status, entry.headers)
+    if image_format is not None:
+        if chunks is None:
+            source = entry.body
+        elif hasattr(chunks, '__aiter__'):
+            source = b''.join([chunk async for chunk in chunks])
+        else:
+            source = b''.join(chunks)
+        headers, content = await asaved_image_content(request, url, entry.headers, source, image_format)
+        set_cache_headers(headers, entry, cache_status)
+    else:
+        headers, content = cached_content(
+            request, entry, page, page_key, website, base_url, url, subpath, cache_status, chunks
+        )
+    not_modified = conditional_response(request, website, headers, cache_status)
+    if not_modified is not None:
+        return not_modified
+    if not hasattr(content, '__aiter__'):
+        content = aiterate(content)
+    return StreamingHttpResponse(
+        acount_traffic(content, request, website, True),
+        headers=headers,
+        status=entry.status,
+        reason=entry.reason
+    )
+
+
+async def afollow_flight(request, flight, client_headers, website, base_url, url, subpath, page_key):
+    with request.stage_timer.stage('coalesce'):
+        entry = await flight.wait(settings.VPN_COALESCE_TIMEOUT)
+    if entry is not None and entry.matches(client_headers):
+        chunks = flight.follow(settings.VPN_COALESCE_TIMEOUT)
+        return await acached_response(
+            request, entry, None, page_key, website, base_url, url, subpath, 'COALESCED', chunks
+        )
+
+    entry, page = lookup_cached(request, url, page_key, client_headers)
+    if entry is not None and entry.is_fresh():
+        return await acached_response(request, entry, page, page_key, website, base_url, url, subpath, 'HIT')
+    return None
+
+
+async def asend_upstream(request, website, url, send):
+    check_upstream(url, request.method, request.cookie_scope)
+    try:
+        with request.stage_timer.stage('upstream'):
+            response = await send(url)
+    except UPSTREAM_ERRORS as exc:
+        raise record_exception(url, exc) from exc
+    record_response(url, request.method, response.status_code, request.cookie_scope)
+    count_upstream(website, response.status_code)
+    return response
+
+
+async def acall_upstream(request, website, url, send):
+    response = await asend_upstream(request, website, url, send)
+    upgrade = get_scheme_upgrade(url, request.method, response)
+    if upgrade is not None:
+        await response.aclose()
+        response = await asend_upstream(request, website, upgrade, send)
+    return response
+
+
+async def asaved_image_content(request, url, upstream_headers, source, image_format):
+    with request.stage_timer.stage('transcode'):
+        try:
+            image, future = transcode_image(url, upstream_headers, source, image_format)
+            if future is not None:
+                image = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)), settings.VPN_DATA_SAVER_TIMEOUT
+                )
+        except TimeoutError:
+            image = None
+        except BrokenExecutor as exc:
+            image_saver.reset(exc)
+            image = None
+    return image_content(request, upstream_headers, source, image)
+
+
+async def asaved_image_response(request, response, website, url, image_format):
+    chunks = request.stage_timer.atime_chunks(aupstream_chunks(response), 'fetch')
+    source = b''.join([chunk async for chunk in chunks])
+    await response.aclose()
+    store_image_source(request, response, response.reason_phrase, url, source)
+    headers, content = await asaved_image_content(request, url, response.headers, source, image_format)
+    headers['X-Cache'] = 'MISS'
+    return StreamingHttpResponse(
+        acount_traffic(aiterate(content), request, website, True),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason_phrase
+    )
+
+
+async def afetch_website(request, client, website, base_url, url, subpath, entry, page, page_key, flight):
+    conditional_headers, translated = get_conditional_headers(request, entry, page_key)
+    headers = {**request.forwarded_headers, **conditional_headers}
+    response = await acall_upstream(request, website, url, lambda target: client.send(
+        client.build_request('GET', target, headers=headers), stream=True
+    ))
+    if response.status_code == 304:
+        await response.aclose()
+        not_modified = revalidate_cached(request, website, response.headers, url, entry, page, page_key, translated)
+        if not_modified is not None:
+            return not_modified
+        return await acached_response(request, entry, page, page_key, website, base_url, url, subpath, 'REVALIDATED')
+
+    image_format = get_image_format(website, response.status_code, response.headers)
+    if image_format is not None:
+        return await asaved_image_response(request, response, website, url, image_format)
+
+    return aproxy_response(
+        request, response, website, base_url, url, subpath,
+        count_transition=True, page_key=page_key, flight=flight
+    )
+
+
+async def aget_range(request, client, website, base_url, url, subpath):
+    headers = get_range_headers(request)
+    response = await acall_upstream(request, website, url, lambda target: client.send(
+        client.build_request('GET', target, headers=headers), stream=True
+    ))
+    return aproxy_response(request, response, website, base_url, url, subpath, count_transition=True)
+
+
+async def ahead_website(request, user, website, base_url, url, subpath):
+    client = await async_clients.aget(user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(client, url)
+    response = await acall_upstream(
+        request, website, url, lambda target: client.head(target, headers=request.forwarded_headers)
+    )
+    headers, _ = prepare_response(request, response.headers, website, base_url, url, subpath)
+    return StreamingHttpResponse(
+        acount_traffic(aiterate(()), request, website, False, response),
+        headers=headers,
+        status=response.status_code,
+        reason=response.reason_phrase
+    )
+
+
+async def aget_website(request, user, website, base_url, url, subpath):
+    client = await async_clients.aget(user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(client, url)
+    if 'Range' in request.headers:
+        return await aget_range(request, client, website, base_url, url, subpath)
+    page_key = get_page_cache_key(request, website, url)
+    client_headers = get_upstream_headers(request, client)
+    with request.stage_timer.stage('cache'):
+        entry, page = lookup_cached(request, url, page_key, client_headers)
+    if entry is not None and entry.is_fresh():
+        return await acached_response(request, entry, page, page_key, website, base_url, url, subpath, 'HIT')
+
+    flight, leader = async_flights.join(get_flight_key(url, client_headers, request.cookie_scope))
+    if not leader:
+        response = await afollow_flight(request, flight, client_headers, website, base_url, url, subpath, page_key)
+        if response is not None:
+            return response
+        flight = None
+
+    try:
+        return await afetch_website(request, client, website, base_url, url, subpath, entry, page, page_key, flight)
+    finally:
+        if flight is not None:
+            flight.start(None)
+
+
+async def aiter_request_body(body):
+    while chunk := body.read(CHUNK_SIZE):
+        yield chunk
+
+
+async def asend_to_website(request, user, website, base_url, url, subpath):
+    client = await async_clients.aget(user.pk, website.pk, base_url)
+    request.cookie_scope = get_cookie_scope(client, url)
+    body = RequestBody(request)
+    upstream_request = client.build_request(
+        request.method, url, content=aiter_request_body(body) if body else None,
+        headers={**request.forwarded_headers, **get_body_headers(request)},
+    )
+    response = await acall_upstream(request, website, url, lambda target: client.send(upstream_request, stream=True))
+
+    if request.method in BODY_METHODS and response.status_code < 400:
+        invalidate_cache(request, url)
+    return aproxy_response(request, response, website, base_url, url, subpath)
+
+
+@csrf_exempt
+@login_required
+async def async_vpn_website(
+    request: HttpRequest, website_name: str, subpath: str = ''
+) -> HttpResponse | StreamingHttpResponse:
+    request.stage_timer = StageTimer()
+    user = await request.auser()
+    with request.stage_timer.stage('find_website'):
+        website = await afind_website(user, website_name)
+
+    if not website:
+        return HttpResponse('У вас немає такого сайту. Добавте.', status=404)
+
+    base_url, subpath, url = get_website_url(website, subpath)
+    start_proxying(request, user, website, base_url)
+    try:
+        await sync_to_async(request.limits.check)()
+        if request.method == "GET":
+            return count_request(await aget_website(request, user, website, base_url, url, subpath), request, website)
 
-    if request.method == "OPTIONS":
-        return requests.options(url, stream=True)
+        elif request.method == "HEAD":
+            return count_request(await ahead_website(request, user, website, base_url, url, subpath), request, website)
 
-    if request.method == "GET":
-        return get_website(request, website, base_url, url, subpath)
+        elif request.method in SENT_METHODS:
+            return count_request(
+                await asend_to_website(request, user, website, base_url, url, subpath), request, website
+            )
 
-    elif request.method == "POST":
-        return post_to_website(request, website, base_url, url, subpath)
+    except ProxyError as error:
+        return error_response(request, website, error)
 
     return HttpResponse('Де сторінка', status=404)